@@ -0,0 +1,51 @@
+#!/usr/bin/env/python
+
+"""Move old records from the database into compressed monthly archives."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+
+from datetime import datetime, timedelta
+from logging import info, INFO, basicConfig
+from diary_peter.archive import ARCHIVE_AFTER_DAYS, ARCHIVE_PATH, archive
+from diary_peter.models import connection
+from diary_peter.search import is_postgres
+
+if __name__ == '__main__':
+    basicConfig(format='%(levelname)s\t%(message)s', level=INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+        help="Archive records older than this many days")
+    parser.add_argument("--path", default=ARCHIVE_PATH,
+        help="Archive directory")
+    parser.add_argument("--vacuum", action="store_true",
+        help="Reclaim the space of archived records afterwards")
+    args = parser.parse_args()
+
+    before = datetime.now() - timedelta(days=args.days)
+    info("Archiving records created before {}...".format(before))
+
+    with connection() as database:
+        count = archive(before, args.path)
+        info("Archived {} records.".format(count))
+
+        if args.vacuum:
+            info("Vacuuming...")
+            database.execute_sql(
+                "VACUUM ANALYZE record" if is_postgres(database) else "VACUUM")
+
+    info("Done.")
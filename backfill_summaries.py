@@ -0,0 +1,51 @@
+#!/usr/bin/env/python
+
+"""Rebuild daily summaries from all existing and archived records."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+
+from logging import info, INFO, basicConfig
+from diary_peter.archive import ARCHIVE_PATH, archived_rows
+from diary_peter.models import connection, DailySummary, User
+
+if __name__ == '__main__':
+    basicConfig(format='%(levelname)s\t%(message)s', level=INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch-size", type=int, default=100,
+        help="Number of users rebuilt per transaction")
+    parser.add_argument("--archive-path", default=ARCHIVE_PATH,
+        help="Archive directory")
+    args = parser.parse_args()
+
+    last, users, days = 0, 0, 0
+    while True:
+        with connection():
+            ids = [u.id for u in User.select(User.id)
+                .where(User.id > last)
+                .order_by(User.id)
+                .limit(args.batch_size)]
+            if not ids:
+                break
+            days += DailySummary.rebuild(ids,
+                archived_rows(ids, args.archive_path))
+
+        users += len(ids)
+        last = ids[-1]
+        info("Rebuilt {} days of {} users...".format(days, users))
+
+    info("Done.")
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+
+"""Drive synthetic conversations through main.update_handler.
+
+Each simulated user goes through Setup onboarding, writes diary entries,
+presses a stale button, answers a Gratitude prompt and writes some more.
+Users are interleaved. A stub bot stands in for Telegram, or with
+--api-latency the fake Bot API from tests/fakeapi.py does, with requests
+sent through the outbox. The report shows throughput and handler latency
+per coach and state. --output saves it as JSON, so results can be
+compared across commits.
+
+Usage: python benchmarks/load.py [--users 200] [--entries 5] [--workers 4]
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import defaultdict
+from threading import Lock
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+# Always run against a scratch SQLite database, configured before the models
+# are imported
+os.environ.pop("PG_PASS", None)
+TMPDIR = tempfile.mkdtemp()
+os.environ["SQLITE_PATH"] = os.path.join(TMPDIR, "load.db")
+
+# Keep main.py from logging every update to a file and coaches from
+# warning about the stale button presses below
+logging.basicConfig(level=logging.ERROR)
+
+import telegram  # noqa
+from telegram.emoji import Emoji  # noqa
+
+import main  # noqa
+from conftest import custom_update_data, inline_query_data  # noqa
+from diary_peter import coaches  # noqa
+from diary_peter.cache import user_cache  # noqa
+from diary_peter.dispatch import OrderedWorkerPool  # noqa
+from diary_peter.jobs import generic_job  # noqa
+from diary_peter.migrations import SchemaVersion, stamp  # noqa
+from diary_peter.models import db, connection, DailySummary, Job, Record, \
+    User  # noqa
+from diary_peter.outbox import Outbox  # noqa
+from diary_peter.search import create_index  # noqa
+from diary_peter.shards import shard_of  # noqa
+from fakeapi import FakeBotAPI  # noqa
+
+WORDS = ("today I went to the park with friends and had coffee lunch walk "
+    "work meeting book read slept well rain sun dinner cooked called mum "
+    "finished project garden run tired happy").split()
+
+
+class StubBot(object):
+    """Bot that accepts every request without sending anything."""
+
+    def __init__(self):
+        """Init counter."""
+        self.requests = 0
+
+    def sendMessage(self, chat_id, **kwargs):
+        """Count message."""
+        self.requests += 1
+
+    def answerCallbackQuery(self, callback_query_id, **kwargs):
+        """Count answer."""
+        self.requests += 1
+
+
+def tguser_data(telegram_id):
+    """Return the JSON data of a Telegram user."""
+    return {
+        'id': telegram_id,
+        'first_name': "Load",
+        'last_name': str(telegram_id),
+        'username': "load{}".format(telegram_id),
+        'type': "private"
+    }
+
+
+def message(telegram_id, text):
+    """Return a message update from a user."""
+    data = custom_update_data(text)
+    data['message']['from'] = data['message']['chat'] = \
+        tguser_data(telegram_id)
+    return telegram.Update.de_json(data)
+
+
+def callback(telegram_id, value):
+    """Return a callback query update from a user."""
+    data = inline_query_data(value)
+    user = tguser_data(telegram_id)
+    data['inline_query']['from'] = data['inline_query']['chat'] = user
+    data['callback_query']['from'] = user
+    data['callback_query']['message']['chat'] = user
+    return telegram.Update.de_json(data)
+
+
+def sentence(rng):
+    """Return a made up diary entry."""
+    return " ".join(rng.sample(WORDS, rng.randint(4, 12))).capitalize()
+
+
+def conversation(telegram_id, entries, rng):
+    """Return the steps of one user's conversation.
+
+    Steps are updates, or None where the Gratitude job fires.
+    """
+    steps = [
+        message(telegram_id, "/start"),
+        message(telegram_id, "Load {}".format(telegram_id)),
+        message(telegram_id, "{}am".format(rng.randint(6, 10))),
+        message(telegram_id, Emoji.THUMBS_UP_SIGN),
+        callback(telegram_id, "Gratitude"),
+        callback(telegram_id, "continue")
+    ]
+    steps += [message(telegram_id, sentence(rng)) for i in range(entries)]
+    steps.append(callback(telegram_id, "continue"))
+    steps.append(None)
+    steps += [message(telegram_id, sentence(rng)) for i in range(6)]
+    steps += [message(telegram_id, sentence(rng)) for i in range(entries)]
+    return steps
+
+
+def state_names():
+    """Return a dictionary of (coach, state number) to state labels."""
+    return {key: "{}:{}".format(key[0], handler.name)
+        for key, handler in coaches.registry.handlers.items()}
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def commit():
+    """Return the current git commit or None."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(users, entries, workers, seed=0, api=None, outbox_options=None,
+        shard=None):
+    """Run all conversations and return the report as a dictionary.
+
+    If api is a `FakeBotAPI`, requests are sent to it through an outbox
+    created with outbox_options. With shard set to `(index, shards)` only the
+    conversations of users in that shard are run.
+    """
+    rng = random.Random(seed)
+    names = state_names()
+    if api is None:
+        outbox = None
+        bot = StubBot()
+        main.outbox = SimpleNamespace(bot=bot)
+    else:
+        outbox = Outbox(telegram.Bot(api.token, base_url=api.base_url),
+            **(outbox_options or {}))
+        outbox.start()
+        bot = outbox.bot
+        main.outbox = outbox
+
+    with connection():
+        db.create_tables([User, Record, Job, DailySummary, SchemaVersion])
+        create_index()
+        stamp()
+
+    ids = [1000000 + i for i in range(users)]
+    if shard is not None:
+        ids = [i for i in ids if shard_of(i, shard[1]) == shard[0]]
+    users = len(ids)
+    streams = [conversation(i, entries, rng) for i in ids]
+
+    samples = defaultdict(list)
+    lock = Lock()
+
+    def handle(telegram_id, update):
+        if update is None:
+            with connection():
+                jobs = list(Job.select(Job, User).join(User)
+                    .where(User.telegram_id == telegram_id))
+                for telegram_id in generic_job(bot, jobs):
+                    user_cache.invalidate(telegram_id)
+            return
+
+        user = User.from_cache(telegram_id)
+        if user is None:
+            with connection():
+                user = User.get_or_create(telegram_id=telegram_id,
+                    chat_id=telegram_id)[0]
+        label = names.get((user.active_coach, user.state), "{}:{}".format(
+            user.active_coach, user.state))
+
+        started = time.monotonic()
+        main.update_handler(bot, update)
+        elapsed = time.monotonic() - started
+        with lock:
+            samples[label].append(elapsed)
+
+    # Interleave users like concurrent conversations would be
+    steps = []
+    cursors = [0] * users
+    active = list(range(users))
+    while active:
+        i = rng.choice(active)
+        steps.append((ids[i], streams[i][cursors[i]]))
+        cursors[i] += 1
+        if cursors[i] == len(streams[i]):
+            active.remove(i)
+
+    started = time.monotonic()
+    if workers:
+        pool = OrderedWorkerPool(workers=workers, name="load")
+        pool.start()
+        for telegram_id, update in steps:
+            pool.submit(telegram_id, handle, telegram_id, update)
+        pool.stop()
+        failed = sum(s["failed"] for s in pool.get_stats())
+    else:
+        failed = 0
+        for telegram_id, update in steps:
+            try:
+                handle(telegram_id, update)
+            except Exception:
+                logging.exception("Update failed")
+                failed += 1
+    elapsed = time.monotonic() - started
+
+    updates = sum(len(v) for v in samples.values())
+    if outbox is None:
+        api_report = {"requests": bot.requests}
+    else:
+        outbox.stop()
+        api_report = {
+            "requests": len(api.calls),
+            "sent": outbox.sent,
+            "failed": outbox.failed,
+            "throttled": outbox.throttled,
+            "drained": time.monotonic() - started
+        }
+
+    return {
+        "commit": commit(),
+        "users": users,
+        "entries": entries,
+        "workers": workers,
+        "shard": shard,
+        "updates": updates,
+        "failed": failed,
+        "seconds": elapsed,
+        "throughput": updates / elapsed,
+        "api": api_report,
+        "states": {label: {
+            "count": len(values),
+            "p50": percentile(values, 50) * 1000,
+            "p95": percentile(values, 95) * 1000,
+            "p99": percentile(values, 99) * 1000
+        } for label, values in sorted(samples.items())}
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--entries", type=int, default=5,
+        help="Diary entries per user before and after the Gratitude session")
+    parser.add_argument("--workers", type=int, default=4,
+        help="Worker threads, 0 handles updates on the main thread")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the report as JSON")
+    parser.add_argument("--shard", type=int, nargs=2,
+        metavar=("INDEX", "SHARDS"),
+        help="Only run the users of one shard, see benchmarks/shards.py")
+    parser.add_argument("--api-latency", type=float,
+        help="Send to a fake Bot API answering after this many ms")
+    parser.add_argument("--api-error-rate", type=float, default=0,
+        help="Fraction of fake Bot API requests that fail")
+    parser.add_argument("--api-chat-rate", type=float,
+        help="Messages per second and chat before the fake API returns 429")
+    args = parser.parse_args()
+
+    api = None
+    if args.api_latency is not None:
+        api = FakeBotAPI(latency=args.api_latency / 1000,
+            error_rate=args.api_error_rate, chat_rate=args.api_chat_rate,
+            seed=args.seed)
+        api.start()
+
+    try:
+        report = run(args.users, args.entries, args.workers, args.seed, api, {
+            "global_rate": float(os.environ.get("SEND_RATE", 30)),
+            "chat_rate": float(os.environ.get("CHAT_SEND_RATE", 1)),
+            "chat_burst": int(os.environ.get("CHAT_SEND_BURST", 3)),
+            "backoff": 0.1
+        }, args.shard)
+    finally:
+        if api is not None:
+            api.stop()
+        shutil.rmtree(TMPDIR)
+
+    print("{updates} updates in {seconds:.2f}s: {throughput:.1f} updates/s, "
+        "{failed} failed".format(**report))
+    if api is not None:
+        print("{sent} requests sent, {failed} failed, {throttled} throttled, "
+            "outbox drained after {drained:.2f}s".format(**report["api"]))
+    print("{:<40} {:>6} {:>9} {:>9} {:>9}".format(
+        "state", "count", "p50 ms", "p95 ms", "p99 ms"))
+    for label, s in report["states"].items():
+        print("{:<40} {count:>6} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f}".format(
+            label, **s))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""Measure full-text search against scanning records with LIKE.
+
+Usage: python benchmarks/search.py [--records 1000000] [--users 1000]
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from peewee import SqliteDatabase
+from playhouse.test_utils import test_database
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from diary_peter.models import User, Record, DailySummary  # noqa
+from diary_peter.search import create_index, search  # noqa
+
+
+def vocabulary(size, rng):
+    """Return a list of made up words."""
+    letters = "abcdefghiklmnoprstuvw"
+    return ["".join(rng.choice(letters) for i in range(rng.randint(3, 9)))
+        for j in range(size)]
+
+
+def corpus(words, users, records, rng):
+    """Yield rows of synthetic diary entries.
+
+    Word frequencies roughly follow Zipf's law, like natural language.
+    """
+    weights = list(itertools.accumulate(
+        1.0 / (i + 1) for i in range(len(words))))
+    start = datetime.now() - timedelta(days=365)
+    for i in range(records):
+        text = rng.choices(words, cum_weights=weights, k=rng.randint(5, 30))
+        yield {
+            "user": rng.randint(1, users),
+            "kind": "text",
+            "content": " ".join(text),
+            "reaction": None,
+            "created": start + timedelta(seconds=i * 30)
+        }
+
+
+def percentile(values, p):
+    """Return the p-th percentile of values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timed(func, *args):
+    """Return milliseconds taken by func."""
+    started = time.monotonic()
+    func(*args)
+    return (time.monotonic() - started) * 1000
+
+
+def run(records, users, queries, seed=0):
+    """Fill a database with a synthetic corpus and time searches."""
+    rng = random.Random(seed)
+    words = vocabulary(5000, rng)
+    path = os.path.join(tempfile.mkdtemp(), "search.db")
+    database = SqliteDatabase(path)
+
+    with test_database(database, [User, Record, DailySummary]):
+        User.insert_many([{"telegram_id": i, "chat_id": i}
+            for i in range(1, users + 1)]).execute()
+
+        started = time.monotonic()
+        rows = []
+        for row in corpus(words, users, records, rng):
+            rows.append(row)
+            if len(rows) == 10000:
+                Record.insert_batch(rows)
+                rows = []
+        Record.insert_batch(rows)
+        print("Inserted {} records in {:.1f}s".format(
+            records, time.monotonic() - started))
+
+        print("Built index in {:.0f}ms".format(timed(create_index, database)))
+
+        started = time.monotonic()
+        Record.insert_batch(list(corpus(words, users, 10000, rng)))
+        print("Inserted 10000 indexed records in {:.1f}s".format(
+            time.monotonic() - started))
+
+        # Mix of common and rare terms
+        samples = [" ".join(rng.sample(words[:2000], rng.randint(1, 2)))
+            for i in range(queries)]
+        accounts = [User.get(User.id == rng.randint(1, users))
+            for i in range(queries)]
+
+        def scan(user, terms):
+            query = Record.select().where(Record.user == user)
+            for term in terms.split():
+                query = query.where(Record.content.contains(term))
+            list(query.limit(10))
+
+        for name, func in (("search", search), ("scan", scan)):
+            times = [timed(func, u, t) for u, t in zip(accounts, samples)]
+            print("{:>7}: p50 {:8.2f}ms p95 {:8.2f}ms p99 {:8.2f}ms".format(
+                name, percentile(times, 50), percentile(times, 95),
+                percentile(times, 99)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    run(args.records, args.users, args.queries)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Measure how update throughput scales with the number of shards.
+
+For each shard count, one benchmarks/load.py process per shard runs the
+conversations of that shard's users concurrently. Throughput is all updates
+divided by the slowest shard's time. Each shard process uses its own scratch
+SQLite database, so this measures the Python side of handling updates. With
+a shared SQLite file, writes from all shards would wait on its lock.
+
+Usage: python benchmarks/shards.py [--shards 1 2 4] [--users 400]
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+LOAD = os.path.join(os.path.dirname(__file__), "load.py")
+
+
+def run(shards, users, entries, workers, seed=0):
+    """Run all shards of a benchmark at once and return their reports."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        procs = []
+        for index in range(shards):
+            output = os.path.join(tmpdir, "{}.json".format(index))
+            procs.append((output, subprocess.Popen([sys.executable, LOAD,
+                "--users", str(users), "--entries", str(entries),
+                "--workers", str(workers), "--seed", str(seed),
+                "--shard", str(index), str(shards), "--output", output],
+                stdout=subprocess.DEVNULL)))
+
+        rv = []
+        for output, proc in procs:
+            if proc.wait() != 0:
+                raise RuntimeError("Shard benchmark failed with exit code "
+                    "{}".format(proc.returncode))
+            with open(output) as fp:
+                rv.append(json.load(fp))
+        return rv
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def summary(shards, reports):
+    """Return totals of the shard reports of one run."""
+    updates = sum(r["updates"] for r in reports)
+    seconds = max(r["seconds"] for r in reports)
+    return {
+        "shards": shards,
+        "updates": updates,
+        "failed": sum(r["failed"] for r in reports),
+        "seconds": seconds,
+        "throughput": updates / seconds,
+        "per_shard": [r["throughput"] for r in reports]
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=400,
+        help="Users in total, split between the shards")
+    parser.add_argument("--entries", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4,
+        help="Worker threads in each shard")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results as JSON")
+    args = parser.parse_args()
+
+    print("{} CPUs".format(os.cpu_count()))
+    print("{:>6} {:>8} {:>9} {:>10} {:>8} {:>10}".format(
+        "shards", "updates", "seconds", "updates/s", "speedup", "efficiency"))
+
+    results = []
+    for shards in args.shards:
+        results.append(summary(shards, run(shards, args.users, args.entries,
+            args.workers, args.seed)))
+        s = results[-1]
+        speedup = s["throughput"] / results[0]["throughput"] * \
+            results[0]["shards"]
+        print("{shards:>6} {updates:>8} {seconds:>9.2f} {throughput:>10.1f} "
+            "{speedup:>8.2f} {efficiency:>9.0%}".format(
+                speedup=speedup, efficiency=speedup / shards, **s))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""Compare diary write and read throughput of the SQLite profiles.
+
+Usage: python benchmarks/sqlite_profile.py [--writers 4] [--records 500]
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from threading import Thread, Event
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.test_utils import test_database
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from diary_peter.models import User, Record, Job, DailySummary, checkpoint, \
+    connection, sqlite_options  # noqa
+
+
+def run(profile, writers, records):
+    """Return (writes/s, reads/s) for a profile."""
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    database = PooledSqliteDatabase(path, check_same_thread=False,
+        max_connections=writers + 2, **sqlite_options(profile))
+
+    with test_database(database, [User, Record, Job, DailySummary]):
+        with connection(database):
+            users = [User.create(telegram_id=i, chat_id=i)
+                for i in range(writers)]
+
+        done = Event()
+        reads = [0]
+
+        def write(user):
+            for i in range(records):
+                with connection(database):
+                    with database.transaction():
+                        Record.create(user=user, kind="text",
+                            content="Entry {}".format(i))
+
+        def read():
+            while not done.is_set():
+                with connection(database):
+                    list(Record.select().where(
+                        (Record.user == users[0]) &
+                        (Record.created >= datetime.now() - timedelta(hours=24)))
+                        .limit(3))
+                reads[0] += 1
+
+        reader = Thread(target=read)
+        threads = [Thread(target=write, args=(u,)) for u in users]
+
+        started = time.monotonic()
+        reader.start()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - started
+        done.set()
+        reader.join()
+
+        if profile == "production":
+            checkpoint(database, "TRUNCATE")
+
+    return writers * records / elapsed, reads[0] / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--records", type=int, default=500)
+    args = parser.parse_args()
+
+    for profile in ("default", "production"):
+        writes, reads = run(profile, args.writers, args.records)
+        print("{:>10}: {:8.1f} writes/s {:8.1f} reads/s".format(
+            profile, writes, reads))
@@ -19,7 +19,9 @@
 import peewee
 
 from logging import info, INFO, warning, basicConfig
-from diary_peter.models import db, Job, Record, User
+from diary_peter.models import db, DailySummary, Job, Record, User
+from diary_peter.migrations import SchemaVersion, stamp
+from diary_peter.search import create_index
 
 if __name__ == '__main__':
     basicConfig(format='%(levelname)s\t%(message)s', level=INFO)
@@ -27,9 +29,13 @@ if __name__ == '__main__':
     info("Creating database...")
     db.connect()
     try:
-        db.create_tables([Job, Record, User])
+        db.create_tables([DailySummary, Job, Record, User, SchemaVersion])
     except peewee.OperationalError as e:
         warning("Oopsie.")
         warning(e)
     else:
+        create_index()
+
+        # Fresh tables already have everything migrations would add
+        stamp()
         info("Done.")
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Cold storage for old records in compressed monthly segments."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import itertools
+import json
+import logging
+import lzma
+import os
+import re
+
+from datetime import datetime
+
+from diary_peter.models import db, Record
+
+logger = logging.getLogger(__name__)
+
+# Directory holding one subdirectory of segments per user
+ARCHIVE_PATH = os.environ.get("ARCHIVE_PATH", "archive")
+
+# Records older than this many days are archived
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", 90))
+
+INDEX = "index.json"
+
+
+def user_path(user_id, root=None):
+    """Return the directory holding a user's segments."""
+    return os.path.join(root or ARCHIVE_PATH, str(user_id))
+
+
+def read_index(user_id, root=None):
+    """Return a user's segment index.
+
+    The index maps months ("2016-08") to the segment's file name, number of
+    records and first and last entry times.
+    """
+    try:
+        with open(os.path.join(user_path(user_id, root), INDEX)) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def replace_file(path, write, opener=open):
+    """Atomically replace path with a file written by write(fp)."""
+    tmp = path + ".tmp"
+    with opener(tmp, "wt", encoding="utf-8") as fp:
+        write(fp)
+    os.replace(tmp, path)
+
+
+def read_segment(path):
+    """Return the rows of a segment file."""
+    with lzma.open(path, "rt", encoding="utf-8") as fp:
+        rows = [json.loads(line) for line in fp]
+    for row in rows:
+        row["created"] = datetime.strptime(row["created"], "%Y-%m-%dT%H:%M:%S.%f")
+    return rows
+
+
+def write_segment(path, rows):
+    """Write rows to a segment file, replacing it if it exists."""
+    def write(fp):
+        for row in rows:
+            fp.write(json.dumps(dict(row, created=row["created"].strftime(
+                "%Y-%m-%dT%H:%M:%S.%f"))))
+            fp.write("\n")
+    replace_file(path, write, lzma.open)
+
+
+def archive_user(user_id, before, root=None):
+    """Move a user's records created before a datetime into the archive.
+
+    Records are added to the segment of their month, which is rewritten
+    before the records are deleted. If deleting fails, archiving again
+    merges the same records into the segment without duplicating them.
+    Returns the number of archived records.
+    """
+    path = user_path(user_id, root)
+    os.makedirs(path, exist_ok=True)
+    index = read_index(user_id, root)
+
+    records = list(Record.select()
+        .where((Record.user == user_id) & (Record.created < before))
+        .order_by(Record.created, Record.id))
+
+    count = 0
+    for month, recs in itertools.groupby(records,
+            lambda r: r.created.strftime("%Y-%m")):
+        name = month + ".jsonl.xz"
+        rows = {r["id"]: r for r in (read_segment(os.path.join(path, name))
+            if month in index else [])}
+        ids = []
+        for rec in recs:
+            rows[rec.id] = {
+                "id": rec.id,
+                "created": rec.created,
+                "kind": rec.kind,
+                "content": rec.content,
+                "reaction": rec.reaction
+            }
+            ids.append(rec.id)
+
+        rows = sorted(rows.values(), key=lambda r: (r["created"], r["id"]))
+        write_segment(os.path.join(path, name), rows)
+        index[month] = {
+            "file": name,
+            "records": len(rows),
+            "first": rows[0]["created"].isoformat(),
+            "last": rows[-1]["created"].isoformat()
+        }
+        replace_file(os.path.join(path, INDEX),
+            lambda fp: json.dump(index, fp, indent=1, sort_keys=True))
+
+        with db.transaction():
+            Record.delete().where(Record.id << ids).execute()
+        count += len(ids)
+    return count
+
+
+def archive(before, root=None):
+    """Archive the records of all users created before a datetime."""
+    users = [r.user_id for r in Record.select(Record.user)
+        .where(Record.created < before)
+        .distinct()]
+
+    count = 0
+    for user_id in users:
+        n = archive_user(user_id, before, root)
+        logger.info("Archived {} records of user {}".format(n, user_id))
+        count += n
+    return count
+
+
+def archived_records(user, root=None):
+    """Yield a user's archived records, oldest first.
+
+    Only one monthly segment is held in memory at a time.
+    """
+    path = user_path(user.id, root)
+    for month, entry in sorted(read_index(user.id, root).items()):
+        for row in read_segment(os.path.join(path, entry["file"])):
+            yield Record(user=user, **row)
+
+
+def archived_rows(user_ids, root=None):
+    """Yield the archived record rows of some users for summaries.
+
+    Records whose deletion failed after archiving are skipped, they are
+    still counted from the database.
+    """
+    for user_id in user_ids:
+        path = user_path(user_id, root)
+        for month, entry in sorted(read_index(user_id, root).items()):
+            rows = read_segment(os.path.join(path, entry["file"]))
+            live = set(r.id for r in Record.select(Record.id)
+                .where(Record.id << [row["id"] for row in rows]))
+            for row in rows:
+                if row["id"] not in live:
+                    yield dict(row, user=user_id)
+
+
+def words(text):
+    """Return the lowercase words of a text."""
+    return re.findall(r"\w+", (text or "").lower())
+
+
+def search_archive(user, terms, root=None):
+    """Return archived records containing all terms, newest first.
+
+    Terms match words they are a prefix of, e.g. "walk" matches "walked".
+    This reads all of the user's segments and is meant for the rare case
+    of searching beyond the records in the database.
+    """
+    terms = words(terms)
+    rv = []
+    for rec in archived_records(user, root):
+        text = words(rec.content) + words(rec.reaction)
+        if all(any(w.startswith(t) for w in text) for t in terms):
+            rv.append(rec)
+    rv.reverse()
+    return rv
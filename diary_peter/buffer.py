@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Write-behind buffer that group-commits diary records."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import datetime
+import logging
+import time
+
+from concurrent.futures import Future
+from threading import Thread, Condition
+
+from diary_peter.models import connection, Record
+
+logger = logging.getLogger(__name__)
+
+"""The buffer used by coaches, None writes every record directly."""
+record_buffer = None
+
+
+class RecordBuffer(object):
+    """Collect new records and insert them in batches.
+
+    A batch is written once it has `max_rows` records or its oldest record
+    waited `max_delay` seconds, whichever comes first. `add` returns a future
+    that resolves once the record is committed.
+    """
+
+    def __init__(self, max_delay=0.05, max_rows=100):
+        """Init empty buffer."""
+        self.max_delay = max_delay
+        self.max_rows = max_rows
+        self.flushes = 0
+        self.flushed_rows = 0
+
+        self._rows = []
+        self._futures = []
+        self._oldest = None
+        self._cond = Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start flushing in a background thread."""
+        self._running = True
+        self._thread = Thread(target=self._work, name="record-buffer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Flush remaining records and stop the background thread."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def add(self, user, kind, content, reaction=None):
+        """Queue a new record for user and return a future for its commit."""
+        future = Future()
+        row = {
+            "user": user.id,
+            "kind": kind,
+            "content": content,
+            "reaction": reaction,
+            "created": datetime.datetime.now()
+        }
+
+        with self._cond:
+            if not self._rows:
+                self._oldest = time.monotonic()
+            self._rows.append(row)
+            self._futures.append(future)
+
+            # Wake the writer to start the delay timer or flush a full batch
+            if len(self._rows) in (1, self.max_rows):
+                self._cond.notify()
+        return future
+
+    def _take(self):
+        """Wait until a batch is due and return its rows and futures."""
+        with self._cond:
+            while True:
+                if len(self._rows) >= self.max_rows or \
+                        (self._rows and not self._running):
+                    break
+
+                if not self._rows:
+                    if not self._running:
+                        return None, None
+                    self._cond.wait()
+                    continue
+
+                remaining = self._oldest + self.max_delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            rows, futures = self._rows, self._futures
+            self._rows, self._futures = [], []
+            return rows, futures
+
+    def _work(self):
+        """Thread target writing batches."""
+        while True:
+            rows, futures = self._take()
+            if rows is None:
+                break
+
+            try:
+                with connection():
+                    Record.insert_batch(rows)
+            except Exception as e:
+                logger.exception("Failed writing {} records".format(len(rows)))
+                for f in futures:
+                    f.set_exception(e)
+            else:
+                self.flushes += 1
+                self.flushed_rows += len(rows)
+                for f in futures:
+                    f.set_result(True)
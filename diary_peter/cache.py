@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""In-process caches for hot database rows."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """Bounded, thread-safe mapping with least-recently-used eviction.
+
+    Entries older than `ttl` seconds are treated as missing, so rows changed
+    behind the cache's back (e.g. by another process) are eventually reloaded.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        """Init cache with a maximum number of entries and a ttl in seconds."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        """Return number of cached entries, including expired ones."""
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value stored for key or default if missing or expired."""
+        with self._lock:
+            try:
+                stored_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self.ttl and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently used entry."""
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self):
+        """Return unexpired (key, value) pairs, least recently used first."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (stored_at, value)
+                in self._data.items()
+                if not self.ttl or now - stored_at <= self.ttl]
+
+    def invalidate(self, key):
+        """Remove key from the cache if present."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+
+"""Snapshots of `User` rows, keyed by telegram id."""
+user_cache = LRUCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", 10000)),
+    ttl=float(os.environ.get("USER_CACHE_TTL", 300)))
@@ -22,40 +22,44 @@ import peewee as pw
 
 from telegram.emoji import Emoji
 from datetime import datetime, time, timedelta
+from functools import partial
 
-from diary_peter.keyboards import keyboard, inline_keyboard
-from diary_peter.models import User, Job, Record
-from diary_peter.jobs import generic_job
+from diary_peter import buffer
+from diary_peter.keyboards import keyboard, inline_keyboard, hide_keyboard
+from diary_peter.fsm import registry, state
+from diary_peter.models import Job
+from diary_peter.outbox import send_messages
+from diary_peter.sessions import RecordSession
+from diary_peter.jobs import next_run
 
 logger = logging.getLogger(__name__)
 
 
-def select(db, tguser):
-    """Return active coach for a telegram user."""
-    with db.transaction():
-        user, created = User.tg_get_or_create(tguser)
-        if created:
-            logger.info("Created new user {}".format(user))
-        return user.active_coach
-
-
 class Coach(object):
-    """Baseclass for coaches."""
+    """Baseclass for coaches.
+
+    Coaches are stateless, the single instance of each coach is created by
+    `registry.register` and handles the updates of all users.
+    """
 
     NAME = "Coach"
 
-    def __init__(self, bot, db, tguser, job_queue):
-        """Init coach object."""
-        self.bot = bot
-        self.db = db
-        self.tguser = tguser
-        self.job_queue = job_queue
+    @classmethod
+    def state_name(cls, state):
+        """Return the name of a state constant of this coach."""
+        for name, value in vars(cls).items():
+            if name.isupper() and value == state and \
+                    not isinstance(value, bool):
+                return name
+        return str(state)
 
-        with db.transaction():
-            user, created = User.tg_get_or_create(tguser)
-            self.user = user
+    def handle(self, conv, update):
+        """Handle update in the user's current state of this coach."""
+        return registry.dispatch(conv, update,
+            registry.lookup(self.NAME, conv.user.state))
 
 
+@registry.register
 class Menu(Coach):
     """Main menu conversation."""
 
@@ -64,55 +68,75 @@ class Menu(Coach):
     # Possible states for this coach
     START, AWAITING_DIARY_ENTRY = range(2)
 
-    def handle(self, update):
+    @state(START, to=[AWAITING_DIARY_ENTRY])
+    def start(self, conv, update):
         """Main menu shows primary interaction affordances."""
         out = []
 
-        if self.user.state == self.AWAITING_DIARY_ENTRY:
-            if update.message is None:
-                if update.callback_query:
-                    error = "Sweetie, you can't press those buttons anymore."
-                    logging.warning(
-                        "User tried to send callback to main menu handler: '{}'".format(update.callback_query)
-                    )
-                else:
-                    error = "I think you were trying to add something to you diary, but I did not get a message? Please try again for me!"
-                    logging.error("Empty message arrived in main handler that has no callback_query attached.")
-                self.bot.sendMessage(self.tguser.id,
-                    text=error)
-                return
-
-            with self.db.transaction():
-                rec = self.user.create_record("text", update.message.text)
+        # msg = "Just hit me up if you need anything."
+        msg = "Just send me a message whenever you want to add something to today's diary."
+        out.append(conv.bot.sendMessage(conv.tguser.id,
+            text=msg, reply_markup=hide_keyboard))
+
+        # msg2 = "Or send me a message whenever you want to add something to today's diary."
+        # options = {
+        #     "coaches": "Change your coaches",
+        #     "setup": "Edit settings",
+        #     "discover": "Discover more"
+        # }
+        # out.append(conv.bot.sendMessage(conv.tguser.id,
+        #     text=msg2
+        #     reply_markup=inline_keyboard(options)
+        # ))
+
+        conv.move(self.AWAITING_DIARY_ENTRY)
+        with conv.db.transaction():
+            conv.user.save()
+        return out
+
+    @state(AWAITING_DIARY_ENTRY)
+    def diary_entry(self, conv, update):
+        """Add a message to the user's diary."""
+        out = []
+
+        if update.message is None:
+            if update.callback_query:
+                error = "Sweetie, you can't press those buttons anymore."
+                logging.warning(
+                    "User tried to send callback to main menu handler: '{}'".format(update.callback_query)
+                )
+            else:
+                error = "I think you were trying to add something to you diary, but I did not get a message? Please try again for me!"
+                logging.error("Empty message arrived in main handler that has no callback_query attached.")
+            conv.bot.sendMessage(conv.tguser.id,
+                text=error)
+            return
+
+        if buffer.record_buffer is not None:
+            # Acknowledge once the batch containing the entry is written
+            committed = buffer.record_buffer.add(
+                conv.user, "text", update.message.text)
+            committed.add_done_callback(partial(self.acknowledge_entry, conv))
+            out.append(committed)
+        else:
+            with conv.db.transaction():
+                rec = conv.user.create_record("text", update.message.text)
                 rec.save()
 
-            out.append(self.bot.sendMessage(self.tguser.id,
+            out.append(conv.bot.sendMessage(conv.tguser.id,
                 text="Ok, added."))
-
-        elif self.user.state == self.START:
-            # msg = "Just hit me up if you need anything."
-            msg = "Just send me a message whenever you want to add something to today's diary."
-            out.append(self.bot.sendMessage(self.tguser.id,
-                text=msg, reply_markup=telegram.ReplyKeyboardHide()))
-
-            # msg2 = "Or send me a message whenever you want to add something to today's diary."
-            # options = {
-            #     "coaches": "Change your coaches",
-            #     "setup": "Edit settings",
-            #     "discover": "Discover more"
-            # }
-            # out.append(self.bot.sendMessage(self.tguser.id,
-            #     text=msg2
-            #     reply_markup=inline_keyboard(options)
-            # ))
-
-            self.user.active_coach = self.NAME
-            self.user.state = self.AWAITING_DIARY_ENTRY
-            with self.db.transaction():
-                self.user.save()
         return out
 
+    def acknowledge_entry(self, conv, committed):
+        """Tell the user whether their buffered diary entry was saved."""
+        if committed.exception() is None:
+            conv.bot.sendMessage(conv.tguser.id, text="Ok, added.")
+        else:
+            conv.bot.sendMessage(conv.tguser.id,
+                text="Sorry, I could not save that. Please send it again.")
 
+
+@registry.register
 class Setup(Coach):
     """Configuration conversations."""
 
@@ -126,271 +150,252 @@ class Setup(Coach):
         "Gratitude": "Gratitude"
     }
 
-    def handle(self, update):
+    # Constant messages as `sendMessage` keyword arguments, with their
+    # keyboards already encoded
+    INTRO = [{"text": m, "reply_markup": hide_keyboard} for m in [
+        "Hello there!",
+        "I am Diary Peter, and I will increase your awareness of your every day",
+        "Every evening, I will ask you about your day. After some time, you can look back and remember all the nice things.",
+        "I am trying to keep this as anonymous as possible, so I will not store your telegram nickname anywhere. \n\nWhat name may I call you by instead?"
+    ]]
+
+    COACH_DESCRIPTIONS = [{
+        "text": m,
+        "parse_mode": telegram.ParseMode.MARKDOWN,
+        "reply_markup": hide_keyboard
+    } for m in [
+        # "*nutrition*: I will ask you in the morning, afternoon and evening what you ate. Answer with a short description or snap a picture.",
+        # "*weight*: If you’d like I can also record your weight every morning.",
+        "*gratitude*: Every evening I will ask you to tell me three things that you were grateful for today. A study has shown that being mindful of the small good things in this way increases happiness for a long time!",
+        # "*sleep*: Would you like to sleep more regularly? I can give you a heads-up in time and then remind you to hit the sheets. In the morning I will ask you for how long you actually slept so you can see how your rest time improves after a while.",
+        # "*dream*: Additionally, I can ask you to tell me your dreams and keep these memories for you. Recording dreams this way will make you remember them more often and more clearly.",
+        # "*reading*: Do you like to read? Or would you? Write down what you read, what was interesting and gather a collection of insights and inspirations."
+    ]] + [{
+        "text": "Click the name of a a coach below to add it now.",
+        "reply_markup": inline_keyboard(dict(AVAILABLE_COACHES,
+            **{"continue": "Continue to main menu"}))
+    }]
+
+    @state(START, to=[AWAITING_NAME])
+    def start(self, conv, update):
         """Setup a user account by asking some basic questions."""
-        out = []
+        out = send_messages(conv.bot,
+            [(conv.tguser.id, kwargs) for kwargs in self.INTRO])
 
-        with self.db.transaction():
-            self.user.active_coach = self.NAME
-            self.user.save()
-
-        if self.user.state == self.START:
-            messages = [
-                "Hello there!",
-                "I am Diary Peter, and I will increase your awareness of your every day",
-                "Every evening, I will ask you about your day. After some time, you can look back and remember all the nice things.",
-                "I am trying to keep this as anonymous as possible, so I will not store your telegram nickname anywhere. \n\nWhat name may I call you by instead?"
-            ]
-
-            for m in messages:
-                out.append(self.bot.sendMessage(self.tguser.id, text=m,
-                    reply_markup=telegram.ReplyKeyboardHide()))
-
-            with self.db.transaction():
-                self.user.state = self.AWAITING_NAME
-                self.user.save()
-
-        elif self.user.state == self.AWAITING_NAME:
-            name = update.message.text
-            out.append(self.bot.sendMessage(self.tguser.id,
-                text="Sweet, {}! Now just a quick question to get an idea of your daily rhythm: *When do you usually get up?* \n\nYou can always change this later by typing */start*".format(name),
-                reply_markup=keyboard('morning_hours'),
-                parse_mode=telegram.ParseMode.MARKDOWN))
-
-            with self.db.transaction():
-                self.user.name = name
-                self.user.state = self.AWAITING_WAKE_TIME
-                self.user.save()
-
-        elif self.user.state == self.AWAITING_WAKE_TIME:
-            wake_time_resp = update.message.text
-            try:
-                wake_time = time(hour=int(wake_time_resp[:-2]))
-            except ValueError:
-                msg = "Please enter a wake time such as '9am'."
-                out.append(self.bot.sendMessage(self.tguser.id,
-                text=msg, reply_markup=keyboard('morning_hours')))
-            else:
-                if wake_time_resp[-2:] == "pm":
-                    wake_time = wake_time + timedelta(hours=12)
+        conv.move(self.AWAITING_NAME)
+        with conv.db.transaction():
+            conv.user.save()
+        return out
 
-                msg = "Ok, {}. I have a number of coaching ideas that can assist you with more specific goals like becoming conscious of your nutrition, sleep&dreams or reading habits. Are you interested in the selection?".format(wake_time_resp)
-                out.append(self.bot.sendMessage(self.tguser.id,
-                    text=msg, reply_markup=keyboard('thumbs')))
+    @state(AWAITING_NAME, to=[AWAITING_WAKE_TIME])
+    def name(self, conv, update):
+        """Store the user's name and ask for their wake time."""
+        name = update.message.text
+        out = [conv.bot.sendMessage(conv.tguser.id,
+            text="Sweet, {}! Now just a quick question to get an idea of your daily rhythm: *When do you usually get up?* \n\nYou can always change this later by typing */start*".format(name),
+            reply_markup=keyboard('morning_hours'),
+            parse_mode=telegram.ParseMode.MARKDOWN)]
+
+        conv.user.name = name
+        conv.move(self.AWAITING_WAKE_TIME)
+        with conv.db.transaction():
+            conv.user.save()
+        return out
 
-                with self.db.transaction():
-                    self.user.wake_time = wake_time
-                    self.user.state = self.AWAITING_SELECTION_CONFIRMATION
-                    self.user.save()
+    @state(AWAITING_WAKE_TIME, to=[AWAITING_SELECTION_CONFIRMATION])
+    def wake_time(self, conv, update):
+        """Store the user's wake time and offer more coaches."""
+        out = []
+        wake_time_resp = update.message.text
+        try:
+            wake_time = time(hour=int(wake_time_resp[:-2]))
+        except ValueError:
+            msg = "Please enter a wake time such as '9am'."
+            out.append(conv.bot.sendMessage(conv.tguser.id,
+            text=msg, reply_markup=keyboard('morning_hours')))
+        else:
+            if wake_time_resp[-2:] == "pm":
+                wake_time = wake_time + timedelta(hours=12)
+
+            msg = "Ok, {}. I have a number of coaching ideas that can assist you with more specific goals like becoming conscious of your nutrition, sleep&dreams or reading habits. Are you interested in the selection?".format(wake_time_resp)
+            out.append(conv.bot.sendMessage(conv.tguser.id,
+                text=msg, reply_markup=keyboard('thumbs')))
+
+            conv.user.wake_time = wake_time
+            conv.move(self.AWAITING_SELECTION_CONFIRMATION)
+            with conv.db.transaction():
+                conv.user.save()
+        return out
 
-        elif self.user.state in(self.AWAITING_SELECTION_CONFIRMATION, self.AWAITING_COACH_SELECTION):
-            out.append(self.handle_coach_selection(update))
+    @state(AWAITING_SELECTION_CONFIRMATION,
+        to=[AWAITING_COACH_SELECTION, (Menu.NAME, Menu.START)])
+    def selection_confirmation(self, conv, update):
+        """Show available coaches or continue to the main menu."""
+        out = []
 
+        if update.message.text == Emoji.THUMBS_UP_SIGN:
+            out.extend(send_messages(conv.bot, [(conv.tguser.id, kwargs)
+                for kwargs in self.COACH_DESCRIPTIONS]))
+
+            conv.move(self.AWAITING_COACH_SELECTION)
+            with conv.db.transaction():
+                conv.user.save()
+        else:
+            out.append(conv.bot.sendMessage(conv.tguser.id,
+                parse_mode=telegram.ParseMode.MARKDOWN,
+                text="You can always change your selection later by typing */start*."))
+            out.extend(self.finish(conv, update))
         return out
 
-    def handle_coach_selection(self, update):
-        """Handle selection of coaches.
-
-        This method is called from the `handle` method.
-        """
+    @state(AWAITING_COACH_SELECTION, to=[(Menu.NAME, Menu.START)])
+    def coach_selection(self, conv, update):
+        """Add the coach selected with an inline button."""
         out = []
 
-        if self.user.state == self.AWAITING_SELECTION_CONFIRMATION:
-            if update.message.text == Emoji.THUMBS_UP_SIGN:
-                msgs = [
-                    # "*nutrition*: I will ask you in the morning, afternoon and evening what you ate. Answer with a short description or snap a picture.",
-                    # "*weight*: If you’d like I can also record your weight every morning.",
-                    "*gratitude*: Every evening I will ask you to tell me three things that you were grateful for today. A study has shown that being mindful of the small good things in this way increases happiness for a long time!",
-                    # "*sleep*: Would you like to sleep more regularly? I can give you a heads-up in time and then remind you to hit the sheets. In the morning I will ask you for how long you actually slept so you can see how your rest time improves after a while.",
-                    # "*dream*: Additionally, I can ask you to tell me your dreams and keep these memories for you. Recording dreams this way will make you remember them more often and more clearly.",
-                    # "*reading*: Do you like to read? Or would you? Write down what you read, what was interesting and gather a collection of insights and inspirations."
-                ]
-
-                out.append([self.bot.sendMessage(self.tguser.id,
-                    text=m,
-                    parse_mode=telegram.ParseMode.MARKDOWN,
-                    reply_markup=telegram.ReplyKeyboardHide()) for m in msgs])
-
-                kb = self.AVAILABLE_COACHES.copy()
-                kb['continue'] = "Continue to main menu"
-
-                out.append(self.bot.sendMessage(self.tguser.id,
-                    text="Click the name of a a coach below to add it now.",
-                    reply_markup=inline_keyboard(kb)))
-
-                with self.db.transaction():
-                    self.user.state = self.AWAITING_COACH_SELECTION
-                    self.user.save()
-            else:
-                out.append(self.bot.sendMessage(self.tguser.id,
-                    parse_mode=telegram.ParseMode.MARKDOWN,
-                    text="You can always change your selection later by typing */start*."))
-
-                with self.db.transaction():
-                    self.user.intro_seen = True
-                    self.user.coach = "Menu"
-                    self.user.state = Menu.START
-                    self.user.save()
-
-                menu = Menu(self.bot, self.db, self.tguser, self.job_queue)
-                out.append(menu.handle(update))
-
-        elif self.user.state == self.AWAITING_COACH_SELECTION:
-            query = update.callback_query
-            if not query:
-                out.append(self.bot.sendMessage(self.tguser.id,
-                    text="Please use the bottons above to select coaches to add or click continue to return to the main menu."))
-                return out
-
-            coach_name = query.data
-
-            if coach_name == "continue":
-                self.bot.answerCallbackQuery(query.id)
-                out.append(self.bot.sendMessage(query.message.chat_id,
-                    parse_mode=telegram.ParseMode.MARKDOWN,
-                    text="You can redo this setup later by typing */start*."))
-
-                with self.db.transaction():
-                    self.user.intro_seen = True
-                    self.user.coach = "Menu"
-                    self.user.state = Menu.START
-                    self.user.save()
-
-                menu = Menu(self.bot, self.db, self.tguser, self.job_queue)
-                out.append(menu.handle(update))
-
-            elif coach_name in self.AVAILABLE_COACHES:
-                self.bot.answerCallbackQuery(query.id, text="Loading {} coach".format(coach_name))
-
-                try:
-                    Job.get(coach=coach_name, user=self.user)
-                except pw.DoesNotExist:
-                    out.append(self.bot.sendMessage(query.message.chat_id,
-                        text="Now adding the {} coach.".format(coach_name)))
-                    coach_cls = globals()[coach_name]
-                    coach_cls.setup(self)
-                    out.append(self.bot.sendMessage(query.message.chat_id,
-                        text="Add another coach or click 'continue' above to finish."))
-                else:
-                    out.append(self.bot.sendMessage(query.message.chat_id,
-                        text="You have already added the {} coach {}".format(coach_name, Emoji.EYES)))
+        query = update.callback_query
+        if not query:
+            out.append(conv.bot.sendMessage(conv.tguser.id,
+                text="Please use the bottons above to select coaches to add or click continue to return to the main menu."))
+            return out
+
+        coach_name = query.data
+
+        if coach_name == "continue":
+            conv.bot.answerCallbackQuery(query.id)
+            out.append(conv.bot.sendMessage(query.message.chat_id,
+                parse_mode=telegram.ParseMode.MARKDOWN,
+                text="You can redo this setup later by typing */start*."))
+            out.extend(self.finish(conv, update))
+
+        elif coach_name in self.AVAILABLE_COACHES:
+            conv.bot.answerCallbackQuery(query.id, text="Loading {} coach".format(coach_name))
+
+            try:
+                Job.get(coach=coach_name, user=conv.user)
+            except pw.DoesNotExist:
+                out.append(conv.bot.sendMessage(query.message.chat_id,
+                    text="Now adding the {} coach.".format(coach_name)))
+                registry.coach(coach_name).setup(conv)
+                out.append(conv.bot.sendMessage(query.message.chat_id,
+                    text="Add another coach or click 'continue' above to finish."))
             else:
-                out.append(self.bot.sendMessage(query.message.chat_id,
-                    text="That is not a coach here."))
+                out.append(conv.bot.sendMessage(query.message.chat_id,
+                    text="You have already added the {} coach {}".format(coach_name, Emoji.EYES)))
+        else:
+            out.append(conv.bot.sendMessage(query.message.chat_id,
+                text="That is not a coach here."))
         return out
 
+    def finish(self, conv, update):
+        """Mark the intro as seen and continue in the main menu."""
+        conv.user.intro_seen = True
+        conv.move(Menu.START, Menu.NAME)
+        with conv.db.transaction():
+            conv.user.save()
+
+        return registry.dispatch(conv, update)
 
+
+@registry.register
 class Gratitude(Coach):
     """Coach that teaches users to become grateful for the small things."""
 
     NAME = "Gratitude"
     MAIN, AWAITING_GRATITUDE, AWAITING_REASONS = range(3)
 
-    collector = []
-
-    def __init__(self, bot, db, tguser, job_queue):
-        """Init and load collected items from past 24hours."""
-        super().__init__(bot, db, tguser, job_queue)
+    # Number of good things collected per session
+    SESSION_SIZE = 3
 
-        self.collector = list(self.user.records.select().where(
-            Record.created >= datetime.now() - timedelta(hours=24)))
+    def collector(self, conv):
+        """Return gratitudes collected from the user in the past 24 hours."""
+        return RecordSession(conv.user, self.NAME, self.SESSION_SIZE)
 
-    @staticmethod
-    def setup(setup_coach):
-        """Setup this coach."""
+    def setup(self, conv):
+        """Schedule this coach for the user of a conversation."""
         scheduled_dt = datetime.combine(
-            datetime.today(), setup_coach.user.wake_time) - timedelta(hours=10)
-        scheduled_remaining = scheduled_dt - datetime.now() - timedelta(hours=6)
-
-        scheduled_remaining = timedelta(seconds=10)
-
-        if scheduled_remaining < timedelta(days=1):
-            scheduled_remaining = scheduled_remaining + timedelta(days=1)
+            datetime.today(), conv.user.wake_time) - timedelta(hours=10)
 
         job, created = Job.get_or_create(
-            coach=Gratitude.NAME,
-            user=setup_coach.user,
-            state=Gratitude.AWAITING_GRATITUDE,
+            coach=self.NAME,
+            user=conv.user,
+            state=self.AWAITING_GRATITUDE,
             scheduled_at=datetime.time(scheduled_dt),
-            text="Hey {}, how was your day? Describe something that happened today that you are grateful for {}".format(setup_coach.user.name, Emoji.RELIEVED_FACE)
+            text="Hey {}, how was your day? Describe something that happened today that you are grateful for {}".format(conv.user.name, Emoji.RELIEVED_FACE)
         )
-        with setup_coach.db.transaction():
+        job.next_run_at = next_run(job.scheduled_at)
+        with conv.db.transaction():
             job.save()
 
-        def jobfunc(bot):
-            return generic_job(bot, job.id)
-
-        interval = 24 * 60 * 60
-        setup_coach.job_queue.put(jobfunc, interval,
-            next_t=scheduled_remaining.seconds)
-
-        logger.info("Saved {} and scheduled first run in {}".format(job, scheduled_remaining))
-        setup_coach.bot.sendMessage(setup_coach.user.telegram_id,
+        logger.info("Saved {} and scheduled first run at {}".format(job, job.next_run_at))
+        conv.bot.sendMessage(conv.user.telegram_id,
             text="Good choice! I will ask you every day at {time} to tell me three things you were grateful for in that day.".format(
                 time=scheduled_dt.strftime("%-I %p")))
 
-    def handle(self, update):
-        """Handle updates from user."""
-        n_things = len(self.collector)
-        n_reasons = len([r for r in self.collector if r.reaction is not None])
+    @state(AWAITING_GRATITUDE, to=[AWAITING_REASONS])
+    def gratitude(self, conv, update):
+        """Collect three good things."""
+        collector = self.collector(conv)
+        n_things = len(collector)
+
+        if n_things == 0:
+            collector.add(update.message.text)
+            conv.bot.sendMessage(conv.tguser.id,
+                text="Ok. Think of a second thing that happened and describe it.!")
+
+        elif n_things == 1:
+            collector.add(update.message.text)
+            conv.bot.sendMessage(conv.tguser.id,
+                text="One more ")
+
+        elif n_things == 2:
+            collector.add(update.message.text)
+            conv.bot.sendMessage(conv.tguser.id,
+                parse_mode=telegram.ParseMode.MARKDOWN,
+                text="Nice! {} Now, about that first one:\n\n_{}_\n\n".format(
+                    Emoji.GRINNING_FACE, collector[0].content))
+            conv.bot.sendMessage(conv.tguser.id,
+                text="Can you tell me, what you think why this particular good thing happened to you?")
+
+            conv.move(self.AWAITING_REASONS)
+            with conv.db.transaction():
+                conv.user.save()
+
+        collector.save()
+
+    @state(AWAITING_REASONS, to=[(Menu.NAME, Menu.START)])
+    def reasons(self, conv, update):
+        """Collect why each of the good things happened."""
+        collector = self.collector(conv)
+        n_reasons = len([r for r in collector if r.reaction is not None])
         start_menu = False
 
-        if self.user.state == self.AWAITING_GRATITUDE:
-            if n_things == 0:
-                self.collector.append(
-                    self.user.create_record(self.NAME, update.message.text))
-                self.bot.sendMessage(self.tguser.id,
-                    text="Ok. Think of a second thing that happened and describe it.!")
-
-            elif n_things == 1:
-                self.collector.append(
-                    self.user.create_record(self.NAME, update.message.text))
-                self.bot.sendMessage(self.tguser.id,
-                    text="One more ")
-
-            elif n_things == 2:
-                self.collector.append(
-                    self.user.create_record(self.NAME, update.message.text))
-                self.bot.sendMessage(self.tguser.id,
-                    parse_mode=telegram.ParseMode.MARKDOWN,
-                    text="Nice! {} Now, about that first one:\n\n_{}_\n\n".format(
-                        Emoji.GRINNING_FACE, self.collector[0].content))
-                self.bot.sendMessage(self.tguser.id,
-                    text="Can you tell me, what you think why this particular good thing happened to you?")
-
-                self.user.state = self.AWAITING_REASONS
-                with self.db.transaction():
-                    self.user.save()
-
-        elif self.user.state == self.AWAITING_REASONS:
-            if n_reasons == 0:
-                self.collector[n_reasons].reaction = update.message.text
-                self.bot.sendMessage(self.tguser.id,
-                    parse_mode=telegram.ParseMode.MARKDOWN,
-                    text="The second thing, why did that happen?\n\n_{}_".format(
-                        self.collector[n_reasons + 1].content))
-            elif n_reasons == 1:
-                self.collector[n_reasons].reaction = update.message.text
-                self.bot.sendMessage(self.tguser.id,
-                    parse_mode=telegram.ParseMode.MARKDOWN,
-                    text="And the third, how did that get to happen to you?\n\n_{}_".format(
-                        self.collector[n_reasons + 1].content))
-            elif n_reasons == 2:
-                self.collector[n_reasons].reaction = update.message.text
-                self.bot.sendMessage(self.tguser.id,
-                    text="Good. I'll be back tomorrow. {}".format(Emoji.RELIEVED_FACE))
-
-                start_menu = True
-
-        with self.db.transaction():
-            for r in self.collector:
-                r.save()
+        if n_reasons == 0:
+            collector[n_reasons].reaction = update.message.text
+            conv.bot.sendMessage(conv.tguser.id,
+                parse_mode=telegram.ParseMode.MARKDOWN,
+                text="The second thing, why did that happen?\n\n_{}_".format(
+                    collector[n_reasons + 1].content))
+        elif n_reasons == 1:
+            collector[n_reasons].reaction = update.message.text
+            conv.bot.sendMessage(conv.tguser.id,
+                parse_mode=telegram.ParseMode.MARKDOWN,
+                text="And the third, how did that get to happen to you?\n\n_{}_".format(
+                    collector[n_reasons + 1].content))
+        elif n_reasons == 2:
+            collector[n_reasons].reaction = update.message.text
+            conv.bot.sendMessage(conv.tguser.id,
+                text="Good. I'll be back tomorrow. {}".format(Emoji.RELIEVED_FACE))
+
+            start_menu = True
+
+        collector.save()
 
         if start_menu:
-            self.user.active_coach = Menu.NAME
-            self.user.state = Menu.START
-            with self.db.transaction():
-                self.user.save()
+            conv.move(Menu.START, Menu.NAME)
+            with conv.db.transaction():
+                conv.user.save()
+
+            return registry.dispatch(conv, update)
+
 
-            menu = Menu(self.bot, self.db, self.tguser, self.job_queue)
-            menu.handle(update)
+registry.validate()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Drop Telegram updates that were already delivered.
+
+Polling restarts and webhook retries can deliver the same update twice. The
+ids of recently seen updates are kept in a fixed size ring buffer with a set
+for lookups, and appended to a journal file so they survive restarts.
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import os
+
+from array import array
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Number of update ids remembered
+DEDUP_SIZE = int(os.environ.get("DEDUP_SIZE", 10000))
+
+# Journal of seen update ids, empty to only remember them in memory
+DEDUP_PATH = os.environ.get("DEDUP_PATH", "seen_updates.bin")
+
+
+class SeenUpdates(object):
+    """Bounded set of the most recently seen update ids.
+
+    Ids are journaled as 8 byte integers. The journal is rewritten with only
+    the remembered ids once it holds twice as many.
+    """
+
+    def __init__(self, size=DEDUP_SIZE, path=None):
+        """Init set remembering size ids, loading them from path if given."""
+        self.size = size
+        self.path = path
+        self.duplicates = 0
+
+        self._ring = array("q", bytes(8 * size))
+        self._seen = set()
+        self._next = 0
+        self._count = 0
+        self._journaled = 0
+        self._fp = None
+        self._lock = Lock()
+
+        if path is not None:
+            for update_id in self._read():
+                self._remember(update_id)
+            self._compact()
+
+    def __contains__(self, update_id):
+        """Return whether update_id is remembered."""
+        return update_id in self._seen
+
+    def __len__(self):
+        """Return the number of remembered ids."""
+        return self._count
+
+    def ids(self):
+        """Return the remembered ids, oldest first."""
+        if self._count < self.size:
+            return self._ring[:self._count].tolist()
+        return (self._ring[self._next:] + self._ring[:self._next]).tolist()
+
+    def add(self, update_id):
+        """Remember update_id and return False if it was already seen."""
+        with self._lock:
+            if update_id in self._seen:
+                self.duplicates += 1
+                return False
+
+            self._remember(update_id)
+            if self._fp is not None:
+                self._fp.write(array("q", [update_id]).tobytes())
+                self._fp.flush()
+                self._journaled += 1
+                if self._journaled >= 2 * self.size:
+                    self._compact()
+        return True
+
+    def close(self):
+        """Close the journal."""
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+    def _remember(self, update_id):
+        if self._count == self.size:
+            self._seen.discard(self._ring[self._next])
+        else:
+            self._count += 1
+        self._ring[self._next] = update_id
+        self._seen.add(update_id)
+        self._next = (self._next + 1) % self.size
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return []
+
+        # Ignore a partly written id at the end
+        rv = array("q")
+        rv.frombytes(data[:len(data) - len(data) % 8])
+        logger.info("Loaded {} seen update ids from {}".format(
+            min(len(rv), self.size), self.path))
+        return rv[-self.size:]
+
+    def _compact(self):
+        if self._fp is not None:
+            self._fp.close()
+
+        ids = array("q", self.ids())
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as fp:
+            ids.tofile(fp)
+        os.replace(tmp, self.path)
+
+        self._fp = open(self.path, "ab")
+        self._journaled = len(ids)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""Dispatch updates onto worker threads, keeping each user's updates in order."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import heapq
+import itertools
+import logging
+import time
+
+from collections import deque
+from queue import Queue, Full
+from threading import Thread, Lock, Condition
+
+logger = logging.getLogger(__name__)
+
+# Priority classes for `PriorityWorkerPool`, lower values are served first
+HIGH, NORMAL, LOW = range(3)
+
+
+class WorkerStats(object):
+    """Counters for a single worker queue."""
+
+    def __init__(self):
+        """Init empty counters."""
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+        self.run_max = 0.0
+
+    def as_dict(self, depth):
+        """Return counters and average latencies as a dictionary."""
+        n = self.processed or 1
+        return {
+            "depth": depth,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / n,
+            "wait_max": self.wait_max,
+            "run_avg": self.run_total / n,
+            "run_max": self.run_max
+        }
+
+
+class OrderedWorkerPool(object):
+    """Run tasks on a fixed number of worker threads.
+
+    Tasks are assigned to a worker by hashing their key, so all tasks with the
+    same key (e.g. a telegram id) run strictly in the order they were
+    submitted while tasks with different keys run in parallel.
+    """
+
+    def __init__(self, workers=4, queue_size=100, max_latency=None,
+            put_timeout=None, name="worker"):
+        """Init pool.
+
+        Parameters:
+            workers: Number of worker threads and queues
+            queue_size: Maximum number of waiting tasks per worker, 0 is
+                unbounded
+            max_latency: Log a warning if a task waited longer than this many
+                seconds before it ran
+            put_timeout: Seconds `submit` blocks on a full queue before
+                rejecting the task, None blocks until there is room
+            name: Prefix for worker thread names
+        """
+        self.workers = workers
+        self.max_latency = max_latency
+        self.put_timeout = put_timeout
+        self.name = name
+
+        self.queues = [Queue(maxsize=queue_size) for i in range(workers)]
+        self.stats = [WorkerStats() for i in range(workers)]
+        self._threads = []
+        self._lock = Lock()
+
+    def start(self):
+        """Start worker threads."""
+        for i, q in enumerate(self.queues):
+            thr = Thread(target=self._work, args=(i,),
+                name="{}-{}".format(self.name, i))
+            thr.daemon = True
+            thr.start()
+            self._threads.append(thr)
+        logger.info("Started {} {} threads".format(self.workers, self.name))
+
+    def stop(self, timeout=None):
+        """Process tasks that are already queued, then stop workers."""
+        for q in self.queues:
+            q.put(None)
+        for thr in self._threads:
+            thr.join(timeout)
+        self._threads = []
+
+    def index(self, key):
+        """Return index of the worker responsible for key."""
+        return hash(key) % self.workers
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) on the worker responsible for key.
+
+        Returns False if the task was rejected because the queue is full.
+        """
+        i = self.index(key)
+        try:
+            self.queues[i].put((time.monotonic(), func, args, kwargs),
+                timeout=self.put_timeout)
+        except Full:
+            with self._lock:
+                self.stats[i].rejected += 1
+            logger.warning("Queue of {}-{} full, rejected task for {}".format(
+                self.name, i, key))
+            return False
+        return True
+
+    def depth(self):
+        """Return the total number of waiting tasks."""
+        return sum(q.qsize() for q in self.queues)
+
+    def get_stats(self):
+        """Return a list with queue depth and latency counters per worker."""
+        with self._lock:
+            return [s.as_dict(q.qsize())
+                for s, q in zip(self.stats, self.queues)]
+
+    def _work(self, i):
+        """Thread target processing queue i until a None task arrives."""
+        q = self.queues[i]
+        stats = self.stats[i]
+
+        while True:
+            task = q.get()
+            if task is None:
+                break
+
+            queued_at, func, args, kwargs = task[:4]
+            started = time.monotonic()
+            wait = started - queued_at
+            if self.max_latency is not None and wait > self.max_latency:
+                logger.warning("Task waited {:.3f}s in {}-{} ({} queued)".format(
+                    wait, self.name, i, q.qsize()))
+
+            failed = False
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                failed = True
+                logger.exception("Uncaught error in {}-{}".format(self.name, i))
+
+            run = time.monotonic() - started
+            with self._lock:
+                stats.processed += 1
+                stats.failed += failed
+                stats.wait_total += wait
+                stats.wait_max = max(stats.wait_max, wait)
+                stats.run_total += run
+                stats.run_max = max(stats.run_max, run)
+
+
+class LaneQueue(object):
+    """Bounded queue that serves keys by priority but each key in order.
+
+    Items of the same key wait in one lane. Of all lanes, the one whose next
+    item has the highest priority is served first. When the queue is full, a
+    new item replaces the lowest priority item that is waiting behind the
+    others of its key, if that one's priority is lower.
+
+    Only one thread may consume the queue, which keeps the order per key.
+    """
+
+    def __init__(self, maxsize=0):
+        """Init queue holding up to maxsize items, 0 is unbounded."""
+        self.maxsize = maxsize
+        self._lanes = {}
+        self._ready = []
+        self._seq = itertools.count()
+        self._size = 0
+        self._cond = Condition()
+
+    def qsize(self):
+        """Return the number of waiting items."""
+        return self._size
+
+    def put(self, item, key=None, priority=None):
+        """Queue item and return the item that was shed to make room.
+
+        Returns None if nothing was shed, or item itself if the queue is full
+        of items at least as important. A priority of None queues item after
+        all others and never sheds, e.g. to stop the consumer.
+        """
+        with self._cond:
+            shed = None
+            if priority is not None and self.maxsize and \
+                    self._size >= self.maxsize:
+                shed = self._evict(priority)
+                if shed is None:
+                    return item
+
+            if priority is None:
+                key, priority = object(), float("inf")
+
+            lane = self._lanes.get(key)
+            if lane is None:
+                seq = next(self._seq)
+                lane = self._lanes[key] = [seq, deque()]
+                heapq.heappush(self._ready, (priority, seq, key))
+            lane[1].append((priority, item))
+            self._size += 1
+            self._cond.notify()
+            return shed
+
+    def get(self):
+        """Remove and return the next item, waiting for one if necessary."""
+        with self._cond:
+            while True:
+                while not self._ready:
+                    self._cond.wait()
+                priority, seq, key = heapq.heappop(self._ready)
+                lane = self._lanes.get(key)
+                # Lanes emptied by `_evict` leave their entries behind
+                if lane is not None and lane[0] == seq:
+                    break
+
+            items = lane[1]
+            priority, item = items.popleft()
+            self._size -= 1
+            if items:
+                lane[0] = next(self._seq)
+                heapq.heappush(self._ready, (items[0][0], lane[0], key))
+            else:
+                del self._lanes[key]
+            return item
+
+    def _evict(self, priority):
+        """Remove and return the last item of the least important lane.
+
+        Only items with a lower priority than priority are considered.
+        """
+        victim = None
+        for key, (seq, items) in self._lanes.items():
+            last = items[-1][0]
+            if last > priority and last != float("inf") and \
+                    (victim is None or last >= victim[0]):
+                victim = (last, key)
+        if victim is None:
+            return None
+
+        items = self._lanes[victim[1]][1]
+        shed = items.pop()[1]
+        self._size -= 1
+        if not items:
+            del self._lanes[victim[1]]
+        return shed
+
+
+class PriorityWorkerPool(OrderedWorkerPool):
+    """Ordered worker pool with bounded queues that shed unimportant work.
+
+    Tasks are submitted with a priority class. Within a worker, keys whose
+    next task is more important run first, while the tasks of each key still
+    run in submission order. Instead of blocking when a worker's queue is
+    full, the least important waiting task is shed and its `on_shed`
+    callback is called.
+    """
+
+    def __init__(self, workers=4, queue_size=100, max_latency=None,
+            name="worker"):
+        """Init pool, see `OrderedWorkerPool`."""
+        super().__init__(workers, 0, max_latency, None, name)
+        self.queues = [LaneQueue(queue_size) for i in range(workers)]
+        self.shed = [0] * (LOW + 1)
+
+    def submit(self, key, func, *args, priority=NORMAL, on_shed=None,
+            **kwargs):
+        """Queue func(*args, **kwargs) on the worker responsible for key.
+
+        Returns False if this task was shed. If any task is shed, its
+        `on_shed` callback is called without arguments.
+        """
+        i = self.index(key)
+        task = (time.monotonic(), func, args, kwargs, priority, on_shed)
+        shed = self.queues[i].put(task, key, priority)
+        if shed is None:
+            return True
+
+        with self._lock:
+            self.stats[i].rejected += 1
+            self.shed[shed[4]] += 1
+        logger.warning("Queue of {}-{} full, shed a task of priority {}".format(
+            self.name, i, shed[4]))
+        if shed[5] is not None:
+            try:
+                shed[5]()
+            except Exception:
+                logger.exception("Failed notifying about shed task")
+        return shed is not task
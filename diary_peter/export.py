@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Export a user's diary as JSON lines, CSV or Markdown."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import json
+
+from diary_peter.archive import archived_records
+from diary_peter.models import Record
+
+FIELDS = ("id", "created", "kind", "content", "reaction")
+
+
+def iter_records(user, batch_size=500):
+    """Yield all records of user, oldest first.
+
+    Archived records come first. Records are then fetched in batches using
+    keyset pagination on (created, id), so only one batch is held in memory
+    at a time.
+    """
+    for rec in archived_records(user):
+        yield rec
+
+    last = None
+    while True:
+        query = Record.select().where(Record.user == user)
+        if last is not None:
+            query = query.where(
+                (Record.created > last.created) |
+                ((Record.created == last.created) & (Record.id > last.id)))
+        batch = list(query
+            .order_by(Record.created, Record.id)
+            .limit(batch_size))
+
+        for rec in batch:
+            yield rec
+
+        if len(batch) < batch_size:
+            break
+        last = batch[-1]
+
+
+def as_dict(rec):
+    """Return the exported fields of a record."""
+    return {
+        "id": rec.id,
+        "created": rec.created.isoformat(),
+        "kind": rec.kind,
+        "content": rec.content,
+        "reaction": rec.reaction
+    }
+
+
+def write_jsonl(records, fp):
+    """Write one JSON object per record."""
+    for rec in records:
+        fp.write(json.dumps(as_dict(rec)))
+        fp.write("\n")
+
+
+def write_csv(records, fp):
+    """Write records as CSV with a header row."""
+    writer = csv.DictWriter(fp, FIELDS)
+    writer.writeheader()
+    for rec in records:
+        writer.writerow(as_dict(rec))
+
+
+def write_markdown(records, fp):
+    """Write records as a Markdown document with one section per day."""
+    day = None
+    for rec in records:
+        if rec.created.date() != day:
+            if day is not None:
+                fp.write("\n")
+            day = rec.created.date()
+            fp.write("## {}\n\n".format(day.strftime("%A, %B %d, %Y")))
+
+        fp.write("- {} {}\n".format(rec.created.strftime("%H:%M"), rec.content))
+        if rec.reaction:
+            fp.write("  > {}\n".format(rec.reaction))
+
+
+FORMATS = {
+    "jsonl": write_jsonl,
+    "csv": write_csv,
+    "md": write_markdown
+}
+
+
+def export(user, fp, fmt="md", batch_size=500):
+    """Write the diary of user to the text file fp in the given format."""
+    try:
+        writer = FORMATS[fmt]
+    except KeyError:
+        raise ValueError("Unknown export format {}".format(fmt))
+    writer(iter_records(user, batch_size), fp)
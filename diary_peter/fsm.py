@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""State machine routing updates to coach handlers.
+
+Coaches declare their states with the `state` decorator and are added to the
+`registry` when their module is imported. Routing an update is then a single
+dictionary lookup on the user's `(active_coach, state)` pair. Coach instances
+keep no per-user data, everything about the current update is passed in a
+`Conversation`.
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+
+from diary_peter.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownState(LookupError):
+    """No handler is registered for a coach and state."""
+
+
+class InvalidTransition(Exception):
+    """A handler moved a user to a state it did not declare."""
+
+
+def state(*states, to=()):
+    """Decorate a coach method as the handler of states.
+
+    Parameters:
+        states: State constants handled by the method
+        to: States the handler may move users to. Either state constants of
+            the same coach or (coach name, state) pairs. Staying in the
+            handled state is always allowed.
+    """
+    def decorator(func):
+        func.fsm_states = states
+        func.fsm_targets = to
+        return func
+    return decorator
+
+
+class Handler(object):
+    """Registered handler for one state of a coach."""
+
+    __slots__ = ("coach", "state", "name", "func", "targets")
+
+    def __init__(self, coach, state, func, targets):
+        """Init handler."""
+        self.coach = coach
+        self.state = state
+        self.name = coach.state_name(state)
+        self.func = func
+        self.targets = frozenset(
+            t if isinstance(t, tuple) else (coach.NAME, t) for t in targets)
+
+    @property
+    def key(self):
+        """Return the (coach name, state) pair handled."""
+        return (self.coach.NAME, self.state)
+
+    def __repr__(self):
+        """Return readable representation."""
+        return "<Handler {}:{}>".format(self.coach.NAME, self.name)
+
+
+class Registry(object):
+    """Dispatch table of all coach states."""
+
+    def __init__(self):
+        """Init empty registry."""
+        self.coaches = {}
+        self.handlers = {}
+
+    def register(self, coach_cls):
+        """Add a coach class and its decorated state handlers.
+
+        Can be used as class decorator. The coach is instantiated once and
+        shared by all conversations.
+        """
+        if coach_cls.NAME in self.coaches:
+            raise ValueError("Coach {} is already registered".format(
+                coach_cls.NAME))
+
+        coach = coach_cls()
+        self.coaches[coach_cls.NAME] = coach
+        for attr in dir(coach_cls):
+            func = getattr(coach, attr)
+            for st in getattr(func, "fsm_states", ()):
+                handler = Handler(coach, st, func, func.fsm_targets)
+                if handler.key in self.handlers:
+                    raise ValueError("{} is handled twice".format(handler))
+                self.handlers[handler.key] = handler
+        return coach_cls
+
+    def coach(self, name):
+        """Return the coach instance registered under name."""
+        try:
+            return self.coaches[name]
+        except KeyError:
+            raise UnknownState("No coach named {}".format(name))
+
+    def lookup(self, coach, state):
+        """Return the handler of a coach name and state."""
+        try:
+            return self.handlers[(coach, state)]
+        except KeyError:
+            raise UnknownState("No handler for {}:{}".format(coach, state))
+
+    def validate(self):
+        """Raise ValueError if a handler declares a transition to nowhere."""
+        for handler in self.handlers.values():
+            for target in handler.targets:
+                if target not in self.handlers:
+                    raise ValueError("{} declares a transition to unknown "
+                        "state {}:{}".format(handler, *target))
+
+    def dispatch(self, conv, update, handler=None):
+        """Pass update to the handler of the conversation's current state.
+
+        Returns what the handler returns.
+        """
+        if handler is None:
+            handler = self.lookup(conv.user.active_coach, conv.user.state)
+
+        outer, conv.handler = conv.handler, handler
+        try:
+            return handler.func(conv, update)
+        finally:
+            conv.handler = outer
+
+
+registry = Registry()
+
+
+class Conversation(object):
+    """Everything a coach handler needs to know about the current update."""
+
+    def __init__(self, bot, db, tguser, job_queue, user=None):
+        """Init conversation, loading or creating the user if not given."""
+        self.bot = bot
+        self.db = db
+        self.tguser = tguser
+        self.job_queue = job_queue
+
+        if user is None:
+            user, created = User.tg_get_or_create(tguser)
+            if created:
+                logger.info("Created new user {}".format(user))
+        self.user = user
+
+        # Handler currently running, set by `Registry.dispatch`
+        self.handler = None
+
+    def move(self, state, coach=None):
+        """Move the user to a state of coach, default the running coach.
+
+        Raises InvalidTransition if the running handler doesn't declare the
+        target state. The user is not saved.
+        """
+        handler = self.handler
+        if coach is None:
+            coach = handler.coach.NAME if handler else self.user.active_coach
+
+        target = (coach, state)
+        if handler is not None and target != handler.key \
+                and target not in handler.targets:
+            raise InvalidTransition("{} may not move to {}:{}".format(
+                handler, coach, state))
+
+        self.user.active_coach = coach
+        self.user.state = state
@@ -15,36 +15,151 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import os
+import time
 import logging
 
+from collections import defaultdict
 from datetime import datetime, timedelta
-from diary_peter.models import db, Job
+from diary_peter import metrics
+from diary_peter.cache import user_cache
+from diary_peter.models import db, connection, Job, User
+from diary_peter.outbox import send_messages
+from diary_peter.shards import in_shard
 
 logger = logging.getLogger(__name__)
 
+"""Jobs run this long before their `scheduled_at` time of day."""
+SCHEDULE_OFFSET = timedelta(hours=float(os.environ.get("SCHEDULE_OFFSET", 6)))
 
-def restore_jobs(job_queue):
-    """Load and queue jobs from database."""
-    for job in Job.select():
-        jobfunc = lambda bot: generic_job(bot, job.id)
-        interval = 24 * 60 * 60
 
-        scheduled = datetime.combine(datetime.today(), job.scheduled_at)
-        scheduled_remaining = scheduled - datetime.now() - timedelta(hours=6)
-        if scheduled_remaining < timedelta(seconds=0):
-            scheduled_remaining = scheduled_remaining + timedelta(days=1)
+def next_run(scheduled_at, now=None):
+    """Return the next datetime after now at which a daily job should run."""
+    now = now or datetime.now()
+    rv = datetime.combine(now.date(), scheduled_at) - SCHEDULE_OFFSET
+    while rv <= now:
+        rv += timedelta(days=1)
+    return rv
 
-        job_queue.put(jobfunc, interval,
-            next_t=scheduled_remaining.seconds)
-        logger.info("{} - {} remaining".format(job, scheduled_remaining))
-    logger.info("All jobs restored")
 
+class Scheduler(object):
+    """Fire jobs when their `next_run_at` time has come.
 
-def generic_job(bot, id):
-    """Generic bot that initiates a coach."""
-    with db.transaction():
-        job = Job.get(id=id)
-        job.user.state = job.state
-        job.user.active_coach = job.coach
-        job.user.save()
-        bot.sendMessage(job.user.telegram_id, text=job.text)
+    The schedule lives in the database, so a single ticker on the job queue
+    replaces one in-memory entry per job and nothing has to be restored on
+    startup.
+
+    With shard set to `(index, shards)` only jobs of users in that shard are
+    fired, see `diary_peter.shards`.
+    """
+
+    def __init__(self, batch_size=500, interval=1.0, shard=None):
+        """Init scheduler firing at most `batch_size` jobs per transaction."""
+        self.batch_size = batch_size
+        self.interval = interval
+        self.shard = shard
+        self.last_batch = None
+
+    def jobs(self):
+        """Return query for the jobs of this scheduler's shard."""
+        query = Job.select(Job, User).join(User)
+        if self.shard is not None:
+            query = query.where(in_shard(User.telegram_id, *self.shard))
+        return query
+
+    def start(self, job_queue):
+        """Schedule jobs that were never scheduled and start ticking."""
+        self.schedule_missing()
+        job_queue.put(self.tick, self.interval, next_t=0)
+        logger.info("Scheduler started")
+
+    def schedule_missing(self):
+        """Set `next_run_at` for jobs created before it existed."""
+        with connection():
+            while True:
+                with db.transaction():
+                    jobs = list(self.jobs()
+                        .where(Job.next_run_at >> None)
+                        .limit(self.batch_size))
+                    for job in jobs:
+                        job.next_run_at = next_run(job.scheduled_at)
+                        job.save()
+                if len(jobs) < self.batch_size:
+                    break
+
+    def due(self, now):
+        """Return query for the next batch of jobs due at now."""
+        return (self.jobs()
+            .where(Job.next_run_at <= now)
+            .order_by(Job.next_run_at)
+            .limit(self.batch_size))
+
+    def tick(self, bot):
+        """Fire due jobs in batches and advance their `next_run_at`."""
+        with connection():
+            self._tick(bot)
+
+    def _tick(self, bot):
+        now = datetime.now()
+        while True:
+            started = time.monotonic()
+            moved = []
+            with db.transaction():
+                jobs = list(self.due(now))
+                selected = time.monotonic()
+
+                if jobs:
+                    moved = generic_job(bot, jobs)
+                    fired = time.monotonic()
+
+                    # Jobs with the same time of day share their next run
+                    slots = defaultdict(list)
+                    for job in jobs:
+                        slots[job.scheduled_at].append(job.id)
+                    for scheduled_at, ids in slots.items():
+                        Job.update(next_run_at=next_run(scheduled_at, now)) \
+                            .where(Job.id << ids).execute()
+
+            # Only after the commit, or a cache miss in between would cache
+            # the rows from before the jobs moved their users
+            for telegram_id in moved:
+                user_cache.invalidate(telegram_id)
+
+            if jobs:
+                self.last_batch = {
+                    "jobs": len(jobs),
+                    "select": selected - started,
+                    "fire": fired - selected,
+                    "advance": time.monotonic() - fired,
+                    "total": time.monotonic() - started
+                }
+                logger.info("Fired {jobs} jobs in {total:.3f}s (select {select:.3f}s, fire {fire:.3f}s, advance {advance:.3f}s)".format(
+                    **self.last_batch))
+
+            if len(jobs) < self.batch_size:
+                break
+
+
+def generic_job(bot, jobs):
+    """Generic job that initiates coaches for a batch of due jobs.
+
+    Users are moved into the jobs' coach and state with one UPDATE per
+    (coach, state) pair and all prompts are handed to the bot at once. The
+    jobs' users should be selected together with the jobs.
+
+    Returns the telegram ids of the moved users, whose cache entries the
+    caller must invalidate once the update is committed.
+    """
+    with metrics.job_latency.time():
+        groups = defaultdict(list)
+        for job in jobs:
+            groups[(job.coach, job.state)].append(job.user)
+
+        for (coach, state), users in groups.items():
+            User.update(active_coach=coach, state=state) \
+                .where(User.id << [u.id for u in users]).execute()
+            metrics.jobs_fired.inc(len(users), coach=coach)
+
+        send_messages(bot, [(job.user.telegram_id, {"text": job.text})
+            for job in jobs])
+    return [job.user.telegram_id for job in jobs]
@@ -18,29 +18,42 @@
 
 import logging
 
-from telegram import KeyboardButton, ReplyKeyboardMarkup, Emoji, \
-    InlineKeyboardButton, InlineKeyboardMarkup
+from functools import lru_cache
+from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardHide, \
+    Emoji, InlineKeyboardButton, InlineKeyboardMarkup
+
+# Keyboards are sent as their JSON encoding, which `telegram.Bot` passes
+# through unchanged. Static keyboards are encoded once at import.
 
 
 def keyboard(name):
-    """Return a custom keyboard."""
+    """Return the JSON encoded custom keyboard called name."""
     try:
-        buttons = globals()[name]
+        return compiled[name]
     except KeyError:
         logging.error("Custom keyboard {} not found.".format(name))
         return
 
-    keyboard = [[KeyboardButton(button) for button in line]
-        for line in buttons]
-    rv = ReplyKeyboardMarkup(keyboard)
-    return rv
+
+def compile_keyboard(buttons):
+    """Return the JSON encoding of a custom keyboard given rows of labels."""
+    return ReplyKeyboardMarkup([[KeyboardButton(button) for button in line]
+        for line in buttons]).to_json()
 
 
 def inline_keyboard(options):
-    """Return an inline Keyboard given a dictionary of callback:display pairs."""
-    rv = InlineKeyboardMarkup([[InlineKeyboardButton(v, callback_data=k)]
-        for k, v in options.items()])
-    return rv
+    """Return an inline Keyboard given a dictionary of callback:display pairs.
+
+    The JSON encoding is returned and cached for the same options.
+    """
+    return compile_inline_keyboard(tuple(options.items()))
+
+
+@lru_cache(maxsize=128)
+def compile_inline_keyboard(items):
+    """Return the JSON encoding of an inline keyboard of (callback, display) pairs."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(v, callback_data=k)]
+        for k, v in items]).to_json()
 
 
 """Keyboard containing the hours from 5am-1pm."""
@@ -53,3 +66,14 @@ morning_hours = [
 
 """A keyboard that just displays thumbs up and down."""
 thumbs = [[Emoji.THUMBS_UP_SIGN, Emoji.THUMBS_DOWN_SIGN]]
+
+
+"""Encoded custom keyboards by name."""
+compiled = {name: compile_keyboard(buttons) for name, buttons in [
+    ("morning_hours", morning_hours),
+    ("thumbs", thumbs),
+]}
+
+
+"""Instruction to hide the custom keyboard."""
+hide_keyboard = ReplyKeyboardHide().to_json()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""Runtime metrics served in the Prometheus text format."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import time
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+
+from diary_peter.models import query_stats
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5,
+    10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def escape(value):
+    """Escape a label value."""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    """Return a label set such as `{coach="Menu",state="1"}`."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + "}"
+
+
+def format_value(value):
+    """Return a sample value in the text format."""
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """Collection of metrics rendered together."""
+
+    def __init__(self):
+        """Init empty registry."""
+        self.metrics = []
+
+    def register(self, metric):
+        """Add metric and return it."""
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.doc))
+            lines.append("# TYPE {} {}".format(metric.name, metric.TYPE))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+"""Registry served by `MetricsServer`."""
+registry = Registry()
+
+
+class Counter(object):
+    """Monotonically increasing count per label set."""
+
+    TYPE = "counter"
+
+    def __init__(self, name, doc, labels=(), registry=registry):
+        """Init counter and add it to registry."""
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = defaultdict(float)
+        self.lock = Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        """Increment the count of a label set."""
+        key = tuple(labels[n] for n in self.labels)
+        with self.lock:
+            self.values[key] += amount
+
+    def get(self, **labels):
+        """Return the count of a label set."""
+        return self.values.get(tuple(labels[n] for n in self.labels), 0)
+
+    def samples(self):
+        """Return sample lines."""
+        with self.lock:
+            items = sorted(self.values.items())
+        return ["{}{} {}".format(self.name, format_labels(self.labels, k),
+            format_value(v)) for k, v in items]
+
+
+class Gauge(object):
+    """Value read from a function whenever metrics are rendered."""
+
+    TYPE = "gauge"
+
+    def __init__(self, name, doc, func, registry=registry):
+        """Init gauge and add it to registry."""
+        self.name = name
+        self.doc = doc
+        self.func = func
+        if registry is not None:
+            registry.register(self)
+
+    def samples(self):
+        """Return sample lines."""
+        try:
+            value = self.func()
+        except Exception:
+            logger.exception("Failed reading gauge {}".format(self.name))
+            return []
+        return ["{} {}".format(self.name, format_value(value))]
+
+
+class Histogram(object):
+    """Distribution of observed values per label set."""
+
+    TYPE = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS,
+            registry=registry):
+        """Init histogram and add it to registry."""
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values = {}
+        self.lock = Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, **labels):
+        """Add an observation to a label set."""
+        key = tuple(labels[n] for n in self.labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block in seconds."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def count(self, **labels):
+        """Return the number of observations of a label set."""
+        counts, total = self.values.get(
+            tuple(labels[n] for n in self.labels), ((), 0))
+        return sum(counts)
+
+    def samples(self):
+        """Return cumulative bucket, sum and count lines."""
+        with self.lock:
+            items = sorted((k, (list(c), t)) for k, (c, t) in self.values.items())
+
+        rv = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for le, n in zip(self.buckets, counts):
+                cumulative += n
+                rv.append("{}_bucket{} {}".format(self.name,
+                    format_labels(self.labels, key, [("le", format_value(le))]),
+                    cumulative))
+            rv.append("{}_sum{} {}".format(self.name,
+                format_labels(self.labels, key), format_value(total)))
+            rv.append("{}_count{} {}".format(self.name,
+                format_labels(self.labels, key), cumulative))
+        return rv
+
+
+update_latency = Histogram("diary_update_seconds",
+    "Time spent handling an update", ["coach", "state"])
+update_queries = Histogram("diary_update_queries",
+    "Database queries per update", ["coach", "state"], COUNT_BUCKETS)
+update_transactions = Histogram("diary_update_transactions",
+    "Database commits per update", ["coach", "state"], COUNT_BUCKETS)
+update_errors = Counter("diary_update_errors_total",
+    "Updates that raised an exception", ["coach", "state"])
+updates_duplicate = Counter("diary_updates_duplicate_total",
+    "Updates dropped because they were already delivered")
+updates_shed = Counter("diary_updates_shed_total",
+    "Updates dropped because the worker queues were full", ["priority"])
+coach_latency = Histogram("diary_coach_handle_seconds",
+    "Time spent in Coach.handle", ["coach", "state"])
+job_latency = Histogram("diary_job_seconds",
+    "Time spent firing a batch of jobs")
+jobs_fired = Counter("diary_jobs_fired_total", "Jobs fired", ["coach"])
+send_latency = Histogram("diary_send_seconds",
+    "Duration of Bot API requests", ["method"])
+send_errors = Counter("diary_send_errors_total",
+    "Failed Bot API requests", ["method", "error"])
+
+
+@contextmanager
+def measure_update():
+    """Measure handling an update in the block.
+
+    Yields a dictionary on which the block sets the "coach" and "state"
+    labels once they are known.
+    """
+    labels = {"coach": "", "state": ""}
+    queries, commits = query_stats.queries, query_stats.commits
+    started = time.monotonic()
+    try:
+        yield labels
+    except Exception:
+        update_errors.inc(**labels)
+        raise
+    finally:
+        update_latency.observe(time.monotonic() - started, **labels)
+        update_queries.observe(query_stats.queries - queries, **labels)
+        update_transactions.observe(query_stats.commits - commits, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the registry on /metrics."""
+
+    def do_GET(self):
+        """Render metrics."""
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests to the module logger instead of stderr."""
+        logger.debug(format % args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    """HTTP server exposing metrics for scraping."""
+
+    daemon_threads = True
+
+    def __init__(self, address, registry=registry):
+        """Init server listening on address, e.g. `('127.0.0.1', 9090)`."""
+        super().__init__(address, MetricsHandler)
+        self.registry = registry
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thr = Thread(target=self.serve_forever, name="metrics")
+        thr.daemon = True
+        thr.start()
+        logger.info("Serving metrics on port {}".format(
+            self.server_address[1]))
+        return thr
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Versioned, forward-only schema migrations."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import datetime
+import logging
+import peewee as pw
+
+from playhouse.migrate import SchemaMigrator, migrate as run_operations
+
+from diary_peter import search
+from diary_peter.models import db, DailySummary
+
+logger = logging.getLogger(__name__)
+
+"""List of (version, description, function) tuples.
+
+Each function receives a `SchemaMigrator` and the database and returns a list
+of migrator operations. Append new migrations with increasing versions and
+never change ones that were already released.
+"""
+MIGRATIONS = []
+
+
+class SchemaVersion(pw.Model):
+    """Record of an applied migration."""
+
+    version = pw.IntegerField(primary_key=True)
+    description = pw.CharField()
+    applied = pw.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        """Metadata for schema version model."""
+
+        database = db
+        db_table = "schema_version"
+
+
+class RawSQL(object):
+    """Migration operation executing statements the migrator can't express."""
+
+    def __init__(self, database, statements):
+        """Init operation."""
+        self.database = database
+        self.statements = statements
+
+    def run(self):
+        """Execute statements in order."""
+        for sql in self.statements:
+            self.database.execute_sql(sql)
+
+
+class CreateTable(object):
+    """Migration operation creating a model's table and indexes."""
+
+    def __init__(self, model):
+        """Init operation."""
+        self.model = model
+
+    def run(self):
+        """Create table unless it exists."""
+        self.model.create_table(fail_silently=True)
+
+
+def migration(version, description):
+    """Decorator registering a migration function."""
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def current_version():
+    """Return the version of the latest applied migration, 0 if none."""
+    SchemaVersion.create_table(fail_silently=True)
+    return SchemaVersion.select(
+        pw.fn.COALESCE(pw.fn.MAX(SchemaVersion.version), 0)).scalar()
+
+
+def pending():
+    """Return migrations that have not been applied yet."""
+    version = current_version()
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def migrate():
+    """Apply pending migrations in order, each in its own transaction."""
+    database = SchemaVersion._meta.database
+    migrator = SchemaMigrator.from_database(database)
+
+    applied = []
+    for version, description, func in pending():
+        logger.info("Migrating to version {}: {}".format(version, description))
+        with database.transaction():
+            run_operations(*func(migrator, database))
+            SchemaVersion.create(version=version, description=description)
+        applied.append(version)
+    return applied
+
+
+def stamp():
+    """Mark all migrations as applied, e.g. after creating fresh tables."""
+    for version, description, func in pending():
+        SchemaVersion.create(version=version, description=description)
+
+
+@migration(1, "Add Job.next_run_at")
+def add_job_next_run_at(migrator, database):
+    """Add scheduling column used by `jobs.Scheduler`."""
+    return [
+        migrator.add_column("job", "next_run_at",
+            pw.DateTimeField(null=True)),
+        migrator.add_index("job", ("next_run_at",), False)
+    ]
+
+
+@migration(2, "Index records by user and creation time")
+def add_record_user_created_index(migrator, database):
+    """Index for loading a user's recent records."""
+    return [migrator.add_index("record", ("user_id", "created"), False)]
+
+
+@migration(3, "Add full-text search index for records")
+def add_record_search_index(migrator, database):
+    """Index used by `search.search`."""
+    return [RawSQL(database, search.index_statements(database))]
+
+
+@migration(4, "Add daily summaries")
+def add_daily_summary(migrator, database):
+    """Rollup table, fill it with backfill_summaries.py afterwards."""
+    return [CreateTable(DailySummary)]
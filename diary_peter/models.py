@@ -17,21 +17,230 @@
 #  limitations under the License.
 
 import os
+import time
 import datetime
 import peewee as pw
 
-# from playhouse.pool import PooledSqliteDatabase
+from contextlib import contextmanager
+from threading import Lock, local
+from playhouse.pool import PooledPostgresqlDatabase, PooledSqliteDatabase, \
+    MaxConnectionsExceeded
+from playhouse.shortcuts import case
+
+from diary_peter.cache import user_cache
+
+# Connections are reused per thread and returned to the pool on close
+POOL_OPTIONS = {
+    "max_connections": int(os.environ.get("DB_MAX_CONNECTIONS", 20)),
+    "stale_timeout": int(os.environ.get("DB_STALE_TIMEOUT", 300))
+}
+
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+
+
+def sqlite_options(profile=None):
+    """Return connection options for an SQLite profile.
+
+    The "production" profile uses a write-ahead log so readers don't block
+    the writer and only syncs on checkpoints. Connections still checkpoint
+    automatically every 1000 pages like SQLite does by default, so tools
+    that never call `checkpoint` don't grow the log. Set
+    SQLITE_AUTOCHECKPOINT to 0 to leave checkpointing to `checkpoint` alone.
+    Any other profile uses SQLite's defaults.
+    """
+    profile = profile or os.environ.get("SQLITE_PROFILE", "default")
+    if profile != "production":
+        return {}
+
+    return {
+        "timeout": float(os.environ.get("SQLITE_BUSY_TIMEOUT", 5)),
+        "pragmas": [
+            ("journal_mode", "wal"),
+            ("synchronous", os.environ.get("SQLITE_SYNCHRONOUS", "normal")),
+            ("cache_size", int(os.environ.get("SQLITE_CACHE_SIZE", -64000))),
+            ("mmap_size", int(os.environ.get("SQLITE_MMAP_SIZE", 268435456))),
+            ("wal_autocheckpoint",
+                int(os.environ.get("SQLITE_AUTOCHECKPOINT", 1000)))
+        ]
+    }
+
+
+class QueryStats(local):
+    """Number of queries and commits issued by the current thread."""
+
+    def __init__(self):
+        """Init counters."""
+        self.queries = 0
+        self.commits = 0
+
+
+query_stats = QueryStats()
+
+
+class CountingMixin(object):
+    """Database mixin counting queries and commits in `query_stats`."""
+
+    def execute_sql(self, *args, **kwargs):
+        """Execute and count a query."""
+        query_stats.queries += 1
+        return super().execute_sql(*args, **kwargs)
+
+    def commit(self):
+        """Commit and count a transaction."""
+        query_stats.commits += 1
+        return super().commit()
+
+
+class CommitHooksMixin(object):
+    """Database mixin running callbacks once the current transaction commits.
+
+    Callbacks are kept per thread and dropped if the transaction rolls back.
+    Outside of a transaction they run at once, as the statements before them
+    were already committed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Init database without pending callbacks."""
+        super().__init__(*args, **kwargs)
+        self._commit_hooks = local()
+
+    def _pop_hooks(self):
+        rv = getattr(self._commit_hooks, "pending", [])
+        self._commit_hooks.pending = []
+        return rv
+
+    def on_commit(self, func, *args):
+        """Call func(*args) after the current transaction commits."""
+        if self.transaction_depth() == 0:
+            func(*args)
+        else:
+            self._commit_hooks.pending = \
+                getattr(self._commit_hooks, "pending", []) + [(func, args)]
+
+    def commit(self):
+        """Commit and run the callbacks registered for the transaction."""
+        rv = super().commit()
+        for func, args in self._pop_hooks():
+            func(*args)
+        return rv
+
+    def rollback(self):
+        """Roll back and drop the callbacks registered for the transaction."""
+        self._pop_hooks()
+        return super().rollback()
+
+
+class CountingPostgresqlDatabase(CommitHooksMixin, CountingMixin,
+        PooledPostgresqlDatabase):
+    """Pooled Postgres database counting queries."""
+
+
+class CountingSqliteDatabase(CommitHooksMixin, CountingMixin,
+        PooledSqliteDatabase):
+    """Pooled SQLite database counting queries."""
 
 
 if os.environ.get("PG_PASS", False):
-    db = pw.PostgresqlDatabase(
+    db = CountingPostgresqlDatabase(
         'peter',  # Required by Peewee.
         user='peter',  # Will be passed directly to psycopg2.
         password=os.environ.get("PG_PASS", False),  # Ditto.
         host='localhost',  # Ditto.
+        **POOL_OPTIONS
     )
 else:
-    db = pw.SqliteDatabase('test.db')
+    # Pooled connections move between threads, but only one uses each at a time
+    db = CountingSqliteDatabase(os.environ.get("SQLITE_PATH", 'test.db'),
+        check_same_thread=False, **dict(POOL_OPTIONS, **sqlite_options()))
+
+
+class PoolStats(object):
+    """Wait times for pooled connections."""
+
+    def __init__(self):
+        """Init empty counters."""
+        self.connects = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.lock = Lock()
+
+    def record(self, wait, waited):
+        """Record a successful connect that took `wait` seconds."""
+        with self.lock:
+            self.connects += 1
+            self.waits += waited
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def as_dict(self, database=None):
+        """Return counters and pool utilization as a dictionary."""
+        database = database or db
+        in_use = len(getattr(database, "_in_use", ()))
+        max_connections = getattr(database, "max_connections", None)
+        return {
+            "connects": self.connects,
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+            "wait_avg": self.wait_total / (self.connects or 1),
+            "wait_max": self.wait_max,
+            "in_use": in_use,
+            "idle": len(getattr(database, "_connections", ())),
+            "max_connections": max_connections,
+            "utilization": in_use / max_connections if max_connections else 0
+        }
+
+
+pool_stats = PoolStats()
+
+
+@contextmanager
+def connection(database=None, timeout=POOL_TIMEOUT):
+    """Hold a connection for the duration of the block.
+
+    Opens the calling thread's connection, waiting up to `timeout` seconds
+    for a free pooled connection, and returns it to the pool afterwards. If
+    the thread already has an open connection it is used as is.
+    """
+    database = database or db
+    if not database.is_closed():
+        yield database
+        return
+
+    started = time.monotonic()
+    waited = False
+    while True:
+        try:
+            database.connect()
+        except MaxConnectionsExceeded:
+            if time.monotonic() - started > timeout:
+                with pool_stats.lock:
+                    pool_stats.timeouts += 1
+                raise
+            waited = True
+            time.sleep(0.01)
+        else:
+            break
+    pool_stats.record(time.monotonic() - started, waited)
+
+    try:
+        yield database
+    finally:
+        database.close()
+
+
+def checkpoint(database=None, mode=None):
+    """Copy the SQLite write-ahead log back into the database file.
+
+    Returns the (busy, log pages, checkpointed pages) result row.
+    """
+    database = database or db
+    mode = mode or os.environ.get("SQLITE_CHECKPOINT_MODE", "PASSIVE")
+    with connection(database):
+        return database.execute_sql(
+            "PRAGMA wal_checkpoint({})".format(mode)).fetchone()
 
 
 class User(pw.Model):
@@ -73,11 +282,53 @@ class User(pw.Model):
 
     @staticmethod
     def tg_get_or_create(tguser):
-        """Get or create based on a Telegram user object."""
-        return User.get_or_create(
+        """Get or create based on a Telegram user object.
+
+        Lookups are answered from `user_cache` when possible, so repeated
+        lookups while handling the same update don't hit the database.
+        """
+        user = User.from_cache(tguser.id)
+        if user is not None:
+            return user, False
+
+        user, created = User.get_or_create(
             telegram_id=tguser.id,
             chat_id=tguser.id
         )
+        user_cache.put(user.telegram_id, dict(user._data))
+        return user, created
+
+    @staticmethod
+    def from_cache(telegram_id):
+        """Return a fresh user instance built from the cache or None."""
+        data = user_cache.get(telegram_id)
+        if data is None:
+            return None
+        return User(**data)
+
+    def save(self, *args, **kwargs):
+        """Save user and write the new field values through to the cache.
+
+        Inside a transaction the cache is updated once it commits, so a
+        rolled back save is never served from the cache.
+        """
+        rv = super().save(*args, **kwargs)
+        if rv:
+            database = self._meta.database
+            on_commit = getattr(database, "on_commit", None)
+            if on_commit is None:
+                user_cache.put(self.telegram_id, dict(self._data))
+            else:
+                on_commit(user_cache.put, self.telegram_id, dict(self._data))
+        else:
+            # The row is gone, don't keep serving it from the cache
+            user_cache.invalidate(self.telegram_id)
+        return rv
+
+    def delete_instance(self, *args, **kwargs):
+        """Delete user and drop it from the cache."""
+        user_cache.invalidate(self.telegram_id)
+        return super().delete_instance(*args, **kwargs)
 
     def create_record(self, kind, content, reaction=None):
         """Return a new record in this user's diary."""
@@ -100,6 +351,23 @@ class Record(pw.Model):
     reaction = pw.CharField(null=True)
     content = pw.CharField()
 
+    @staticmethod
+    def insert_batch(rows, chunk_size=100):
+        """Insert a list of field dictionaries in one transaction."""
+        with db.transaction():
+            for i in range(0, len(rows), chunk_size):
+                Record.insert_many(rows[i:i + chunk_size]).execute()
+            DailySummary.add_records(rows)
+
+    def save(self, *args, **kwargs):
+        """Save record and count new records in the daily summary."""
+        created = self._get_pk_value() is None or kwargs.get("force_insert")
+        with self._meta.database.atomic():
+            rv = super().save(*args, **kwargs)
+            if created:
+                DailySummary.add_records([self._data])
+        return rv
+
     def __repr__(self):
         """Return readable representation."""
         return "{} #{} of User-{} ({})".format(
@@ -114,6 +382,10 @@ class Record(pw.Model):
         database = db
         order_by = ('created',)
 
+        indexes = (
+            (('user', 'created'), False),
+        )
+
 
 class Job(pw.Model):
     """Coach setup for a user."""
@@ -124,6 +396,9 @@ class Job(pw.Model):
     scheduled_at = pw.TimeField(default=lambda: datetime.time(hour=22))
     text = pw.CharField()
 
+    # When is this job due next?
+    next_run_at = pw.DateTimeField(null=True, index=True)
+
     def __repr__(self):
         """Readable representation."""
         return "{} job of user {} scheduled at {}".format(
@@ -138,3 +413,196 @@ class Job(pw.Model):
         indexes = (
             (('user', 'coach', 'state'), True),
         )
+
+
+class DailySummary(pw.Model):
+    """Rollup of a user's records on one day.
+
+    Updated whenever records are written, so views over weeks or months
+    read one row per day instead of every record.
+    """
+
+    # Number of reasons that complete a day's gratitude session
+    GRATITUDE_SIZE = 3
+
+    user = pw.ForeignKeyField(User, related_name="daily_summaries")
+    date = pw.DateField()
+
+    # Number of records by kind, `entries` counts all kinds
+    entries = pw.IntegerField(default=0)
+    text_entries = pw.IntegerField(default=0)
+    gratitude_entries = pw.IntegerField(default=0)
+
+    # Number of gratitude records with a reason
+    gratitude_reasons = pw.IntegerField(default=0)
+    gratitude_complete = pw.BooleanField(default=False)
+
+    first_entry = pw.DateTimeField(null=True)
+    last_entry = pw.DateTimeField(null=True)
+
+    class Meta:
+        """Metadata for daily summary model."""
+
+        database = db
+        db_table = "daily_summary"
+
+        indexes = (
+            (('user', 'date'), True),
+        )
+
+    @staticmethod
+    def count(rows):
+        """Return a summary dictionary for each (user, date) of record rows.
+
+        Rows are dictionaries with at least user, kind, created and reaction.
+        """
+        rv = {}
+        for row in rows:
+            user = row["user"]
+            user = getattr(user, "id", user)
+            created = row["created"]
+            counts = rv.setdefault((user, created.date()), {
+                "entries": 0,
+                "text_entries": 0,
+                "gratitude_entries": 0,
+                "gratitude_reasons": 0,
+                "first_entry": created,
+                "last_entry": created
+            })
+
+            counts["entries"] += 1
+            if row["kind"] == "text":
+                counts["text_entries"] += 1
+            elif row["kind"] == "Gratitude":
+                counts["gratitude_entries"] += 1
+                if row.get("reaction") is not None:
+                    counts["gratitude_reasons"] += 1
+            counts["first_entry"] = min(counts["first_entry"], created)
+            counts["last_entry"] = max(counts["last_entry"], created)
+        return rv
+
+    @staticmethod
+    def add_records(rows):
+        """Add new record rows to their users' daily summaries."""
+        for (user, date), counts in DailySummary.count(rows).items():
+            DailySummary.increment(user, date, **counts)
+
+    @staticmethod
+    def add_reactions(records):
+        """Count reactions that were added to existing records."""
+        for (user, date), counts in DailySummary.count(
+                r._data for r in records).items():
+            if counts["gratitude_reasons"]:
+                DailySummary.increment(user, date,
+                    gratitude_reasons=counts["gratitude_reasons"])
+
+    @staticmethod
+    def increment(user, date, first_entry=None, last_entry=None, **counts):
+        """Add counts to a user's summary of date, creating it if needed."""
+        S = DailySummary
+        database = S._meta.database
+        updates = {getattr(S, k): getattr(S, k) + v for k, v in counts.items()}
+        if "gratitude_reasons" in counts:
+            updates[S.gratitude_complete] = \
+                S.gratitude_reasons + counts["gratitude_reasons"] >= \
+                S.GRATITUDE_SIZE
+        if first_entry is not None:
+            updates[S.first_entry] = case(None, (
+                (S.first_entry >> None, first_entry),
+                (S.first_entry > first_entry, first_entry)), S.first_entry)
+        if last_entry is not None:
+            updates[S.last_entry] = case(None, (
+                (S.last_entry >> None, last_entry),
+                (S.last_entry < last_entry, last_entry)), S.last_entry)
+
+        query = S.update(updates).where((S.user == user) & (S.date == date))
+        with database.atomic():
+            if query.execute():
+                return
+            try:
+                # Another thread may have created the row in the meantime
+                with database.atomic():
+                    S.create(user=user, date=date, first_entry=first_entry,
+                        last_entry=last_entry,
+                        gratitude_complete=counts.get(
+                            "gratitude_reasons", 0) >= S.GRATITUDE_SIZE,
+                        **counts)
+            except pw.IntegrityError:
+                query.execute()
+
+    @staticmethod
+    def rebuild(user_ids, archived=()):
+        """Recompute the summaries of some users from their records.
+
+        Records moved out of the database are counted from `archived`, rows
+        like those taken by `count`, e.g. from `archive.archived_rows`.
+        Without them the summaries of archived days are lost.
+        """
+        R = Record
+        is_gratitude = R.kind == "Gratitude"
+        day = pw.fn.date(R.created)
+        query = (R.select(
+                R.user,
+                day.alias("date"),
+                pw.fn.COUNT(R.id).alias("entries"),
+                pw.fn.SUM(case(None, ((R.kind == "text", 1),), 0))
+                    .alias("text_entries"),
+                pw.fn.SUM(case(None, ((is_gratitude, 1),), 0))
+                    .alias("gratitude_entries"),
+                pw.fn.SUM(case(None,
+                    ((is_gratitude & R.reaction.is_null(False), 1),), 0))
+                    .alias("gratitude_reasons"),
+                pw.fn.MIN(R.created).alias("first_entry"),
+                pw.fn.MAX(R.created).alias("last_entry"))
+            .where(R.user << user_ids)
+            .group_by(R.user, day)
+            .dicts())
+
+        # Deleting first locks the summaries, so records written while the
+        # rebuild runs are either aggregated or counted into the new rows
+        with DailySummary._meta.database.atomic():
+            DailySummary.delete().where(
+                DailySummary.user << user_ids).execute()
+
+            days = {}
+            for row in query:
+                # SQLite returns dates as text, peewee may parse them into
+                # datetimes
+                date = row["date"]
+                if isinstance(date, str):
+                    date = datetime.datetime.strptime(date[:10], "%Y-%m-%d")
+                if isinstance(date, datetime.datetime):
+                    date = date.date()
+                days[(row["user"], date)] = dict(row, date=date)
+
+            for (user, date), counts in DailySummary.count(archived).items():
+                row = days.get((user, date))
+                if row is None:
+                    days[(user, date)] = dict(counts, user=user, date=date)
+                    continue
+                for k in ("entries", "text_entries", "gratitude_entries",
+                        "gratitude_reasons"):
+                    row[k] += counts[k]
+                row["first_entry"] = min(row["first_entry"],
+                    counts["first_entry"])
+                row["last_entry"] = max(row["last_entry"],
+                    counts["last_entry"])
+
+            rows = list(days.values())
+            for row in rows:
+                row["gratitude_complete"] = \
+                    row["gratitude_reasons"] >= DailySummary.GRATITUDE_SIZE
+
+            for i in range(0, len(rows), 100):
+                DailySummary.insert_many(rows[i:i + 100]).execute()
+        return len(rows)
+
+    @staticmethod
+    def period(user, start, end):
+        """Return the user's summaries from start up to and including end."""
+        return (DailySummary.select()
+            .where(
+                (DailySummary.user == user) &
+                (DailySummary.date >= start) &
+                (DailySummary.date <= end))
+            .order_by(DailySummary.date))
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""Rate-limited, pipelined sending of outbound messages."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import heapq
+import logging
+import re
+import time
+
+from collections import deque
+from concurrent.futures import Future
+from itertools import count
+from threading import Thread, Condition
+
+from telegram.error import TelegramError, NetworkError
+
+from diary_peter import metrics
+from diary_peter.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """Allow `rate` events per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        """Init a full bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+            self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Return seconds until a token is available, 0 if there is one."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Take a token, which must be available."""
+        self._refill(now)
+        self.tokens -= 1
+
+
+def retry_after(error):
+    """Return seconds to wait if error is a 429 response, otherwise None."""
+    seconds = getattr(error, "retry_after", None)
+    if seconds is not None:
+        return seconds
+
+    msg = str(error)
+    if "429" in msg or "Too Many Requests" in msg:
+        match = re.search(r"retry after (\d+)", msg)
+        return int(match.group(1)) if match else 1
+    return None
+
+
+class Outbox(object):
+    """Send bot requests from background threads.
+
+    Requests are queued per chat and sent in order, limited by a global and a
+    per-chat token bucket. Calls return a `concurrent.futures.Future`
+    resolving to the bot method's return value.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=3,
+            workers=4, max_retries=5, backoff=1.0):
+        """Init outbox sending through bot.
+
+        Parameters:
+            global_rate: Maximum requests per second across all chats
+            chat_rate: Maximum sustained requests per second in a chat
+            chat_burst: Number of requests a chat may send back-to-back
+            workers: Number of sending threads
+            max_retries: Give up on a request after this many failed attempts
+            backoff: Seconds to wait after the first network error, doubled
+                for every further attempt
+        """
+        self.sender = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        # Buckets are full again burst / rate seconds after their last take,
+        # so they can be forgotten after that. Taking re-puts the bucket to
+        # restart its time to live.
+        self._buckets = LRUCache(maxsize=100000, ttl=chat_burst / chat_rate)
+        self._ready = []
+        self._seq = count()
+        self._cond = Condition()
+        self._threads = []
+        self._running = False
+
+        self.bot = OutboxBot(bot, self)
+
+    def start(self):
+        """Start sending threads."""
+        self._running = True
+        for i in range(self.workers):
+            thr = Thread(target=self._work, name="outbox-{}".format(i))
+            thr.daemon = True
+            thr.start()
+            self._threads.append(thr)
+
+    def stop(self, timeout=None):
+        """Stop sending threads after the queue was drained."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thr in self._threads:
+            thr.join(timeout)
+        self._threads = []
+
+    def depth(self):
+        """Return the number of queued requests."""
+        with self._cond:
+            return sum(len(q) for q in self._chats.values())
+
+    def send(self, method, chat_id, *args, **kwargs):
+        """Queue `bot.<method>(chat_id, *args, **kwargs)` and return a future."""
+        future = Future()
+        item = [future, method, (chat_id,) + args, kwargs, 0]
+
+        with self._cond:
+            q = self._chats.get(chat_id)
+            if q is None:
+                q = self._chats[chat_id] = deque()
+                self._schedule(chat_id, time.monotonic())
+            q.append(item)
+        return future
+
+    def sendMessage(self, chat_id, *args, **kwargs):
+        """Queue a text message."""
+        return self.send("sendMessage", chat_id, *args, **kwargs)
+
+    def send_many(self, method, requests):
+        """Queue `(chat_id, kwargs)` requests at once and return their futures."""
+        rv = []
+        now = time.monotonic()
+        with self._cond:
+            for chat_id, kwargs in requests:
+                future = Future()
+                q = self._chats.get(chat_id)
+                if q is None:
+                    q = self._chats[chat_id] = deque()
+                    heapq.heappush(self._ready, (now, next(self._seq), chat_id))
+                q.append([future, method, (chat_id,), kwargs, 0])
+                rv.append(future)
+            self._cond.notify_all()
+        return rv
+
+    def _schedule(self, chat_id, at):
+        """Mark chat as ready to send at monotonic time `at`."""
+        heapq.heappush(self._ready, (at, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets.put(chat_id, bucket)
+        return bucket
+
+    def _next(self):
+        """Wait for a chat that may send now and return its first request.
+
+        The chat is taken off the ready heap until the request completed, so
+        no two requests of the same chat are ever in flight.
+        """
+        with self._cond:
+            while True:
+                if not self._ready:
+                    if not self._running:
+                        return None, None
+                    self._cond.wait()
+                    continue
+
+                now = time.monotonic()
+                at, seq, chat_id = self._ready[0]
+                if at > now:
+                    self._cond.wait(at - now)
+                    continue
+
+                delay = max(self._global.delay(now),
+                    self._bucket(chat_id).delay(now))
+                if delay > 0:
+                    heapq.heapreplace(self._ready,
+                        (now + delay, seq, chat_id))
+                    continue
+
+                heapq.heappop(self._ready)
+                self._global.take(now)
+                bucket = self._bucket(chat_id)
+                bucket.take(now)
+                self._buckets.put(chat_id, bucket)
+                return chat_id, self._chats[chat_id][0]
+
+    def _done(self, chat_id, retry_in=None, counter=None):
+        """Release chat after a request.
+
+        If `retry_in` is given the request stays at the head of the chat's
+        queue and is sent again after that many seconds.
+        """
+        with self._cond:
+            if counter is not None:
+                setattr(self, counter, getattr(self, counter) + 1)
+
+            q = self._chats[chat_id]
+            if retry_in is None:
+                q.popleft()
+                retry_in = 0
+
+            if q:
+                self._schedule(chat_id, time.monotonic() + retry_in)
+            else:
+                del self._chats[chat_id]
+
+    def _work(self):
+        """Thread target sending queued requests."""
+        while True:
+            chat_id, item = self._next()
+            if item is None:
+                break
+
+            future, method, args, kwargs, attempts = item
+            if attempts == 0 and not future.set_running_or_notify_cancel():
+                self._done(chat_id)
+                continue
+
+            try:
+                with metrics.send_latency.time(method=method):
+                    rv = getattr(self.sender, method)(*args, **kwargs)
+            except TelegramError as e:
+                item[4] = attempts + 1
+                wait = retry_after(e)
+                metrics.send_errors.inc(method=method,
+                    error="throttled" if wait is not None else type(e).__name__)
+                if wait is not None:
+                    logger.warning("Rate limited in chat {}, waiting {}s".format(
+                        chat_id, wait))
+                    self._done(chat_id, retry_in=wait, counter="throttled")
+                elif isinstance(e, NetworkError) and \
+                        attempts + 1 < self.max_retries:
+                    wait = self.backoff * 2 ** attempts
+                    logger.warning("{} to chat {} failed ({}), retry in {}s".format(
+                        method, chat_id, e, wait))
+                    self._done(chat_id, retry_in=wait)
+                else:
+                    future.set_exception(e)
+                    self._done(chat_id, counter="failed")
+            except Exception as e:
+                metrics.send_errors.inc(method=method, error=type(e).__name__)
+                logger.exception("Error sending {} to chat {}".format(
+                    method, chat_id))
+                future.set_exception(e)
+                self._done(chat_id, counter="failed")
+            else:
+                future.set_result(rv)
+                self._done(chat_id, counter="sent")
+
+
+def send_messages(bot, messages):
+    """Send `(chat_id, kwargs)` messages, queued in one go if bot is an outbox."""
+    if isinstance(bot, OutboxBot):
+        return bot._outbox.send_many("sendMessage", messages)
+    return [bot.sendMessage(chat_id, **kwargs) for chat_id, kwargs in messages]
+
+
+class OutboxBot(object):
+    """Bot proxy that queues `sendMessage` calls in an outbox.
+
+    All other attributes are passed through to the wrapped bot, so coaches can
+    use it in place of a `telegram.Bot`.
+    """
+
+    def __init__(self, bot, outbox):
+        """Init proxy for bot."""
+        self._bot = bot
+        self._outbox = outbox
+
+    def sendMessage(self, chat_id, *args, **kwargs):
+        """Queue a message and return a future for the sent message."""
+        return self._outbox.sendMessage(chat_id, *args, **kwargs)
+
+    def __getattr__(self, name):
+        """Pass everything else through to the bot, timing method calls."""
+        attr = getattr(self._bot, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                with metrics.send_latency.time(method=name):
+                    return attr(*args, **kwargs)
+            except Exception as e:
+                metrics.send_errors.inc(method=name, error=type(e).__name__)
+                raise
+        return call
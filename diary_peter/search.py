@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""Full-text search over diary records."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import peewee as pw
+
+from diary_peter.archive import search_archive
+from diary_peter.models import Record
+
+# Postgres matches records against this expression, which is also indexed
+PG_DOCUMENT = "to_tsvector('english', " \
+    "coalesce(record.content, '') || ' ' || coalesce(record.reaction, ''))"
+
+SQLITE_INDEX = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS record_fts USING fts5(
+        content, reaction, content='record', content_rowid='id',
+        tokenize='porter unicode61')""",
+
+    # Keep the external content index in sync with the record table
+    """CREATE TRIGGER IF NOT EXISTS record_fts_insert AFTER INSERT ON record
+    BEGIN
+        INSERT INTO record_fts (rowid, content, reaction)
+            VALUES (new.id, new.content, new.reaction);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS record_fts_delete AFTER DELETE ON record
+    BEGIN
+        INSERT INTO record_fts (record_fts, rowid, content, reaction)
+            VALUES ('delete', old.id, old.content, old.reaction);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS record_fts_update
+        AFTER UPDATE OF content, reaction ON record
+    BEGIN
+        INSERT INTO record_fts (record_fts, rowid, content, reaction)
+            VALUES ('delete', old.id, old.content, old.reaction);
+        INSERT INTO record_fts (rowid, content, reaction)
+            VALUES (new.id, new.content, new.reaction);
+    END""",
+
+    # Index records that existed before the triggers
+    "INSERT INTO record_fts (record_fts) VALUES ('rebuild')"
+]
+
+PG_INDEX = [
+    "CREATE INDEX IF NOT EXISTS record_search ON record "
+    "USING gin ({})".format(PG_DOCUMENT)
+]
+
+
+def is_postgres(database):
+    """Return True if database is a Postgres database."""
+    return isinstance(database, pw.PostgresqlDatabase)
+
+
+def index_statements(database=None):
+    """Return the statements creating the search index for a database.
+
+    On SQLite this is an FTS5 table that triggers keep up to date, on
+    Postgres a GIN index over the records' text search vector.
+    """
+    database = database or Record._meta.database
+    return PG_INDEX if is_postgres(database) else SQLITE_INDEX
+
+
+def create_index(database=None):
+    """Create the search index and fill it with existing records."""
+    database = database or Record._meta.database
+    for sql in index_statements(database):
+        database.execute_sql(sql)
+
+
+def drop_index(database=None):
+    """Drop the search index.
+
+    The Postgres index and the SQLite triggers are dropped together with
+    the record table.
+    """
+    database = database or Record._meta.database
+    if not is_postgres(database):
+        database.execute_sql("DROP TABLE IF EXISTS record_fts")
+
+
+def match_expression(terms):
+    """Return an FTS5 query matching records that contain all terms.
+
+    Each term is quoted so user input can't use FTS5 query syntax.
+    """
+    return " ".join('"{}"'.format(t.replace('"', '""')) for t in terms.split())
+
+
+def search(user, terms, page=1, per_page=10):
+    """Return a page of user's records matching terms, best match first.
+
+    Archived records are listed after all records in the database, newest
+    first. Returns a tuple of the records and whether there are more
+    results.
+    """
+    database = Record._meta.database
+    p = database.interpolation
+    offset = (page - 1) * per_page
+
+    if is_postgres(database):
+        query = """SELECT record.* FROM record
+            WHERE record.user_id = {p} AND {doc} @@ plainto_tsquery('english', {p})
+            ORDER BY ts_rank({doc}, plainto_tsquery('english', {p})) DESC,
+                record.created DESC
+            LIMIT {p} OFFSET {p}""".format(p=p, doc=PG_DOCUMENT)
+        params = (user.id, terms, terms, per_page + 1, offset)
+    else:
+        query = """SELECT record.* FROM record_fts
+            JOIN record ON record.id = record_fts.rowid
+            WHERE record_fts MATCH {p} AND record.user_id = {p}
+            ORDER BY record_fts.rank, record.created DESC
+            LIMIT {p} OFFSET {p}""".format(p=p)
+        params = (match_expression(terms), user.id, per_page + 1, offset)
+
+    records = list(Record.raw(query, *params))
+    if len(records) <= per_page:
+        # Continue with archived records once all others are listed
+        if records or not offset:
+            skip = 0
+        else:
+            skip = offset - count(user, terms)
+        records += search_archive(user, terms)[
+            skip:skip + per_page + 1 - len(records)]
+    return records[:per_page], len(records) > per_page
+
+
+def count(user, terms):
+    """Return the number of user's records in the database matching terms."""
+    database = Record._meta.database
+    p = database.interpolation
+
+    if is_postgres(database):
+        query = """SELECT COUNT(*) FROM record
+            WHERE record.user_id = {p} AND {doc} @@ plainto_tsquery('english', {p})
+            """.format(p=p, doc=PG_DOCUMENT)
+        params = (user.id, terms)
+    else:
+        query = """SELECT COUNT(*) FROM record_fts
+            JOIN record ON record.id = record_fts.rowid
+            WHERE record_fts MATCH {p} AND record.user_id = {p}""".format(p=p)
+        params = (match_expression(terms), user.id)
+    return database.execute_sql(query, params).fetchone()[0]
+
+
+def format_results(terms, page, records, more, per_page=10, width=200):
+    """Return a chat message listing search results."""
+    if not records:
+        if page > 1:
+            return "There are no more entries about \"{}\".".format(terms)
+        return "I couldn't find anything about \"{}\" in your diary.".format(
+            terms)
+
+    first = (page - 1) * per_page + 1
+    lines = ["Entries {}-{} about \"{}\":".format(
+        first, first + len(records) - 1, terms), ""]
+
+    for rec in records:
+        content = rec.content
+        if len(content) > width:
+            content = content[:width - 1] + "…"
+        lines.append("{}: {}".format(rec.created.strftime("%b %d, %Y"), content))
+        if rec.reaction:
+            lines.append("  > {}".format(rec.reaction))
+
+    if more:
+        lines += ["", "Send /search {} {} for more.".format(page + 1, terms)]
+    return "\n".join(lines)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Records collected by a coach over the course of a conversation."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from datetime import datetime, timedelta
+from playhouse.shortcuts import case
+
+from diary_peter.models import db, DailySummary, Record
+
+
+class RecordSession(object):
+    """A user's records of one kind from the current session.
+
+    Loads at most `size` records created within `window` and keeps track of
+    which ones were added or changed, so `save` only writes those.
+    """
+
+    def __init__(self, user, kind, size, window=timedelta(hours=24)):
+        """Load the session's records, oldest first."""
+        self.user = user
+        self.kind = kind
+
+        self.records = list(Record.select()
+            .where(
+                (Record.user == user) &
+                (Record.kind == kind) &
+                (Record.created >= datetime.now() - window))
+            .order_by(Record.created)
+            .limit(size))
+
+        self._new = []
+        self._reactions = {r.id: r.reaction for r in self.records}
+
+    def __len__(self):
+        """Return number of records in the session."""
+        return len(self.records)
+
+    def __getitem__(self, i):
+        """Return i-th record of the session."""
+        return self.records[i]
+
+    def __iter__(self):
+        """Iterate over the session's records."""
+        return iter(self.records)
+
+    def add(self, content, reaction=None):
+        """Add a new record to the session."""
+        rec = self.user.create_record(self.kind, content, reaction)
+        self.records.append(rec)
+        self._new.append(rec)
+        return rec
+
+    def changed(self):
+        """Return loaded records whose reaction was modified."""
+        return [r for r in self.records
+            if r.id in self._reactions and r.reaction != self._reactions[r.id]]
+
+    def save(self):
+        """Write new and modified records.
+
+        New records are inserted with a single statement and modified
+        reactions are updated with another, so the ids of new records are
+        not known afterwards. Call this once when done handling an update.
+        """
+        new, changed = self._new, self.changed()
+
+        with db.transaction():
+            if new:
+                Record.insert_batch([{
+                    "user": r.user.id,
+                    "kind": r.kind,
+                    "content": r.content,
+                    "reaction": r.reaction,
+                    "created": r.created
+                } for r in new])
+
+            if changed:
+                Record.update(reaction=case(Record.id,
+                    [(r.id, r.reaction) for r in changed])) \
+                    .where(Record.id << [r.id for r in changed]).execute()
+                DailySummary.add_reactions([r for r in changed
+                    if self._reactions[r.id] is None])
+
+        self._new = []
+        self._reactions.update((r.id, r.reaction) for r in changed)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""Run the bot as several processes, each owning a shard of the users.
+
+A supervisor starts one worker process per shard. The front router forwards
+every update to the worker that owns its user, which is the one with index
+`telegram_id % shards`. Workers keep their own database connections, caches,
+outbox and scheduler, and only fire the jobs of their own users.
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import logging
+import multiprocessing
+import telegram
+
+from threading import Event, Lock
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(telegram_id, shards):
+    """Return the index of the shard owning a Telegram user."""
+    return telegram_id % shards
+
+
+def in_shard(field, index, shards):
+    """Return a query expression matching rows of field in a shard.
+
+    Spelled out with integer division because peewee reads `%` as LIKE and
+    SQLite has no MOD function.
+    """
+    return (field - field / shards * shards) == index
+
+
+def update_user_id(update):
+    """Return the id of the Telegram user who sent update, or None."""
+    for attr in ("message", "callback_query", "inline_query",
+            "chosen_inline_result"):
+        obj = getattr(update, attr, None)
+        if obj is not None and getattr(obj, "from_user", None) is not None:
+            return obj.from_user.id
+    return None
+
+
+class Router(object):
+    """Forward updates to the queue of the shard owning their user.
+
+    Has the `put` method of an update queue, so a `WebhookServer` can feed it
+    directly. Updates without a user go to the first shard.
+    """
+
+    def __init__(self, queues):
+        """Init router for a list of per-shard queues."""
+        self.queues = queues
+        self.routed = [0] * len(queues)
+        self._lock = Lock()
+        self._stopped = Event()
+
+    def put(self, update):
+        """Forward an update as JSON."""
+        telegram_id = update_user_id(update)
+        index = 0 if telegram_id is None \
+            else shard_of(telegram_id, len(self.queues))
+        self.queues[index].put(update.to_json())
+        with self._lock:
+            self.routed[index] += 1
+
+    def poll(self, bot, timeout=10):
+        """Get updates from Telegram and route them until stopped."""
+        offset = 0
+        while not self._stopped.is_set():
+            try:
+                updates = bot.getUpdates(offset=offset, timeout=timeout)
+            except telegram.TelegramError as e:
+                logger.error("Polling failed: {}".format(e))
+                self._stopped.wait(1)
+                continue
+
+            for update in updates:
+                self.put(update)
+                offset = update.update_id + 1
+
+    def stop(self):
+        """Stop polling after the current request."""
+        self._stopped.set()
+
+
+def feed(updates, update_queue):
+    """Put updates received from the router on a local update queue.
+
+    Returns when the router sends None.
+    """
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        update_queue.put(telegram.Update.de_json(json.loads(data)))
+
+
+class Supervisor(object):
+    """Start a worker process per shard and restart those that die.
+
+    Workers are started as `target(index, shards, updates, *args)`, where
+    updates is the queue the router forwards the shard's updates to.
+    """
+
+    def __init__(self, target, shards, args=()):
+        """Init supervisor of shards worker processes."""
+        self.target = target
+        self.shards = shards
+        self.args = args
+        self.queues = [multiprocessing.Queue() for i in range(shards)]
+        self.processes = [None] * shards
+        self.restarts = 0
+
+    def start_worker(self, index):
+        """Start the worker process of a shard."""
+        proc = multiprocessing.Process(target=self.target,
+            args=(index, self.shards, self.queues[index]) + tuple(self.args),
+            name="shard-{}".format(index))
+        proc.start()
+        self.processes[index] = proc
+        logger.info("Started shard {} of {} as process {}".format(
+            index, self.shards, proc.pid))
+
+    def start(self):
+        """Start all worker processes."""
+        for index in range(self.shards):
+            self.start_worker(index)
+
+    def check(self):
+        """Restart worker processes that have exited."""
+        for index, proc in enumerate(self.processes):
+            if not proc.is_alive():
+                logger.error("Shard {} exited with code {}, restarting".format(
+                    index, proc.exitcode))
+                self.restarts += 1
+                self.start_worker(index)
+
+    def stop(self, timeout=10):
+        """Let workers finish their queued updates and wait for them."""
+        for q in self.queues:
+            q.put(None)
+        for proc in self.processes:
+            proc.join(timeout)
+            if proc.is_alive():
+                logger.warning("Terminating shard process {}".format(proc.pid))
+                proc.terminate()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+"""Save cached user state on shutdown to start warm the next time.
+
+The snapshot is a binary file: a header followed by one packed record per
+cached user. The header holds the number of users and jobs and their highest
+ids at shutdown. If the database doesn't match these on startup, the
+snapshot is discarded. Snapshots are deleted once they are read, so after a
+crash the bot starts cold instead of trusting old state.
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from datetime import time as dtime
+
+from peewee import fn
+
+from diary_peter.cache import user_cache
+from diary_peter.models import connection, Job, User
+
+logger = logging.getLogger(__name__)
+
+# Snapshot file written on shutdown, empty to disable snapshots
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "snapshot.bin")
+
+MAGIC = b"DPSNAP"
+VERSION = 1
+
+# Magic, version, time written, user count, highest user id, job count,
+# highest job id, number of records, CRC32 of the records
+HEADER = struct.Struct("<6sHdqqqqII")
+
+# id, telegram_id, state, flags, wake time in seconds or -1
+USER = struct.Struct("<qqiBi")
+STRING = struct.Struct("<H")
+NULL = 0xFFFF
+
+FLAGS = ("active", "intro_seen", "ask_mood", "ask_good_things", "ask_diary")
+STRINGS = ("name", "chat_id", "active_coach")
+
+
+def high_water():
+    """Return count and highest id of users and jobs."""
+    with connection():
+        users = User.select(fn.COUNT(User.id), fn.MAX(User.id)).tuples().get()
+        jobs = Job.select(fn.COUNT(Job.id), fn.MAX(Job.id)).tuples().get()
+    return tuple(v or 0 for v in users + jobs)
+
+
+def pack_user(data):
+    """Return the binary record of cached user data."""
+    flags = 0
+    for i, name in enumerate(FLAGS):
+        if data.get(name):
+            flags |= 1 << i
+
+    wake_time = data.get("wake_time")
+    seconds = -1 if wake_time is None else \
+        wake_time.hour * 3600 + wake_time.minute * 60 + wake_time.second
+
+    rv = [USER.pack(data["id"], data["telegram_id"], data.get("state") or 0,
+        flags, seconds)]
+    for name in STRINGS:
+        value = data.get(name)
+        if value is None:
+            rv.append(STRING.pack(NULL))
+        else:
+            value = str(value).encode("utf-8")
+            rv.append(STRING.pack(len(value)))
+            rv.append(value)
+    return b"".join(rv)
+
+
+def unpack_user(buf, offset):
+    """Return user data of the record at offset and the next offset."""
+    user_id, telegram_id, state, flags, seconds = USER.unpack_from(buf, offset)
+    offset += USER.size
+
+    rv = {
+        "id": user_id,
+        "telegram_id": telegram_id,
+        "state": state,
+        "wake_time": None if seconds < 0 else dtime(
+            seconds // 3600, seconds // 60 % 60, seconds % 60)
+    }
+    for i, name in enumerate(FLAGS):
+        rv[name] = bool(flags & 1 << i)
+    for name in STRINGS:
+        length, = STRING.unpack_from(buf, offset)
+        offset += STRING.size
+        if length == NULL:
+            rv[name] = None
+        else:
+            rv[name] = bytes(buf[offset:offset + length]).decode("utf-8")
+            offset += length
+    return rv, offset
+
+
+def write(path, cache=user_cache):
+    """Write cached users to a snapshot at path and return their number."""
+    items = cache.items()
+    records = b"".join(pack_user(data) for key, data in items)
+    header = HEADER.pack(MAGIC, VERSION, time.time(), *high_water(),
+        len(items), zlib.crc32(records))
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        fp.write(header)
+        fp.write(records)
+    os.replace(tmp, path)
+    logger.info("Wrote snapshot of {} users to {}".format(len(items), path))
+    return len(items)
+
+
+def load(path, cache=user_cache):
+    """Put the users of the snapshot at path into cache and delete it.
+
+    Returns the number of users loaded, 0 if there is no valid snapshot.
+    """
+    try:
+        fp = open(path, "rb")
+    except FileNotFoundError:
+        return 0
+
+    try:
+        with fp:
+            if os.fstat(fp.fileno()).st_size < HEADER.size:
+                logger.warning("Snapshot {} is truncated".format(path))
+                return 0
+
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                return _load(path, buf, cache)
+    finally:
+        os.remove(path)
+
+
+def _load(path, buf, cache):
+    magic, version, created, *marks, entries, crc = \
+        HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        logger.warning("Snapshot {} has unknown format {} {}".format(
+            path, magic, version))
+        return 0
+
+    if zlib.crc32(buf[HEADER.size:]) != crc:
+        logger.warning("Snapshot {} is corrupt".format(path))
+        return 0
+
+    if tuple(marks) != high_water():
+        logger.info("Database changed since snapshot {} was written".format(
+            path))
+        return 0
+
+    offset = HEADER.size
+    for i in range(entries):
+        data, offset = unpack_user(buf, offset)
+        cache.put(data["telegram_id"], data)
+
+    logger.info("Loaded {} users from snapshot {} written {:.0f}s ago".format(
+        entries, path, time.time() - created))
+    return entries
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Copy all rows from one database to another, e.g. SQLite to Postgres.
+
+Rows are read in batches ordered by id and written with one bulk statement
+per batch, or `COPY` on Postgres. The last copied id of each table is saved
+in the target database in the same transaction as its batch, so an
+interrupted transfer continues where it stopped.
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import datetime
+import hashlib
+import io
+import logging
+
+from peewee import Using
+
+from diary_peter.migrations import SchemaVersion, pending, stamp
+from diary_peter.models import DailySummary, Job, Record, User
+from diary_peter.search import create_index, is_postgres
+
+logger = logging.getLogger(__name__)
+
+# Tables in the order they are copied, referenced tables first
+MODELS = [User, Job, Record, DailySummary]
+
+PROGRESS_TABLE = "transfer_progress"
+
+
+def quote(database, name):
+    """Return name quoted for database."""
+    return database.compiler().quote(name)
+
+
+def read_batches(model, database, batch_size=10000, after=0):
+    """Yield lists of rows of model in database with an id above after.
+
+    Rows are tuples of Python values in the order of the model's fields.
+    """
+    fields = model._meta.sorted_fields
+    pk = fields.index(model._meta.primary_key)
+    with Using(database, [model], with_transaction=False):
+        while True:
+            batch = list(model.select(*fields)
+                .where(model._meta.primary_key > after)
+                .order_by(model._meta.primary_key)
+                .limit(batch_size)
+                .tuples())
+            if not batch:
+                break
+            yield batch
+            after = batch[-1][pk]
+
+
+def copy_value(value):
+    """Return value in the text format of Postgres' `COPY`."""
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    elif isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t") \
+        .replace("\n", "\\n").replace("\r", "\\r")
+
+
+def write_batch(database, model, rows):
+    """Insert rows as read by `read_batches` into database."""
+    fields = model._meta.sorted_fields
+    table = quote(database, model._meta.db_table)
+    columns = ", ".join(quote(database, f.db_column) for f in fields)
+    cursor = database.get_cursor()
+
+    if is_postgres(database):
+        buf = io.StringIO()
+        for row in rows:
+            buf.write("\t".join(copy_value(v) for v in row))
+            buf.write("\n")
+        buf.seek(0)
+        cursor.copy_expert("COPY {} ({}) FROM STDIN".format(table, columns),
+            buf)
+    else:
+        cursor.executemany("INSERT INTO {} ({}) VALUES ({})".format(
+            table, columns, ", ".join([database.interpolation] * len(fields))),
+            [[f.db_value(v) for f, v in zip(fields, row)] for row in rows])
+
+
+def create_progress_table(database):
+    """Create the table holding the last copied id per table."""
+    database.execute_sql("CREATE TABLE IF NOT EXISTS {} (name VARCHAR(64) "
+        "PRIMARY KEY, last_id BIGINT NOT NULL)".format(PROGRESS_TABLE))
+
+
+def get_progress(database, name):
+    """Return the last copied id of table name, 0 if none."""
+    p = database.interpolation
+    row = database.execute_sql("SELECT last_id FROM {} WHERE name = {}".format(
+        PROGRESS_TABLE, p), (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def set_progress(database, name, last_id):
+    """Save the last copied id of table name."""
+    p = database.interpolation
+    cursor = database.execute_sql("UPDATE {} SET last_id = {} WHERE name = {}"
+        .format(PROGRESS_TABLE, p, p), (last_id, name))
+    if cursor.rowcount == 0:
+        database.execute_sql("INSERT INTO {} (name, last_id) VALUES ({}, {})"
+            .format(PROGRESS_TABLE, p, p), (name, last_id))
+
+
+def reset_sequence(database, model):
+    """Continue the id sequence of a Postgres table after its copied rows."""
+    table = model._meta.db_table
+    pk = model._meta.primary_key.db_column
+    database.execute_sql("SELECT setval(pg_get_serial_sequence({p}, {p}), "
+        "COALESCE(MAX({pk}), 0) + 1, false) FROM {table}".format(
+            p=database.interpolation, pk=quote(database, pk),
+            table=quote(database, table)), (quote(database, table), pk))
+
+
+def transfer(source, target, models=MODELS, batch_size=10000):
+    """Copy models from source to target and return rows copied per table.
+
+    Tables are created in target if necessary. Call again after an
+    interruption to copy the remaining rows.
+    """
+    with Using(source, [SchemaVersion], with_transaction=False):
+        if pending():
+            raise ValueError("Source database is not fully migrated, run "
+                "migrate_database.py on it first")
+
+    with Using(target, models + [SchemaVersion], with_transaction=False):
+        target.create_tables(models, safe=True)
+    create_progress_table(target)
+
+    rv = {}
+    for model in models:
+        name = model._meta.db_table
+        after = get_progress(target, name)
+        if after:
+            logger.info("Resuming {} after id {}".format(name, after))
+
+        rv[name] = 0
+        for batch in read_batches(model, source, batch_size, after):
+            with target.transaction():
+                write_batch(target, model, batch)
+                set_progress(target, name,
+                    batch[-1][model._meta.sorted_fields.index(
+                        model._meta.primary_key)])
+            rv[name] += len(batch)
+            logger.info("Copied {} {} rows".format(rv[name], name))
+
+    # Indexing once at the end is faster than updating it for every batch
+    create_index(target)
+    with Using(target, [SchemaVersion], with_transaction=False):
+        stamp()
+    if is_postgres(target):
+        for model in models:
+            reset_sequence(target, model)
+    return rv
+
+
+def checksum(model, database, batch_size=10000):
+    """Return number of rows and a digest of their values."""
+    digest = hashlib.sha256()
+    count = 0
+    for batch in read_batches(model, database, batch_size):
+        count += len(batch)
+        for row in batch:
+            digest.update("\x1f".join("\x00" if v is None else str(v)
+                for v in row).encode("utf-8"))
+            digest.update(b"\x1e")
+    return count, digest.hexdigest()
+
+
+def verify(source, target, models=MODELS, batch_size=10000):
+    """Return names of tables whose rows differ between source and target."""
+    rv = []
+    for model in models:
+        name = model._meta.db_table
+        expected = checksum(model, source, batch_size)
+        actual = checksum(model, target, batch_size)
+        if expected != actual:
+            logger.error("{} differs: {} rows, {} in target".format(
+                name, expected[0], actual[0]))
+            rv.append(name)
+        else:
+            logger.info("{} matches: {} rows".format(name, expected[0]))
+    return rv
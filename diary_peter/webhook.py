@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""Receive updates from Telegram through a webhook instead of polling."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import logging
+import telegram
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accept POSTed update JSON on the server's secret path.
+
+    The body may contain a single update object or a list of updates.
+    """
+
+    def do_POST(self):
+        """Parse updates and put them on the server's update queue."""
+        if self.path.rstrip("/") != self.server.url_path:
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            data = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+
+        if isinstance(data, dict):
+            data = [data]
+
+        if not isinstance(data, list) or \
+                not all(isinstance(u, dict) for u in data):
+            self.send_error(400, "Expected an update or a list of updates")
+            return
+
+        try:
+            updates = [telegram.Update.de_json(u) for u in data]
+        except (AttributeError, KeyError, TypeError, ValueError):
+            self.send_error(400, "Invalid update")
+            return
+
+        for update in updates:
+            self.server.update_queue.put(update)
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        """Log requests to the module logger instead of stderr."""
+        logger.debug(format % args)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """HTTP server that feeds updates received on `url_path` into a queue."""
+
+    daemon_threads = True
+
+    def __init__(self, address, update_queue, secret):
+        """Init server listening on address, e.g. `('0.0.0.0', 8443)`."""
+        super().__init__(address, WebhookHandler)
+        self.update_queue = update_queue
+        self.url_path = "/" + secret.strip("/")
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thr = Thread(target=self.serve_forever, name="webhook")
+        thr.daemon = True
+        thr.start()
+        logger.info("Listening for updates on port {}".format(
+            self.server_address[1]))
+        return thr
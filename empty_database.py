@@ -19,7 +19,9 @@
 import peewee
 
 from logging import info, INFO, warning, basicConfig
-from diary_peter.models import db, Job, Record, User
+from diary_peter.models import db, DailySummary, Job, Record, User
+from diary_peter.migrations import SchemaVersion
+from diary_peter.search import drop_index
 
 if __name__ == '__main__':
     basicConfig(format='%(levelname)s\t%(message)s', level=INFO)
@@ -27,7 +29,8 @@ if __name__ == '__main__':
     info("Deleting database...")
     db.connect()
     try:
-        for m in [Job, Record, User]:
+        drop_index()
+        for m in [DailySummary, Job, Record, User, SchemaVersion]:
             m.drop_table()
     except peewee.OperationalError as e:
         warning("Oopsie.")
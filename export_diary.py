@@ -0,0 +1,48 @@
+#!/usr/bin/env/python
+
+"""Export the diary of a user."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import peewee
+import sys
+
+from logging import info, INFO, warning, basicConfig
+from diary_peter.export import FORMATS, export
+from diary_peter.models import connection, User
+
+if __name__ == '__main__':
+    basicConfig(format='%(levelname)s\t%(message)s', level=INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("telegram_id", type=int)
+    parser.add_argument("--format", choices=sorted(FORMATS), default="md")
+    parser.add_argument("--output", help="File to write, default is stdout")
+    args = parser.parse_args()
+
+    with connection():
+        try:
+            user = User.get(User.telegram_id == args.telegram_id)
+        except peewee.DoesNotExist:
+            warning("No user with telegram id {}".format(args.telegram_id))
+            sys.exit(1)
+
+        if args.output:
+            with open(args.output, "w", newline="", encoding="utf-8") as fp:
+                export(user, fp, args.format)
+            info("Done.")
+        else:
+            export(user, sys.stdout, args.format)
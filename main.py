@@ -25,13 +25,29 @@ the bot.
 
 import os
 import logging
+import signal
+import tempfile
+import telegram
 
+from functools import partial
+from threading import Event, Thread
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, \
     CallbackQueryHandler
 
-from diary_peter import coaches
-from diary_peter.models import db
-from diary_peter.jobs import restore_jobs
+from diary_peter import buffer, coaches, metrics, snapshot
+from diary_peter.dedup import SeenUpdates, DEDUP_PATH, DEDUP_SIZE
+from diary_peter.cache import user_cache
+from diary_peter.dispatch import PriorityWorkerPool, HIGH, NORMAL, LOW
+from diary_peter.fsm import Conversation
+from diary_peter.export import export, FORMATS
+from diary_peter.models import db, checkpoint, connection, pool_stats, User
+from diary_peter.search import search, format_results
+from diary_peter.shards import Router, Supervisor, feed
+from diary_peter.buffer import RecordBuffer
+from diary_peter.outbox import Outbox
+from diary_peter.jobs import Scheduler
+from diary_peter.metrics import Gauge, MetricsServer
+from diary_peter.webhook import WebhookServer
 
 __author__ = "Vincent Ahrend"
 __copyright__ = "Copyright 2016, Vincent Ahrend"
@@ -41,6 +57,12 @@ __email__ = "mail@vincentahrend.com"
 __status__ = "Development"
 
 job_queue = None
+worker_pool = None
+outbox = None
+seen_updates = None
+snapshot_path = None
+
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
 
 logging.basicConfig(
     format='%(asctime)s %(levelname) 8s\t%(name) 25s\t%(message)s',
@@ -49,45 +71,378 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def update_handler(bot, update):
-    """Handle updates by routing them to the appropriate coach."""
+def get_tguser(update):
+    """Return the Telegram user who sent an update."""
     try:
-        tguser = update.message.from_user
+        return update.message.from_user
     except AttributeError:
-        tguser = update.callback_query.from_user
+        return update.callback_query.from_user
+
+
+def dispatch_update(bot, update, handler=None):
+    """Queue update on the worker thread that owns the sending user.
+
+    Updates that were already delivered are dropped.
+    """
+    if seen_updates is not None and not seen_updates.add(update.update_id):
+        logger.info("Dropped duplicate update {}".format(update.update_id))
+        metrics.updates_duplicate.inc()
+        return
+
+    tguser = get_tguser(update)
+    level = priority(update)
+    worker_pool.submit(tguser.id, handler or update_handler, bot, update,
+        priority=level, on_shed=partial(shed_update, update, level))
+
+
+def priority(update):
+    """Return the priority class of an update, without database queries.
+
+    Button presses come first and users starting onboarding last.
+    """
+    if update.callback_query is not None:
+        return HIGH
+
+    text = update.message.text or ""
+    if text.startswith("/start"):
+        return LOW
+
+    data = user_cache.get(update.message.from_user.id)
+    if data is not None and data["active_coach"] == coaches.Setup.NAME \
+            and data["state"] == coaches.Setup.START:
+        return LOW
+    return NORMAL
+
+
+def shed_update(update, level):
+    """Ask the sender of an update that was shed to send it again."""
+    logger.warning("Shed update {} of priority {}".format(
+        update.update_id, level))
+    metrics.updates_shed.inc(priority=PRIORITY_NAMES[level])
+    outbox.bot.sendMessage(get_tguser(update).id,
+        text="Sorry, I'm a little overwhelmed right now. Please send that again in a few minutes.")
+
+
+def log_stats(bot):
+    """Log queue depth and latency of workers, outbox and database pool."""
+    for i, stats in enumerate(worker_pool.get_stats()):
+        logger.info("Worker {}: {}".format(i, stats))
+    logger.info("Outbox: {} queued, {} sent, {} failed, {} throttled".format(
+        outbox.depth(), outbox.sent, outbox.failed, outbox.throttled))
+    logger.info("Database pool: {}".format(pool_stats.as_dict()))
+
+
+def checkpoint_job(bot):
+    """Checkpoint the SQLite write-ahead log.
+
+    Passive checkpoints don't wait for readers and can fall behind while the
+    bot is busy, so the log is truncated once it has grown too large.
+    """
+    busy, log, checkpointed = checkpoint()
+    if log > int(os.environ.get("SQLITE_WAL_TRUNCATE_PAGES", 10000)):
+        busy, log, checkpointed = checkpoint(mode="TRUNCATE")
+        if busy:
+            logger.warning("Could not truncate the WAL, readers are busy")
+    logger.debug("Checkpointed {} of {} WAL pages".format(checkpointed, log))
 
-    coach_name = coaches.select(db, tguser)
-    coach_cls = getattr(coaches, coach_name)
-    coach = coach_cls(bot, db, tguser, job_queue)
 
-    logger.info("User {} entering {}:{}".format(
-        tguser.id, coach_name, coach.user.state))
-    coach.handle(update)
+def update_handler(bot, update):
+    """Handle updates by routing them to the appropriate coach."""
+    tguser = get_tguser(update)
+
+    with metrics.measure_update() as labels, connection():
+        conv = Conversation(outbox.bot, db, tguser, job_queue)
+        handler = coaches.registry.lookup(conv.user.active_coach, conv.user.state)
+
+        labels["coach"] = handler.coach.NAME
+        labels["state"] = handler.name
+        logger.info("User {} entering {}:{}".format(
+            tguser.id, handler.coach.NAME, handler.name))
+        with metrics.coach_latency.time(**labels):
+            coaches.registry.dispatch(conv, update, handler)
+
+
+def export_handler(bot, update):
+    """Send the user's diary as a file, e.g. `/export csv`."""
+    tguser = get_tguser(update)
+    args = update.message.text.split()[1:]
+    fmt = args[0].lower() if args else "md"
+    if fmt not in FORMATS:
+        outbox.bot.sendMessage(update.message.chat_id,
+            text="I can export your diary as {}.".format(
+                ", ".join(sorted(FORMATS))))
+        return
+
+    with connection():
+        user, created = User.tg_get_or_create(tguser)
+        with tempfile.NamedTemporaryFile("w+", suffix="." + fmt,
+                newline="", encoding="utf-8") as fp:
+            export(user, fp, fmt)
+            fp.flush()
+
+            logger.info("Exporting diary of user {} as {}".format(
+                tguser.id, fmt))
+            with open(fp.name, "rb") as document:
+                outbox.bot.sendDocument(update.message.chat_id,
+                    document=document, filename="diary." + fmt)
+
+
+def search_handler(bot, update):
+    """Send diary entries matching a search, e.g. `/search [page] beach`."""
+    tguser = get_tguser(update)
+    args = update.message.text.split()[1:]
+    page = 1
+    if len(args) > 1 and args[0].isdigit():
+        page = max(1, int(args.pop(0)))
+    terms = " ".join(args)
+
+    if not terms:
+        outbox.bot.sendMessage(update.message.chat_id,
+            text="What should I look for? Send me e.g. /search beach")
+        return
+
+    with connection():
+        user, created = User.tg_get_or_create(tguser)
+        records, more = search(user, terms, page)
+
+    outbox.bot.sendMessage(update.message.chat_id,
+        text=format_results(terms, page, records, more))
 
 
 def main():
     """Main loop."""
-    global job_queue
-
     token = os.environ.get("TG_TOKEN", False)
     if not token:
         print("TG_TOKEN environment variable not set")
         quit()
 
+    shards = int(os.environ.get("SHARDS", 1))
+    if shards > 1:
+        supervise(token, shards)
+    else:
+        serve(token)
+
+
+def setup(token, shard=None):
+    """Create the updater and start outbox, scheduler and workers.
+
+    With shard set to `(index, shards)` this process only handles the users
+    and jobs of that shard, and the send rate is split between the shards.
+    """
+    global job_queue, worker_pool, outbox, seen_updates, snapshot_path
+
+    index, shards = shard or (0, 1)
+
+    seen_updates = SeenUpdates(DEDUP_SIZE, shard_path(DEDUP_PATH, shard))
+
+    snapshot_path = shard_path(snapshot.SNAPSHOT_PATH, shard)
+    if snapshot_path is not None:
+        with connection():
+            snapshot.load(snapshot_path)
+
     updater = Updater(token)
     dp = updater.dispatcher
 
+    outbox = Outbox(updater.bot,
+        global_rate=float(os.environ.get("SEND_RATE", 30)) / shards,
+        chat_rate=float(os.environ.get("CHAT_SEND_RATE", 1)),
+        chat_burst=int(os.environ.get("CHAT_SEND_BURST", 3)))
+    outbox.start()
+
+    # Jobs send their prompts through the outbox as well
     job_queue = updater.job_queue
-    restore_jobs(job_queue)
+    job_queue.bot = outbox.bot
+    Scheduler(
+        batch_size=int(os.environ.get("SCHEDULER_BATCH_SIZE", 500)),
+        interval=float(os.environ.get("SCHEDULER_INTERVAL", 1)),
+        shard=shard
+    ).start(job_queue)
+
+    if os.environ.get("RECORD_BUFFER_MS", False):
+        buffer.record_buffer = RecordBuffer(
+            max_delay=float(os.environ["RECORD_BUFFER_MS"]) / 1000,
+            max_rows=int(os.environ.get("RECORD_BUFFER_ROWS", 100)))
+        buffer.record_buffer.start()
+
+    worker_pool = PriorityWorkerPool(
+        workers=int(os.environ.get("WORKERS", 4)),
+        queue_size=int(os.environ.get("WORKER_QUEUE_SIZE", 100)),
+        max_latency=float(os.environ.get("WORKER_MAX_LATENCY", 5)),
+        name="update-worker")
+    worker_pool.start()
+    job_queue.put(log_stats, 60)
+
+    if os.environ.get("METRICS_PORT", False):
+        Gauge("diary_outbox_depth", "Requests waiting in the outbox",
+            outbox.depth)
+        Gauge("diary_worker_queue_depth", "Updates waiting for a worker",
+            worker_pool.depth)
+        Gauge("diary_db_connections_in_use", "Pooled connections in use",
+            lambda: pool_stats.as_dict()["in_use"])
+        # Each shard serves its metrics on the next port
+        MetricsServer((os.environ.get("METRICS_LISTEN", "127.0.0.1"),
+            int(os.environ["METRICS_PORT"]) + index)).start()
+
+    if os.environ.get("SQLITE_PROFILE") == "production" and \
+            not os.environ.get("PG_PASS", False) and index == 0:
+        job_queue.put(checkpoint_job,
+            float(os.environ.get("SQLITE_CHECKPOINT_INTERVAL", 60)))
+
+    dp.add_handler(CommandHandler('start', dispatch_update))
+    dp.add_handler(CommandHandler('export',
+        partial(dispatch_update, handler=export_handler)))
+    dp.add_handler(CommandHandler('search',
+        partial(dispatch_update, handler=search_handler)))
+    dp.add_handler(MessageHandler([Filters.text], dispatch_update))
+    dp.add_handler(CallbackQueryHandler(dispatch_update))
+    return updater
+
+
+def shard_path(path, shard):
+    """Return the path of a shard's own copy of a file, None if path is empty."""
+    if not path:
+        return None
+    if shard is None:
+        return path
+    return "{}.{}".format(path, shard[0])
 
-    dp.add_handler(CommandHandler('start', update_handler))
-    dp.add_handler(MessageHandler([Filters.text], update_handler))
-    dp.add_handler(CallbackQueryHandler(update_handler))
 
-    updater.start_polling()
-    logger.info("Polling started")
+def teardown():
+    """Finish queued updates and messages."""
+    worker_pool.stop()
+    if buffer.record_buffer is not None:
+        buffer.record_buffer.stop()
+    outbox.stop()
+    seen_updates.close()
+    if snapshot_path is not None:
+        snapshot.write(snapshot_path)
 
-    updater.idle()
+
+def interrupt(signum, frame):
+    """Handle a signal like Ctrl-C, so cleanup in `finally` blocks runs."""
+    raise KeyboardInterrupt
+
+
+def serve(token):
+    """Receive and handle all updates in this process."""
+    updater = setup(token)
+
+    try:
+        if os.environ.get("WEBHOOK_URL", False):
+            start_webhook(updater)
+        else:
+            updater.start_polling()
+            logger.info("Polling started")
+            updater.idle()
+    finally:
+        teardown()
+
+
+def webhook_config():
+    """Return secret, public URL and listen address of the webhook.
+
+    Telegram is told to POST updates to `WEBHOOK_URL/WEBHOOK_SECRET`, which
+    should be forwarded to the local server on `WEBHOOK_PORT`.
+    """
+    secret = os.environ.get("WEBHOOK_SECRET", False)
+    if not secret:
+        print("WEBHOOK_SECRET environment variable not set")
+        quit()
+
+    url = "{}/{}".format(os.environ["WEBHOOK_URL"].rstrip("/"), secret)
+    address = (os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+        int(os.environ.get("WEBHOOK_PORT", 8443)))
+    return secret, url, address
+
+
+def start_webhook(updater):
+    """Receive updates through a webhook until interrupted."""
+    secret, url, address = webhook_config()
+
+    httpd = WebhookServer(address, updater.update_queue, secret)
+    dispatcher_thread = Thread(target=updater.dispatcher.start,
+        name="dispatcher")
+    dispatcher_thread.start()
+
+    updater.bot.setWebhook(webhook_url=url)
+    logger.info("Webhook started")
+
+    # Process managers stop the bot with SIGTERM. The handler runs on this
+    # thread, which is busy serving, so another thread has to stop it.
+    previous = signal.signal(signal.SIGTERM,
+        lambda signum, frame: Thread(target=httpd.shutdown).start())
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        httpd.server_close()
+        updater.stop()
+        updater.dispatcher.stop()
+        dispatcher_thread.join()
+
+
+def run_shard(index, shards, updates, token):
+    """Handle the updates the supervisor forwards to one shard."""
+    logger.info("Shard {} of {} starting".format(index, shards))
+    signal.signal(signal.SIGTERM, interrupt)
+    updater = setup(token, (index, shards))
+    dispatcher_thread = Thread(target=updater.dispatcher.start,
+        name="dispatcher")
+    dispatcher_thread.start()
+
+    try:
+        feed(updates, updater.update_queue)
+    except KeyboardInterrupt:
+        # The supervisor stops shards through their queues
+        feed(updates, updater.update_queue)
+    finally:
+        updater.stop()
+        updater.dispatcher.stop()
+        dispatcher_thread.join()
+        teardown()
+
+
+def supervise(token, shards):
+    """Route updates to shards worker processes until interrupted.
+
+    Each process owns the users whose `telegram_id % shards` equals its index.
+    Stops the shards on SIGTERM, otherwise they would keep running and firing
+    jobs without the supervisor.
+    """
+    stopping = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    supervisor = Supervisor(run_shard, shards, args=(token,))
+    supervisor.start()
+    router = Router(supervisor.queues)
+    bot = telegram.Bot(token)
+
+    httpd = None
+    if os.environ.get("WEBHOOK_URL", False):
+        secret, url, address = webhook_config()
+        httpd = WebhookServer(address, router, secret)
+        httpd.start()
+        bot.setWebhook(webhook_url=url)
+        logger.info("Webhook started, routing to {} shards".format(shards))
+    else:
+        Thread(target=router.poll, args=(bot,), name="router",
+            daemon=True).start()
+        logger.info("Polling started, routing to {} shards".format(shards))
+
+    try:
+        while not stopping.wait(1):
+            supervisor.check()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.stop()
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+        supervisor.stop()
+        logger.info("Routed updates per shard: {}".format(router.routed))
 
 if __name__ == '__main__':
     main()
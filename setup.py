@@ -26,7 +26,9 @@ setup(
     author="Vincent Ahrend",
     author_email="mail@vincentahrend.com",
     url="https://github.com/ciex/diary-peter/",
-    scripts=["main.py", "create_database.py"],
+    scripts=["main.py", "create_database.py", "migrate_database.py",
+        "export_diary.py", "backfill_summaries.py", "archive_records.py",
+        "transfer_database.py"],
     packages=["diary_peter"],
     license="Apache",
     description="A Conversational Diary",
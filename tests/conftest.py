@@ -15,7 +15,6 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-import os
 import pytest
 import telegram
 
@@ -24,7 +23,9 @@ from random import randint
 from telegram.ext import Updater
 from playhouse.test_utils import test_database
 
-from diary_peter.models import User, Record, Job
+from diary_peter.cache import user_cache
+from diary_peter.models import User, Record, Job, DailySummary
+from fakeapi import FakeBotAPI
 
 user_data = {
     'id': 4325497,
@@ -35,6 +36,12 @@ user_data = {
 }
 
 
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    """Make sure users cached by a previous test's database don't leak."""
+    user_cache.clear()
+
+
 @pytest.fixture(scope="module")
 def test_db():
     """Provide an in-memory database for testing."""
@@ -42,15 +49,24 @@ def test_db():
 
 
 @pytest.fixture
-def bot():
+def fake_api(request):
+    """Return a running fake Bot API server."""
+    api = FakeBotAPI()
+    api.start()
+    request.addfinalizer(api.stop)
+    return api
+
+
+@pytest.fixture
+def bot(fake_api):
     """Fixture that returns a Telegram for Python bot object."""
-    return telegram.Bot(os.environ.get('TG_TOKEN', None))
+    return telegram.Bot(fake_api.token, base_url=fake_api.base_url)
 
 
 @pytest.fixture
-def updater(request, scope="module"):
+def updater(request, fake_api):
     """Fixture that returns a Telegram Bot updater object."""
-    updater = Updater(os.environ.get("TG_TOKEN", False))
+    updater = Updater(fake_api.token, base_url=fake_api.base_url)
 
     def stop_updater():
         updater.stop()
@@ -79,6 +95,11 @@ def user(test_db):
 
 def custom_update(msg="Lol I just ate a whole tuna."):
     """Return a custom update."""
+    return telegram.Update.de_json(custom_update_data(msg))
+
+
+def custom_update_data(msg="Lol I just ate a whole tuna."):
+    """Return the JSON data of a custom update."""
     json = {
         'message_id': randint(40000, 50000),
         'from': user_data,
@@ -87,15 +108,19 @@ def custom_update(msg="Lol I just ate a whole tuna."):
         'text': msg
     }
 
-    rv = telegram.Update.de_json({
+    return {
         'update_id': randint(100000000, 200000000),
         'message': json
-    })
-    return rv
+    }
 
 
 def inline_query(data):
     """Return a custom inline query."""
+    return telegram.Update.de_json(inline_query_data(data))
+
+
+def inline_query_data(data):
+    """Return the JSON data of a custom inline query."""
     iq = {
         'id': randint(40000, 50000),
         'from': user_data,
@@ -117,17 +142,16 @@ def inline_query(data):
         'data': data
     }
 
-    rv = telegram.Update.de_json({
+    return {
         'update_id': randint(100000000, 200000000),
         'inline_query': iq,
         'callback_query': cq
-    })
-    return rv
+    }
 
 
 def create_users(db, num=10):
     """Utility func for creating users."""
-    with test_database(db, [User, Record, Job], fail_silently=True):
+    with test_database(db, [User, Record, Job, DailySummary], fail_silently=True):
         rv = []
         for i in range(num):
             rv.append(User.create_or_get(
@@ -135,4 +159,7 @@ def create_users(db, num=10):
                 name="User-{}".format(i),
                 chat_id=4325497 + i
             )[0])
-        return rv
+
+    # The users are dropped together with the test database
+    user_cache.clear()
+    return rv
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+
+"""Local stand-in for the Telegram Bot API.
+
+Serves the subset of methods the bot uses, records every call and can add
+latency, rate limit responses and failures, so coaches can be tested and
+benchmarked offline. Point a bot at it with
+`telegram.Bot(TOKEN, base_url=api.base_url)`.
+"""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import email
+import json
+import random
+import time
+
+from collections import defaultdict, deque
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Condition
+from urllib.parse import parse_qsl
+
+from diary_peter.outbox import TokenBucket
+
+TOKEN = "123456:FAKEfakeFAKEfakeFAKEfakeFAKEfake"
+
+BOT_USER = {
+    "id": 123456,
+    "first_name": "Diary Peter",
+    "username": "diarypete_bot"
+}
+
+
+class Call(object):
+    """A request received by the fake API."""
+
+    def __init__(self, method, params, status):
+        """Init call."""
+        self.method = method
+        self.params = params
+        self.status = status
+        self.time = time.monotonic()
+
+    def __repr__(self):
+        """Return readable representation."""
+        return "{}({}) -> {}".format(self.method, self.params, self.status)
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    """Answer `/bot<token>/<method>` requests."""
+
+    def do_POST(self):
+        """Handle a request with parameters in the body."""
+        length = int(self.headers.get("Content-Length", 0))
+        self.handle_method(self.parse_body(self.rfile.read(length)))
+
+    def do_GET(self):
+        """Handle a request with parameters in the query string."""
+        query = self.path.partition("?")[2]
+        self.handle_method(dict(parse_qsl(query)))
+
+    def parse_body(self, body):
+        """Return request parameters from a JSON, form or multipart body."""
+        ctype = self.headers.get("Content-Type", "")
+        if ctype.startswith("application/json"):
+            return json.loads(body.decode("utf-8") or "{}")
+        elif ctype.startswith("multipart/form-data"):
+            msg = email.message_from_bytes(
+                "Content-Type: {}\r\n\r\n".format(ctype).encode() + body)
+            rv = {}
+            for part in msg.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                filename = part.get_filename()
+                payload = part.get_payload(decode=True)
+                rv[name] = {"filename": filename, "size": len(payload)} \
+                    if filename else payload.decode("utf-8")
+            return rv
+        return dict(parse_qsl(body.decode("utf-8")))
+
+    def handle_method(self, params):
+        """Dispatch to the server and write its JSON response."""
+        prefix, _, method = self.path.partition("?")[0].rpartition("/")
+        if prefix != "/bot" + self.server.token:
+            status, body = 401, self.server.error(401, "Unauthorized")
+        else:
+            status, body = self.server.call(method, params)
+
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        """Don't log requests."""
+
+
+class FakeBotAPI(ThreadingMixIn, HTTPServer):
+    """Fake Bot API server.
+
+    Parameters:
+        address: Address to listen on, port 0 picks a free port
+        latency: Seconds to wait before answering each request, or a
+            function returning the seconds for a method
+        error_rate: Fraction of requests answered with a 500 error
+        chat_rate: Sustained messages per second and chat before 429
+            responses are returned, None disables rate limiting
+        chat_burst: Messages a chat may receive back-to-back
+        retry_after: Seconds 429 responses ask the client to wait
+        seed: Seed for the random error injection
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), token=TOKEN, latency=0,
+            error_rate=0, chat_rate=None, chat_burst=3, retry_after=1,
+            seed=None):
+        """Init server, call `start` to begin serving."""
+        super().__init__(address, FakeBotAPIHandler)
+        self.token = token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retry_after = retry_after
+
+        # Every request, including failed ones
+        self.calls = []
+        self.webhook_url = ""
+        self._failures = defaultdict(deque)
+        self._buckets = {}
+        self._updates = []
+        self._update_ids = 0
+        self._message_ids = 0
+        self._random = random.Random(seed)
+        self._cond = Condition()
+
+    @property
+    def base_url(self):
+        """Return the base URL to pass to `telegram.Bot`."""
+        return "http://{}:{}/bot".format(*self.server_address[:2])
+
+    def start(self):
+        """Serve requests in a background thread."""
+        # Poll often so tests don't wait for `stop`
+        thr = Thread(target=self.serve_forever, args=(0.01,),
+            name="fake-bot-api")
+        thr.daemon = True
+        thr.start()
+        return thr
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        with self._cond:
+            self._cond.notify_all()
+        self.shutdown()
+        self.server_close()
+
+    def sent(self, method="sendMessage"):
+        """Return the parameters of all successful calls of method."""
+        with self._cond:
+            return [c.params for c in self.calls
+                if c.method == method and c.status == 200]
+
+    def fail_next(self, method, status=500, description="Internal Server Error",
+            retry_after=None):
+        """Answer the next call of method with an error."""
+        with self._cond:
+            self._failures[method].append((status, description, retry_after))
+
+    def push_update(self, data):
+        """Make an update available to `getUpdates`.
+
+        Assigns an update id above all ids pushed so far if data doesn't
+        have one.
+        """
+        with self._cond:
+            if "update_id" not in data:
+                data = dict(data, update_id=self._update_ids + 1)
+            self._update_ids = max(self._update_ids, data["update_id"])
+            self._updates.append(data)
+            self._cond.notify_all()
+
+    def error(self, status, description, retry_after=None):
+        """Return the body of an error response."""
+        rv = {"ok": False, "error_code": status, "description": description}
+        if retry_after is not None:
+            rv["parameters"] = {"retry_after": retry_after}
+        return rv
+
+    def call(self, method, params):
+        """Return status and body of the response to a method call."""
+        status, body = self._respond(method, params)
+        with self._cond:
+            self.calls.append(Call(method, params, status))
+        return status, body
+
+    def _respond(self, method, params):
+        latency = self.latency(method) if callable(self.latency) \
+            else self.latency
+        if latency:
+            time.sleep(latency)
+
+        with self._cond:
+            if self._failures[method]:
+                status, description, retry_after = \
+                    self._failures[method].popleft()
+                return status, self.error(status, description, retry_after)
+
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 500, self.error(500, "Internal Server Error")
+
+            if method == "sendMessage" and self.chat_rate:
+                now = time.monotonic()
+                bucket = self._buckets.setdefault(str(params.get("chat_id")),
+                    TokenBucket(self.chat_rate, self.chat_burst))
+                if bucket.delay(now):
+                    return 429, self.error(429, "Too Many Requests: retry "
+                        "after {}".format(self.retry_after), self.retry_after)
+                bucket.take(now)
+
+        handler = getattr(self, "method_" + method, None)
+        if handler is None:
+            return 404, self.error(404, "Not Found: method not found")
+
+        status, result = handler(params)
+        if status == 200:
+            return 200, {"ok": True, "result": result}
+        return status, self.error(status, result)
+
+    def message(self, params, **fields):
+        """Return a message sent by the bot."""
+        with self._cond:
+            self._message_ids += 1
+            message_id = self._message_ids
+
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except ValueError:
+            pass
+        rv = {
+            "message_id": message_id,
+            "from": BOT_USER,
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time())
+        }
+        rv.update(fields)
+        return rv
+
+    def method_getMe(self, params):
+        """Return the bot user."""
+        return 200, BOT_USER
+
+    def method_getUpdates(self, params):
+        """Return updates from offset, waiting up to timeout seconds."""
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 100))
+        deadline = time.monotonic() + min(float(params.get("timeout", 0)), 5)
+
+        with self._cond:
+            if self.webhook_url:
+                return 409, "Conflict: can't use getUpdates method while " \
+                    "webhook is active"
+            while True:
+                rv = [u for u in self._updates if u["update_id"] >= offset]
+                remaining = deadline - time.monotonic()
+                if rv or remaining <= 0:
+                    return 200, rv[:limit]
+                self._cond.wait(remaining)
+
+    def method_sendMessage(self, params):
+        """Return the sent message."""
+        if not params.get("chat_id") or not params.get("text"):
+            return 400, "Bad Request: message text is empty"
+        return 200, self.message(params, text=params["text"])
+
+    def method_sendDocument(self, params):
+        """Return the sent document message."""
+        document = params.get("document")
+        name = document.get("filename") if isinstance(document, dict) \
+            else params.get("filename")
+        return 200, self.message(params, document={
+            "file_id": "file{}".format(len(self.calls)),
+            "file_name": name})
+
+    def method_answerCallbackQuery(self, params):
+        """Acknowledge the callback query."""
+        if not params.get("callback_query_id"):
+            return 400, "Bad Request: query id is empty"
+        return 200, True
+
+    def method_setWebhook(self, params):
+        """Set or remove the webhook URL."""
+        self.webhook_url = params.get("url", "")
+        return 200, True
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""Tests for archiving old records."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import io
+import pytest
+
+from datetime import datetime, timedelta
+from playhouse.test_utils import test_database
+
+from diary_peter import archive
+from diary_peter.export import export, iter_records
+from diary_peter.models import User, Record, DailySummary
+from diary_peter.search import create_index, search
+
+
+@pytest.fixture
+def archive_path(tmpdir, monkeypatch):
+    """Archive records into a temporary directory."""
+    monkeypatch.setattr(archive, "ARCHIVE_PATH", str(tmpdir))
+    return str(tmpdir)
+
+
+def add_record(user, content, created):
+    """Save a record of user created at a given time."""
+    rec = user.create_record("text", content)
+    rec.created = created
+    rec.save()
+    return rec
+
+
+class TestArchive():
+    """Tests for the record archive."""
+
+    def test_archive(self, test_db, user, archive_path):
+        """Test that old records move into monthly segments."""
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            user.save(force_insert=True)
+            add_record(user, "July", datetime(2016, 7, 31, 23, 59))
+            add_record(user, "August", datetime(2016, 8, 1, 8, 15, 30, 12))
+            add_record(user, "August again", datetime(2016, 8, 2))
+            add_record(user, "Today", datetime.now())
+
+            before = datetime.now() - timedelta(days=1)
+            assert archive.archive(before) == 3
+            assert [r.content for r in Record.select()] == ["Today"]
+
+            index = archive.read_index(user.id)
+            assert sorted(index) == ["2016-07", "2016-08"]
+            assert index["2016-08"]["records"] == 2
+
+            # Archiving again only adds new records
+            add_record(user, "Late", datetime(2016, 8, 3))
+            assert archive.archive(before) == 1
+            assert [r.content for r in archive.archived_records(user)] == \
+                ["July", "August", "August again", "Late"]
+            assert list(archive.archived_records(user))[1].created == \
+                datetime(2016, 8, 1, 8, 15, 30, 12)
+
+            # Archived records are still part of the daily summaries
+            assert DailySummary.select().count() == 5
+
+    def test_rebuild(self, test_db, user, archive_path):
+        """Test that rebuilding summaries counts archived records."""
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            user.save(force_insert=True)
+            for content, created in [
+                    ("July", datetime(2016, 7, 31, 23, 59)),
+                    ("Morning", datetime(2016, 8, 2, 8)),
+                    ("Evening", datetime(2016, 8, 2, 18)),
+                    ("Today", datetime.now())]:
+                Record.create(user=user, kind="text", content=content,
+                    created=created)
+
+            def summaries():
+                return [(s.date, s.entries, s.text_entries, s.first_entry,
+                    s.last_entry) for s in
+                    DailySummary.select().order_by(DailySummary.date)]
+
+            expected = summaries()
+            assert len(expected) == 3
+
+            # Splits the records of August 2nd
+            assert archive.archive(datetime(2016, 8, 2, 12)) == 2
+            assert DailySummary.rebuild([user.id],
+                archive.archived_rows([user.id])) == 3
+            assert summaries() == expected
+
+    def test_export(self, test_db, user, archive_path):
+        """Test that exports include archived records."""
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            user.save(force_insert=True)
+            add_record(user, "Old", datetime(2016, 7, 1))
+            add_record(user, "New", datetime.now())
+            archive.archive(datetime.now() - timedelta(days=1))
+
+            assert [r.content for r in iter_records(user)] == ["Old", "New"]
+
+            fp = io.StringIO()
+            export(user, fp, "jsonl")
+            assert len(fp.getvalue().splitlines()) == 2
+
+    def test_search(self, test_db, user, archive_path):
+        """Test that archived records are found after the others."""
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            create_index(test_db)
+            user.save(force_insert=True)
+            for i in range(3):
+                add_record(user, "Walked {}".format(i), datetime(2016, 7, i + 1))
+            add_record(user, "Walking today", datetime.now())
+            add_record(user, "Resting", datetime.now())
+            archive.archive(datetime.now() - timedelta(days=1))
+
+            records, more = search(user, "walk", page=1, per_page=2)
+            assert [r.content for r in records] == \
+                ["Walking today", "Walked 2"]
+            assert more
+
+            records, more = search(user, "walk", page=2, per_page=2)
+            assert [r.content for r in records] == ["Walked 1", "Walked 0"]
+            assert not more
+
+            assert search(user, "resting walk")[0] == []
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""Tests for the record write buffer."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+import time
+
+from peewee import SqliteDatabase
+from playhouse.test_utils import test_database
+
+from diary_peter.buffer import RecordBuffer
+from diary_peter.models import User, Record, DailySummary
+
+
+@pytest.fixture
+def file_db(tmpdir):
+    """Provide a database that is shared with the buffer's thread."""
+    return SqliteDatabase(str(tmpdir.join("buffer.db")))
+
+
+class TestRecordBuffer():
+    """Tests for the record buffer."""
+
+    def test_max_rows(self, file_db, user):
+        """Test that a full batch is written without waiting."""
+        with test_database(file_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            buf = RecordBuffer(max_delay=60, max_rows=10)
+            buf.start()
+
+            futures = [buf.add(user, "text", "Entry {}".format(i))
+                for i in range(10)]
+
+            assert all(f.result(5) for f in futures)
+            assert Record.select().count() == 10
+            assert buf.flushes == 1
+            buf.stop()
+
+    def test_max_delay(self, file_db, user):
+        """Test that a partial batch is written after the delay."""
+        with test_database(file_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            buf = RecordBuffer(max_delay=0.05, max_rows=100)
+            buf.start()
+
+            started = time.monotonic()
+            assert buf.add(user, "text", "Entry").result(5)
+            assert time.monotonic() - started >= 0.05
+
+            rec = Record.get()
+            assert rec.user == user
+            assert rec.content == "Entry"
+            buf.stop()
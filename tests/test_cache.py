@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""Tests for Diary Peter caches."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+from playhouse.test_utils import test_database
+
+from diary_peter.cache import LRUCache, user_cache
+from diary_peter.models import CountingSqliteDatabase, User
+
+
+class TestLRUCache():
+    """Tests for the LRU cache."""
+
+    def test_eviction(self):
+        """Test that the least recently used entry is evicted first."""
+        cache = LRUCache(maxsize=2, ttl=None)
+        cache.put(1, "a")
+        cache.put(2, "b")
+        cache.get(1)
+        cache.put(3, "c")
+
+        assert cache.get(1) == "a"
+        assert cache.get(2) is None
+        assert cache.get(3) == "c"
+
+    def test_ttl(self):
+        """Test that expired entries are not returned."""
+        cache = LRUCache(maxsize=2, ttl=-1)
+        cache.put(1, "a")
+
+        assert cache.get(1) is None
+        assert len(cache) == 0
+
+
+class TestUserCache():
+    """Tests for caching of user lookups."""
+
+    def test_write_through(self, test_db, tguser):
+        """Test that saved changes are visible to cached lookups."""
+        with test_database(test_db, [User], fail_silently=True):
+            user, created = User.tg_get_or_create(tguser)
+            assert created
+
+            user.state = 3
+            user.active_coach = "Menu"
+            user.save()
+
+            # Change the row behind the cache's back
+            User.update(state=4).where(User.id == user.id).execute()
+
+            cached, created = User.tg_get_or_create(tguser)
+            assert not created
+            assert cached.state == 3
+            assert cached.active_coach == "Menu"
+
+            user_cache.invalidate(tguser.id)
+            reloaded, created = User.tg_get_or_create(tguser)
+            assert reloaded.state == 4
+
+    def test_transaction(self, tmpdir, tguser):
+        """Test that the cache only sees committed saves."""
+        database = CountingSqliteDatabase(str(tmpdir.join("cache.db")),
+            check_same_thread=False)
+        with test_database(database, [User]):
+            user, created = User.tg_get_or_create(tguser)
+
+            with pytest.raises(RuntimeError):
+                with database.transaction():
+                    user.state = 4
+                    user.save()
+                    raise RuntimeError("Rolled back")
+            assert User.from_cache(tguser.id).state == 0
+
+            with database.transaction():
+                user.state = 5
+                user.save()
+                assert User.from_cache(tguser.id).state == 0
+            assert User.from_cache(tguser.id).state == 5
+
+            # Outside of a transaction saves are written through at once
+            user.state = 6
+            user.save()
+            assert User.from_cache(tguser.id).state == 6
@@ -19,26 +19,28 @@ import pytest
 import telegram
 import peewee
 
+from datetime import datetime
 from playhouse.test_utils import test_database
 from telegram.emoji import Emoji
 
 from conftest import custom_update, inline_query
-from diary_peter.coaches import Setup, Coach, Menu, Gratitude
-from diary_peter.models import db, User, Record, Job
+from diary_peter.coaches import Setup, Menu, Gratitude, registry
+from diary_peter.fsm import Conversation
+from diary_peter.models import db, User, Record, Job, DailySummary
 
 
-class TestBaseCoach:
-    """Test base class."""
+class TestConversation:
+    """Test the data passed to coaches."""
 
     def test_init(self, bot, tguser, test_db, updater):
-        """Test initialization of the base coach class."""
+        """Test initialization of a conversation."""
         with test_database(test_db, [User], fail_silently=True):
-            coach = Coach(bot, test_db, tguser, updater.job_queue)
+            conv = Conversation(bot, test_db, tguser, updater.job_queue)
 
-            assert isinstance(coach.bot, telegram.Bot)
-            assert isinstance(coach.db, peewee.Database)
-            assert isinstance(coach.user, User)
-            assert isinstance(coach.tguser, telegram.user.User)
+            assert isinstance(conv.bot, telegram.Bot)
+            assert isinstance(conv.db, peewee.Database)
+            assert isinstance(conv.user, User)
+            assert isinstance(conv.tguser, telegram.user.User)
 
 
 class TestMenu:
@@ -63,14 +65,14 @@ class TestMenu:
 
     def test_handle(self, bot, menu_update, test_db, tguser, updater):
         """Test display of main menu."""
-        with test_database(test_db, [User, Record], fail_silently=True):
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
             with db.transaction():
                 user, created = User.tg_get_or_create(tguser)
                 user.state = menu_update.states[0]
                 user.save()
 
-            coach = Menu(bot, db, tguser, updater.job_queue)
-            msgs = coach.handle(menu_update)
+            conv = Conversation(bot, db, tguser, updater.job_queue)
+            msgs = registry.coach(Menu.NAME).handle(conv, menu_update)
 
             assert len(msgs) > 0
 
@@ -78,14 +80,15 @@ class TestMenu:
         """Test diary entry from main menu."""
         diary_entry = "My secret diary."
 
-        with test_database(test_db, [User, Record], fail_silently=True):
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
             with db.transaction():
                 user, created = User.tg_get_or_create(tguser)
                 user.state = Menu.AWAITING_DIARY_ENTRY
                 user.save()
 
-            coach = Menu(bot, db, tguser, updater.job_queue)
-            msgs = coach.handle(custom_update(msg=diary_entry))
+            conv = Conversation(bot, db, tguser, updater.job_queue)
+            msgs = registry.coach(Menu.NAME).handle(conv,
+                custom_update(msg=diary_entry))
 
             assert len(msgs) == 1
 
@@ -125,8 +128,9 @@ class TestSetup:
                 user.state = setup_update.states[0]
                 user.save()
 
-            coach = Setup(bot, test_db, setup_update.message.from_user, updater.job_queue)
-            messages = coach.handle(setup_update)
+            conv = Conversation(bot, test_db, setup_update.message.from_user,
+                updater.job_queue)
+            messages = registry.coach(Setup.NAME).handle(conv, setup_update)
 
             user, created = User.tg_get_or_create(
                 setup_update.message.from_user)
@@ -164,8 +168,9 @@ class TestSetup:
                 user.state = coach_query.states[0]
                 user.save()
 
-            coach = Setup(bot, test_db, query.message.from_user, updater.job_queue)
-            messages = coach.handle(coach_query)
+            conv = Conversation(bot, test_db, query.message.from_user,
+                updater.job_queue)
+            messages = registry.coach(Setup.NAME).handle(conv, coach_query)
 
             user = User.get(User.telegram_id == user.telegram_id)
 
@@ -189,20 +194,43 @@ class TestGratitude:
 
     def test_init(self, gratitudes, bot, tguser, test_db, updater):
         """Test that current gratitudes are collected in init."""
-        with test_database(test_db, [User, Record], fail_silently=True):
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
             for g in gratitudes:
                 g.save()
-            gc = Gratitude(bot, db, tguser, updater.job_queue)
+            conv = Conversation(bot, db, tguser, updater.job_queue)
 
-            assert len(gc.collector) == len(gratitudes)
+            assert len(registry.coach(Gratitude.NAME).collector(conv)) == \
+                len(gratitudes)
 
     def test_setup(self, user, bot, test_db, tguser, updater):
         """Test the setup method."""
-        with test_database(test_db, [User, Record, Job], fail_silently=True):
-            sc = Setup(bot, test_db, tguser, updater.job_queue)
-            Gratitude.setup(sc)
+        with test_database(test_db, [User, Record, Job, DailySummary], fail_silently=True):
+            conv = Conversation(bot, test_db, tguser, updater.job_queue)
+            registry.coach(Gratitude.NAME).setup(conv)
 
-            assert not updater.job_queue.queue.empty()
+            job = Job.get(Job.user == conv.user)
+            assert job.next_run_at > datetime.now()
+
+    def test_session(self, bot, test_db, tguser, updater):
+        """Test that a diary entry after a full session is saved."""
+        with test_database(test_db, [User, Record, Job, DailySummary], fail_silently=True):
+            user, created = User.tg_get_or_create(tguser)
+            user.active_coach = Gratitude.NAME
+            user.state = Gratitude.AWAITING_GRATITUDE
+            user.save()
+
+            for msg in ["g1", "g2", "g3", "r1", "r2", "r3"]:
+                registry.dispatch(Conversation(bot, test_db, tguser,
+                    updater.job_queue), custom_update(msg))
+
+            user = User.get(User.id == user.id)
+            assert (user.active_coach, user.state) == \
+                (Menu.NAME, Menu.AWAITING_DIARY_ENTRY)
+
+            registry.dispatch(Conversation(bot, test_db, tguser,
+                updater.job_queue), custom_update("my diary entry"))
+            assert Record.select().where(Record.user == user,
+                Record.content == "my diary entry").count() == 1
 
     @pytest.fixture(params=[Gratitude.AWAITING_GRATITUDE, Gratitude.AWAITING_REASONS])
     def gratitude_states(self, request, gratitudes):
@@ -211,7 +239,7 @@ class TestGratitude:
 
     def test_handle(self, bot, test_db, tguser, updater, update, gratitude_states):
         """Test the handle that collects records from the user."""
-        with test_database(test_db, [User, Record, Job], fail_silently=True):
+        with test_database(test_db, [User, Record, Job, DailySummary], fail_silently=True):
             user, created = User.tg_get_or_create(tguser)
             user.active_coach = Gratitude.NAME
             user.state = gratitude_states[0]
@@ -229,16 +257,17 @@ class TestGratitude:
                     g.save()
                 user.save()
 
-            g = Gratitude(bot, test_db, tguser, updater.job_queue)
-            g.handle(update)
+            g = registry.coach(Gratitude.NAME)
+            g.handle(Conversation(bot, test_db, tguser, updater.job_queue),
+                update)
 
             # Reload from disk
-            g = Gratitude(bot, test_db, tguser, updater.job_queue)
-            user = User.get(User.id == g.user.id)
+            conv = Conversation(bot, test_db, tguser, updater.job_queue)
+            user = User.get(User.id == conv.user.id)
 
             if user.state == Gratitude.AWAITING_GRATITUDE:
                 if len(gratitude_states[1]) < 3:
-                    assert len(g.collector) == len(gratitude_states[1]) + 1
+                    assert len(g.collector(conv)) == len(gratitude_states[1]) + 1
             # else:
             #     assert g.collector[-1].reaction is not None
 
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Tests for dropping duplicate updates."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+
+from diary_peter.dedup import SeenUpdates
+
+
+class TestSeenUpdates:
+    """Tests for the bounded set of seen update ids."""
+
+    def test_add(self):
+        """Test that only the most recent ids are remembered."""
+        seen = SeenUpdates(3)
+        assert all(seen.add(i) for i in (10, 11, 12))
+        assert not seen.add(11)
+        assert seen.duplicates == 1
+
+        assert seen.add(13)
+        assert 10 not in seen
+        assert seen.ids() == [11, 12, 13]
+        assert len(seen) == 3
+
+        # Forgotten ids count as new
+        assert seen.add(10)
+
+    def test_persist(self, tmpdir):
+        """Test that seen ids survive a restart."""
+        path = str(tmpdir.join("seen.bin"))
+        seen = SeenUpdates(4, path)
+        for i in range(6):
+            seen.add(100 + i)
+        seen.close()
+
+        # A crash may leave a partly written id behind
+        with open(path, "ab") as fp:
+            fp.write(b"\x01\x02")
+
+        seen = SeenUpdates(4, path)
+        assert seen.ids() == [102, 103, 104, 105]
+        assert not seen.add(105)
+        assert seen.add(101)
+        seen.close()
+
+    def test_compact(self, tmpdir):
+        """Test that the journal doesn't grow without bounds."""
+        path = str(tmpdir.join("seen.bin"))
+        seen = SeenUpdates(5, path)
+        for i in range(100):
+            seen.add(i)
+        seen.close()
+
+        assert os.path.getsize(path) < 2 * 5 * 8
+        assert SeenUpdates(5, path).ids() == list(range(95, 100))
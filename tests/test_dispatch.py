@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""Tests for the update worker pool."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+
+from collections import defaultdict
+from threading import Event
+
+from diary_peter.dispatch import OrderedWorkerPool, PriorityWorkerPool, \
+    LaneQueue, HIGH, NORMAL, LOW
+
+
+class TestOrderedWorkerPool():
+    """Tests for the ordered worker pool."""
+
+    def test_order(self):
+        """Test that tasks with the same key run in submission order."""
+        seen = defaultdict(list)
+        pool = OrderedWorkerPool(workers=4, queue_size=0)
+        pool.start()
+
+        for i in range(100):
+            for key in range(10):
+                pool.submit(key, seen[key].append, i)
+        pool.stop()
+
+        for key in range(10):
+            assert seen[key] == list(range(100))
+
+        stats = pool.get_stats()
+        assert sum(s["processed"] for s in stats) == 1000
+
+    def test_parallel(self):
+        """Test that a blocked key doesn't hold up other keys."""
+        release = Event()
+        done = Event()
+        pool = OrderedWorkerPool(workers=2, queue_size=0)
+        pool.start()
+
+        pool.submit(0, release.wait, 5)
+        pool.submit(1, done.set)
+
+        assert done.wait(5)
+        release.set()
+        pool.stop()
+
+    def test_reject(self):
+        """Test that tasks are rejected when a queue is full."""
+        release = Event()
+        pool = OrderedWorkerPool(workers=1, queue_size=1, put_timeout=0)
+        pool.start()
+
+        pool.submit(0, release.wait, 5)
+        time.sleep(0.1)
+        assert pool.submit(0, time.sleep, 0)
+        assert not pool.submit(0, time.sleep, 0)
+        assert pool.get_stats()[0]["rejected"] == 1
+
+        release.set()
+        pool.stop()
+
+
+class TestLaneQueue():
+    """Tests for the priority queue with ordered lanes."""
+
+    def test_order(self):
+        """Test that important lanes go first and lanes stay in order."""
+        q = LaneQueue()
+        q.put("a1", "a", LOW)
+        q.put("b1", "b", NORMAL)
+        q.put("a2", "a", HIGH)
+        q.put("c1", "c", HIGH)
+        q.put(None)
+
+        assert [q.get() for i in range(5)] == ["c1", "b1", "a1", "a2", None]
+        assert q.qsize() == 0
+
+    def test_shed(self):
+        """Test that a full queue sheds its least important item."""
+        q = LaneQueue(maxsize=3)
+        assert q.put("a1", "a", NORMAL) is None
+        assert q.put("b1", "b", LOW) is None
+        assert q.put("b2", "b", LOW) is None
+
+        # Only the last item of a lane can be shed
+        assert q.put("c1", "c", HIGH) == "b2"
+        assert q.put("d1", "d", LOW) == "d1"
+        assert q.put("e1", "e", NORMAL) == "b1"
+        assert q.put("f1", "f", NORMAL) == "f1"
+
+        # Stopping is never refused
+        assert q.put(None) is None
+        assert [q.get() for i in range(4)] == ["c1", "a1", "e1", None]
+
+
+class TestPriorityWorkerPool():
+    """Tests for the worker pool that sheds load."""
+
+    def test_shed(self):
+        """Test serving by priority and shedding when full."""
+        release = Event()
+        ran = []
+        shed = []
+        pool = PriorityWorkerPool(workers=1, queue_size=2)
+        pool.start()
+
+        pool.submit(0, release.wait, 5)
+        time.sleep(0.1)
+        assert pool.submit(1, ran.append, "low", priority=LOW,
+            on_shed=lambda: shed.append("low"))
+        assert pool.submit(2, ran.append, "normal")
+        assert pool.submit(3, ran.append, "high", priority=HIGH)
+        assert not pool.submit(4, ran.append, "low", priority=LOW,
+            on_shed=lambda: shed.append("new"))
+
+        release.set()
+        pool.stop()
+
+        assert ran == ["high", "normal"]
+        assert shed == ["low", "new"]
+        assert pool.shed == [0, 0, 2]
+        assert pool.get_stats()[0]["rejected"] == 2
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Tests for diary exports."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import csv
+import io
+import json
+import pytest
+
+from datetime import datetime
+from playhouse.test_utils import test_database
+
+from diary_peter.export import export, iter_records
+from diary_peter.models import User, Record, DailySummary
+
+
+def add_records(user, created, count):
+    """Save count records of user with the same creation time."""
+    for i in range(count):
+        rec = user.create_record("text", "Entry {}".format(i))
+        rec.created = created
+        rec.save()
+
+
+class TestExport():
+    """Tests for diary exports."""
+
+    def test_iter_records(self, test_db, user):
+        """Test that batches don't skip records with equal timestamps."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            add_records(user, datetime(2016, 8, 1, 9), 5)
+            add_records(user, datetime(2016, 8, 2, 9), 2)
+
+            records = list(iter_records(user, batch_size=2))
+
+            assert len(records) == 7
+            assert len(set(r.id for r in records)) == 7
+            assert records == sorted(records,
+                key=lambda r: (r.created, r.id))
+
+    def test_jsonl(self, test_db, user):
+        """Test JSON lines export."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            add_records(user, datetime(2016, 8, 1, 9), 2)
+
+            fp = io.StringIO()
+            export(user, fp, "jsonl")
+
+            rows = [json.loads(l) for l in fp.getvalue().splitlines()]
+            assert [r["content"] for r in rows] == ["Entry 0", "Entry 1"]
+            assert rows[0]["created"] == "2016-08-01T09:00:00"
+
+    def test_csv(self, test_db, user):
+        """Test CSV export."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            add_records(user, datetime(2016, 8, 1, 9), 2)
+
+            fp = io.StringIO()
+            export(user, fp, "csv")
+            fp.seek(0)
+
+            rows = list(csv.DictReader(fp))
+            assert [r["content"] for r in rows] == ["Entry 0", "Entry 1"]
+
+    def test_markdown(self, test_db, user):
+        """Test Markdown export groups records by day."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            add_records(user, datetime(2016, 8, 1, 9), 1)
+            add_records(user, datetime(2016, 8, 2, 21, 30), 1)
+
+            fp = io.StringIO()
+            export(user, fp, "md")
+
+            assert fp.getvalue() == (
+                "## Monday, August 01, 2016\n\n"
+                "- 09:00 Entry 0\n"
+                "\n"
+                "## Tuesday, August 02, 2016\n\n"
+                "- 21:30 Entry 0\n")
+
+    def test_unknown_format(self, test_db, user):
+        """Test that unknown formats are rejected."""
+        with pytest.raises(ValueError):
+            export(user, io.StringIO(), "pdf")
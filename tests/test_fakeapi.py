@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Tests for the fake Bot API server."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+import telegram
+import time
+
+from telegram.error import TelegramError
+
+from conftest import custom_update_data
+from diary_peter.outbox import Outbox, retry_after
+from fakeapi import FakeBotAPI
+
+
+@pytest.fixture
+def api(request):
+    """Return a factory for running fake APIs with custom options."""
+    servers = []
+
+    def factory(**kwargs):
+        rv = FakeBotAPI(**kwargs)
+        rv.start()
+        servers.append(rv)
+        return rv, telegram.Bot(rv.token, base_url=rv.base_url)
+
+    def stop_servers():
+        for s in servers:
+            s.stop()
+    request.addfinalizer(stop_servers)
+
+    return factory
+
+
+class TestFakeBotAPI():
+    """Tests for the fake Bot API server."""
+
+    def test_record(self, fake_api, bot):
+        """Test that calls are answered and recorded."""
+        msg = bot.sendMessage(42, text="Hello")
+        bot.answerCallbackQuery("1234", text="Loading")
+
+        assert msg.text == "Hello"
+        assert msg.chat_id == 42
+        assert fake_api.sent() == [{"chat_id": 42, "text": "Hello"}]
+        assert [c.method for c in fake_api.calls] == \
+            ["sendMessage", "answerCallbackQuery"]
+
+    def test_updates(self, fake_api, bot):
+        """Test polling pushed updates."""
+        # Let the server number the updates, the random ids aren't ordered
+        for text in ("One", "Two"):
+            data = custom_update_data(text)
+            del data["update_id"]
+            fake_api.push_update(data)
+
+        updates = bot.getUpdates()
+        assert [u.message.text for u in updates] == ["One", "Two"]
+        assert bot.getUpdates(offset=updates[-1].update_id + 1) == []
+
+    def test_update_ids(self, fake_api, bot):
+        """Test that assigned update ids stay above explicit ones."""
+        for update_id in (None, 5, None):
+            data = custom_update_data()
+            if update_id is None:
+                del data["update_id"]
+            else:
+                data["update_id"] = update_id
+            fake_api.push_update(data)
+
+        assert [u.update_id for u in bot.getUpdates()] == [1, 5, 6]
+
+    def test_webhook(self, fake_api, bot):
+        """Test that polling conflicts with an active webhook."""
+        bot.setWebhook(webhook_url="https://example.com/s3cret")
+        assert fake_api.webhook_url == "https://example.com/s3cret"
+
+        with pytest.raises(TelegramError):
+            bot.getUpdates()
+
+    def test_failures(self, fake_api, bot):
+        """Test injected failures."""
+        fake_api.fail_next("sendMessage", 429, "Too Many Requests: retry "
+            "after 7", retry_after=7)
+        fake_api.fail_next("sendMessage")
+
+        with pytest.raises(TelegramError) as e:
+            bot.sendMessage(42, text="Hello")
+        assert retry_after(e.value) == 7
+
+        with pytest.raises(TelegramError):
+            bot.sendMessage(42, text="Hello")
+
+        bot.sendMessage(42, text="Hello")
+        assert [c.status for c in fake_api.calls] == [429, 500, 200]
+
+    def test_latency(self, api):
+        """Test response latency."""
+        server, bot = api(latency=0.05)
+        started = time.monotonic()
+        bot.sendMessage(42, text="Hello")
+        assert time.monotonic() - started >= 0.05
+
+    def test_rate_limit(self, api):
+        """Test that the outbox recovers from 429 responses."""
+        server, bot = api(chat_rate=20, chat_burst=1, retry_after=0)
+        outbox = Outbox(bot, chat_rate=100, chat_burst=5)
+        outbox.start()
+        try:
+            futures = [outbox.sendMessage(42, text=str(i)) for i in range(5)]
+            assert [f.result(5).text for f in futures] == \
+                [str(i) for i in range(5)]
+        finally:
+            outbox.stop()
+
+        assert outbox.throttled > 0
+        assert [p["text"] for p in server.sent()] == [str(i) for i in range(5)]
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Tests for the coach state machine."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+from types import SimpleNamespace
+
+from diary_peter.coaches import Coach, Setup, Menu, Gratitude, registry
+from diary_peter.fsm import Registry, Conversation, InvalidTransition, \
+    UnknownState, state
+
+
+def make_registry():
+    """Return a registry with two small coaches."""
+    rv = Registry()
+
+    @rv.register
+    class Door(Coach):
+        NAME = "Door"
+        CLOSED, OPEN, BROKEN = range(3)
+
+        @state(CLOSED, to=[OPEN])
+        def closed(self, conv, update):
+            conv.move(update)
+            if conv.user.state == self.OPEN and update != self.OPEN:
+                return "not reached"
+            return "closed"
+
+        @state(OPEN, to=[CLOSED, ("Hall", 0)])
+        def open(self, conv, update):
+            if update == "leave":
+                conv.move(0, "Hall")
+                return rv.dispatch(conv, update)
+            return "open"
+
+    @rv.register
+    class Hall(Coach):
+        NAME = "Hall"
+        START, INSIDE = range(2)
+
+        @state(START, to=[INSIDE])
+        def start(self, conv, update):
+            conv.move(self.INSIDE)
+            return "hall"
+
+        @state(INSIDE)
+        def inside(self, conv, update):
+            return "inside"
+
+    return rv
+
+
+def conversation(coach, st):
+    """Return a conversation of a user without a database."""
+    user = SimpleNamespace(active_coach=coach, state=st)
+    return Conversation(None, None, None, None, user=user)
+
+
+class TestRegistry:
+    """Tests for registering and dispatching coach states."""
+
+    def test_coaches(self):
+        """Test that all coach states are registered."""
+        for coach, st, name in [
+                (Menu, Menu.START, "START"),
+                (Menu, Menu.AWAITING_DIARY_ENTRY, "AWAITING_DIARY_ENTRY"),
+                (Setup, Setup.AWAITING_COACH_SELECTION,
+                    "AWAITING_COACH_SELECTION"),
+                (Gratitude, Gratitude.AWAITING_REASONS, "AWAITING_REASONS")]:
+            handler = registry.lookup(coach.NAME, st)
+            assert handler.coach is registry.coach(coach.NAME)
+            assert handler.name == name
+
+        assert len(registry.handlers) == 9
+
+    def test_dispatch(self):
+        """Test moving between states and coaches."""
+        rv = make_registry()
+        conv = conversation("Door", 0)
+
+        assert rv.dispatch(conv, 1) == "closed"
+        assert (conv.user.active_coach, conv.user.state) == ("Door", 1)
+
+        # Nested dispatch is checked against the inner handler
+        assert rv.dispatch(conv, "leave") == "hall"
+        assert (conv.user.active_coach, conv.user.state) == ("Hall", 1)
+        assert conv.handler is None
+
+    def test_invalid_transition(self):
+        """Test that undeclared transitions are rejected."""
+        rv = make_registry()
+        conv = conversation("Door", 0)
+
+        with pytest.raises(InvalidTransition):
+            rv.dispatch(conv, 2)
+        assert conv.user.state == 0
+
+        # Staying in the handled state is allowed
+        assert rv.dispatch(conv, 0) == "closed"
+
+    def test_unknown_state(self):
+        """Test looking up states that have no handler."""
+        rv = make_registry()
+
+        with pytest.raises(UnknownState):
+            rv.dispatch(conversation("Door", 2), None)
+        with pytest.raises(UnknownState):
+            rv.dispatch(conversation("Attic", 0), None)
+        with pytest.raises(UnknownState):
+            rv.coach("Attic")
+
+    def test_validate(self):
+        """Test that transitions to unregistered states are found."""
+        rv = make_registry()
+        rv.validate()
+
+        class Attic(Coach):
+            NAME = "Attic"
+
+            @state(0, to=[("Roof", 0)])
+            def start(self, conv, update):
+                pass
+
+        rv.register(Attic)
+        with pytest.raises(ValueError):
+            rv.validate()
+        with pytest.raises(ValueError):
+            rv.register(Attic)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""Tests for scheduled jobs."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from datetime import datetime, time, timedelta
+from playhouse.test_utils import test_database
+
+from conftest import create_users
+from diary_peter import jobs
+from diary_peter.cache import user_cache
+from diary_peter.jobs import Scheduler, next_run, SCHEDULE_OFFSET
+from diary_peter.models import User, Record, Job, DailySummary
+
+
+class RecordingBot(object):
+    """Bot stand-in that records sent messages."""
+
+    def __init__(self):
+        """Init empty message list."""
+        self.sent = []
+
+    def sendMessage(self, chat_id, text=None, **kwargs):
+        """Record message."""
+        self.sent.append((chat_id, text))
+
+
+def test_next_run():
+    """Test computing the next run of a daily job."""
+    now = datetime(2016, 6, 1, 12, 0)
+    scheduled_at = time(hour=22)
+
+    rv = next_run(scheduled_at, now)
+    assert rv == datetime(2016, 6, 1, 22, 0) - SCHEDULE_OFFSET
+    assert next_run(scheduled_at, rv) == rv + timedelta(days=1)
+
+
+class TestScheduler():
+    """Tests for the database backed scheduler."""
+
+    def test_tick(self, test_db):
+        """Test that due jobs fire and are advanced by a day."""
+        users = create_users(test_db, num=5)
+        with test_database(test_db, [User, Record, Job, DailySummary], fail_silently=True):
+            now = datetime.now()
+            for i, user in enumerate(users):
+                user.save(force_insert=True)
+                Job.create(
+                    user=user,
+                    coach="Gratitude",
+                    state=1,
+                    text="Job {}".format(i),
+                    next_run_at=now + timedelta(hours=i - 2))
+
+            bot = RecordingBot()
+            Scheduler(batch_size=2).tick(bot)
+
+            assert sorted(t for c, t in bot.sent) == ["Job 0", "Job 1", "Job 2"]
+            for job in Job.select().join(User):
+                if job.text in ("Job 0", "Job 1", "Job 2"):
+                    assert job.next_run_at > now
+                    assert job.user.active_coach == "Gratitude"
+                    assert job.user.state == 1
+                else:
+                    assert job.user.active_coach == "Setup"
+
+    def test_tick_cache(self, test_db, user, monkeypatch):
+        """Test that moved users are dropped from the cache after commit."""
+        with test_database(test_db, [User, Record, Job, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            Job.create(user=user, coach="Gratitude", state=1, text="Hi",
+                next_run_at=datetime.now() - timedelta(minutes=1))
+
+            invalidate = user_cache.invalidate
+            depths = []
+
+            def recording_invalidate(key):
+                depths.append(jobs.db.transaction_depth())
+                invalidate(key)
+
+            monkeypatch.setattr(user_cache, "invalidate", recording_invalidate)
+            Scheduler().tick(RecordingBot())
+
+            assert depths == [0]
+            assert User.from_cache(user.telegram_id) is None
+
+    def test_schedule_missing(self, test_db, user):
+        """Test that jobs without a next run are scheduled."""
+        with test_database(test_db, [User, Record, Job, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            Job.create(user=user, coach="Gratitude", text="Hi")
+
+            if not jobs.db.is_closed():
+                jobs.db.close()
+            Scheduler(batch_size=1).schedule_missing()
+
+            assert Job.get().next_run_at > datetime.now()
+            # The pooled connection was returned
+            assert jobs.db.is_closed()
+
+    def test_shard(self, test_db):
+        """Test that a sharded scheduler only fires its own users' jobs."""
+        users = create_users(test_db, num=6)
+        with test_database(test_db, [User, Record, Job, DailySummary], fail_silently=True):
+            now = datetime.now()
+            for user in users:
+                user.save(force_insert=True)
+                Job.create(user=user, coach="Gratitude", state=1,
+                    text=str(user.telegram_id),
+                    next_run_at=now - timedelta(hours=1))
+
+            bot = RecordingBot()
+            Scheduler(shard=(1, 3)).tick(bot)
+
+            assert sorted(int(t) % 3 for c, t in bot.sent) == [1, 1]
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Tests for the encoded keyboards."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+
+from collections import OrderedDict
+
+from diary_peter.keyboards import keyboard, inline_keyboard, hide_keyboard
+
+
+class TestKeyboards:
+    """Tests for keyboards sent as JSON."""
+
+    def test_keyboard(self):
+        """Test that custom keyboards are encoded once."""
+        kb = keyboard("morning_hours")
+        assert kb is keyboard("morning_hours")
+        assert json.loads(kb)["keyboard"][1][1] == {"text": "9am"}
+        assert keyboard("notakeyboard") is None
+
+    def test_inline_keyboard(self):
+        """Test that inline keyboards are cached by their options."""
+        options = OrderedDict([("a", "Option A"), ("b", "Option B")])
+        kb = inline_keyboard(options)
+        assert kb is inline_keyboard(OrderedDict(options))
+        assert json.loads(kb)["inline_keyboard"] == [
+            [{"text": "Option A", "callback_data": "a"}],
+            [{"text": "Option B", "callback_data": "b"}]]
+
+    def test_hide(self):
+        """Test the encoded instruction to hide the keyboard."""
+        assert json.loads(hide_keyboard)["hide_keyboard"] is True
+
+    def test_sent(self, bot, fake_api):
+        """Test that an encoded keyboard arrives as sent."""
+        bot.sendMessage(42, text="Up?", reply_markup=keyboard("thumbs"))
+        assert fake_api.sent()[0]["reply_markup"] == keyboard("thumbs")
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""Tests for runtime metrics."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+from peewee import SqliteDatabase
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from diary_peter import metrics
+from diary_peter.coaches import Setup
+from diary_peter.metrics import Counter, Gauge, Histogram, MetricsServer, \
+    Registry
+from diary_peter.models import CountingMixin
+
+
+class CountingDatabase(CountingMixin, SqliteDatabase):
+    """In-memory database counting queries."""
+
+
+class TestMetrics():
+    """Tests for metric types and rendering."""
+
+    def test_counter(self):
+        """Test counting per label set."""
+        registry = Registry()
+        c = Counter("errors_total", "Errors", ["kind"], registry)
+        c.inc(kind="a")
+        c.inc(2, kind='quote"d')
+
+        assert registry.render().splitlines() == [
+            "# HELP errors_total Errors",
+            "# TYPE errors_total counter",
+            'errors_total{kind="a"} 1.0',
+            'errors_total{kind="quote\\"d"} 2.0'
+        ]
+
+    def test_histogram(self):
+        """Test that buckets are cumulative and include their bound."""
+        registry = Registry()
+        h = Histogram("latency", "Latency", ["coach"], (1, 2), registry)
+        for value in (0.5, 1, 1.5, 3):
+            h.observe(value, coach="Menu")
+
+        lines = registry.render().splitlines()
+        assert lines[2:] == [
+            'latency_bucket{coach="Menu",le="1"} 2',
+            'latency_bucket{coach="Menu",le="2"} 3',
+            'latency_bucket{coach="Menu",le="+Inf"} 4',
+            'latency_sum{coach="Menu"} 6.0',
+            'latency_count{coach="Menu"} 4'
+        ]
+        assert h.count(coach="Menu") == 4
+
+    def test_gauge(self):
+        """Test that gauges are read when rendering."""
+        registry = Registry()
+        Gauge("depth", "Queue depth", lambda: 3, registry)
+        assert registry.render().endswith("depth 3\n")
+
+    def test_measure_update(self):
+        """Test counting queries and commits of an update."""
+        database = CountingDatabase(":memory:")
+        labels = {"coach": "Test", "state": "START"}
+        queries = metrics.update_queries.count(**labels)
+
+        with metrics.measure_update() as update_labels:
+            update_labels.update(labels)
+            with database.transaction():
+                database.execute_sql("CREATE TABLE t (x INTEGER)")
+                database.execute_sql("INSERT INTO t VALUES (1)")
+
+        assert metrics.update_queries.count(**labels) == queries + 1
+        counts, total = metrics.update_queries.values[("Test", "START")]
+        assert total >= 3
+        counts, total = metrics.update_transactions.values[("Test", "START")]
+        assert total >= 1
+
+        with pytest.raises(ValueError):
+            with metrics.measure_update() as update_labels:
+                update_labels.update(labels)
+                raise ValueError()
+        assert metrics.update_errors.get(**labels) == 1
+
+    def test_state_name(self):
+        """Test naming coach states."""
+        assert Setup.state_name(Setup.AWAITING_NAME) == "AWAITING_NAME"
+        assert Setup.state_name(99) == "99"
+
+    def test_server(self):
+        """Test serving metrics over HTTP."""
+        registry = Registry()
+        Gauge("up", "Running", lambda: 1, registry)
+        httpd = MetricsServer(("127.0.0.1", 0), registry)
+        httpd.start()
+
+        try:
+            url = "http://127.0.0.1:{}".format(httpd.server_address[1])
+            body = urlopen(url + "/metrics").read().decode("utf-8")
+            assert "up 1" in body
+
+            with pytest.raises(HTTPError):
+                urlopen(url + "/other")
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
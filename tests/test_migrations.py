@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""Tests for schema migrations and the indexes they add."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from datetime import datetime, timedelta
+from playhouse.migrate import SchemaMigrator, migrate as run_operations
+from playhouse.test_utils import test_database
+
+from diary_peter.jobs import Scheduler
+from diary_peter.migrations import MIGRATIONS, SchemaVersion, current_version, \
+    migrate, stamp
+from diary_peter.models import User, Record, Job, DailySummary
+
+MODELS = [User, Record, Job, DailySummary, SchemaVersion]
+
+
+def query_plan(db, query):
+    """Return SQLite's query plan for a peewee query as a single string."""
+    sql, params = query.sql()
+    cursor = db.execute_sql("EXPLAIN QUERY PLAN " + sql, params)
+    return " ".join(str(row[-1]) for row in cursor.fetchall())
+
+
+class TestMigrations():
+    """Tests for the migration runner."""
+
+    def test_migrate(self, test_db):
+        """Test migrating a database created before migrations existed."""
+        with test_database(test_db, MODELS, fail_silently=True):
+            migrator = SchemaMigrator.from_database(test_db)
+            run_operations(
+                migrator.drop_index("record", "record_user_id_created"),
+                migrator.drop_column("job", "next_run_at"))
+            assert current_version() == 0
+
+            applied = migrate()
+
+            assert applied == [m[0] for m in MIGRATIONS]
+            assert current_version() == MIGRATIONS[-1][0]
+            assert "next_run_at" in [c.name for c in test_db.get_columns("job")]
+            assert migrate() == []
+
+    def test_stamp(self, test_db):
+        """Test that fresh tables can be marked as up to date."""
+        with test_database(test_db, MODELS, fail_silently=True):
+            stamp()
+            assert current_version() == MIGRATIONS[-1][0]
+            assert migrate() == []
+
+
+class TestIndexes():
+    """Test that hot queries use their indexes."""
+
+    def test_recent_records(self, test_db, user):
+        """Test loading a user's records of the last day."""
+        with test_database(test_db, MODELS, fail_silently=True):
+            query = user.records.select().where(
+                Record.created >= datetime.now() - timedelta(hours=24))
+            assert "record_user_id_created" in query_plan(test_db, query)
+
+    def test_due_jobs(self, test_db):
+        """Test selecting due jobs."""
+        with test_database(test_db, MODELS, fail_silently=True):
+            query = Scheduler().due(datetime.now())
+            assert "job_next_run_at" in query_plan(test_db, query)
@@ -16,10 +16,19 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import pytest
+
+from datetime import date, datetime, timedelta
+from peewee import SqliteDatabase
+from threading import Event, Thread, Timer
+from playhouse.pool import PooledSqliteDatabase, MaxConnectionsExceeded
 from playhouse.test_utils import test_database
 from telegram.emoji import Emoji
 
-from diary_peter.models import User, Record
+from diary_peter.models import User, Record, DailySummary, checkpoint, \
+    connection, pool_stats, sqlite_options
+
+from diary_peter.sessions import RecordSession
 
 from conftest import create_users
 
@@ -55,7 +64,7 @@ class TestRecords():
 
     def test_gen(self, test_db):
         """Test creating of records."""
-        with test_database(test_db, [User, Record], fail_silently=True):
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
             user = create_users(test_db, 1)[0]
             records = []
             for i in range(10):
@@ -67,3 +76,176 @@ class TestRecords():
             assert len(records) == 10
             assert isinstance(records[0], Record)
             assert records[0].user == user
+
+
+class TestDailySummary():
+    """Tests for the daily rollup of records."""
+
+    def test_incremental(self, test_db, user):
+        """Test that saved and batch inserted records are counted."""
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            user.save(force_insert=True)
+            morning = datetime(2016, 8, 1, 9)
+            rec = user.create_record("text", "Morning")
+            rec.created = morning
+            rec.save()
+            rec.content = "Good morning"
+            rec.save()
+
+            Record.insert_batch([{
+                "user": user.id,
+                "kind": "Gratitude",
+                "content": "Thing {}".format(i),
+                "reaction": "Reason" if i else None,
+                "created": morning + timedelta(hours=i + 1)
+            } for i in range(3)] + [{
+                "user": user.id,
+                "kind": "text",
+                "content": "Next day",
+                "reaction": None,
+                "created": morning + timedelta(days=1)
+            }])
+
+            first, second = DailySummary.period(
+                user, date(2016, 8, 1), date(2016, 8, 7))
+            assert (first.entries, first.text_entries,
+                first.gratitude_entries, first.gratitude_reasons) == \
+                (4, 1, 3, 2)
+            assert not first.gratitude_complete
+            assert first.first_entry == morning
+            assert first.last_entry == morning + timedelta(hours=3)
+            assert second.entries == 1
+
+    def test_reactions(self, test_db, user):
+        """Test that reasons added in a session complete the day."""
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            user.save(force_insert=True)
+            session = RecordSession(user, "Gratitude", 3)
+            for i in range(3):
+                session.add("Thing {}".format(i))
+            session.save()
+
+            session = RecordSession(user, "Gratitude", 3)
+            for rec in session:
+                rec.reaction = "Reason"
+            session.save()
+
+            summary = DailySummary.get(DailySummary.user == user)
+            assert summary.gratitude_reasons == 3
+            assert summary.gratitude_complete
+
+    def test_rebuild(self, test_db):
+        """Test that rebuilding matches the incremental summaries."""
+        users = create_users(test_db, num=2)
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            for i, u in enumerate(users):
+                u.save(force_insert=True)
+                for j in range(i + 2):
+                    u.create_record("Gratitude", "Thing", "Reason").save()
+
+            def summaries():
+                return [(s.user_id, s.date, s.entries, s.gratitude_reasons,
+                    s.gratitude_complete, s.first_entry, s.last_entry)
+                    for s in DailySummary.select().order_by(DailySummary.id)]
+
+            expected = summaries()
+            DailySummary.delete().execute()
+
+            assert DailySummary.rebuild([u.id for u in users]) == 2
+            assert summaries() == expected
+
+    def test_rebuild_atomic(self, test_db, user, monkeypatch):
+        """Test that records are aggregated in the rebuild's transaction."""
+        with test_database(test_db, [User, Record, DailySummary],
+                fail_silently=True):
+            user.save(force_insert=True)
+            user.create_record("text", "Entry").save()
+
+            execute_sql = test_db.execute_sql
+            depths = []
+
+            def recording_execute_sql(sql, *args, **kwargs):
+                if "GROUP BY" in sql:
+                    depths.append(test_db.transaction_depth())
+                return execute_sql(sql, *args, **kwargs)
+
+            monkeypatch.setattr(test_db, "execute_sql", recording_execute_sql)
+            assert DailySummary.rebuild([user.id]) == 1
+            assert depths == [1]
+
+
+class TestConnection():
+    """Tests for pooled connection handling."""
+
+    def test_wait(self, tmpdir):
+        """Test waiting for a connection held by another thread."""
+        pool = PooledSqliteDatabase(str(tmpdir.join("pool.db")),
+            max_connections=1, check_same_thread=False)
+        opened = Event()
+        release = Event()
+
+        def hold():
+            with connection(pool):
+                opened.set()
+                release.wait(5)
+
+        thr = Thread(target=hold)
+        thr.start()
+        opened.wait(5)
+        Timer(0.05, release.set).start()
+
+        waits = pool_stats.waits
+        with connection(pool):
+            assert not pool.is_closed()
+            assert pool_stats.as_dict(pool)["utilization"] == 1
+        thr.join()
+
+        assert pool.is_closed()
+        assert pool_stats.waits == waits + 1
+
+    def test_timeout(self, tmpdir):
+        """Test giving up when no connection becomes available."""
+        pool = PooledSqliteDatabase(str(tmpdir.join("pool.db")),
+            max_connections=1, check_same_thread=False)
+        opened = Event()
+        release = Event()
+
+        def hold():
+            with connection(pool):
+                opened.set()
+                release.wait(5)
+
+        thr = Thread(target=hold)
+        thr.start()
+        opened.wait(5)
+
+        with pytest.raises(MaxConnectionsExceeded):
+            with connection(pool, timeout=0.05):
+                pass
+        release.set()
+        thr.join()
+
+
+class TestSqliteProfile():
+    """Tests for the tuned SQLite profile."""
+
+    def test_production(self, tmpdir):
+        """Test that the production profile uses a write-ahead log."""
+        database = SqliteDatabase(str(tmpdir.join("wal.db")),
+            **sqlite_options("production"))
+
+        with connection(database):
+            mode = database.execute_sql("PRAGMA journal_mode").fetchone()[0]
+            assert mode == "wal"
+            assert database.execute_sql(
+                "PRAGMA wal_autocheckpoint").fetchone()[0] == 1000
+
+        busy, log, checkpointed = checkpoint(database)
+        assert busy == 0
+
+    def test_default(self):
+        """Test that SQLite defaults are kept without a profile."""
+        assert sqlite_options("default") == {}
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""Tests for the outbound message queue."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+import time
+
+from telegram.error import NetworkError, TelegramError
+
+from diary_peter.outbox import Outbox, TokenBucket
+
+
+class RecordingBot(object):
+    """Bot stand-in that records sent messages and can fail on request."""
+
+    def __init__(self, errors=None):
+        """Init with a list of errors to raise before succeeding."""
+        self.sent = []
+        self.errors = list(errors or [])
+
+    def sendMessage(self, chat_id, text=None, **kwargs):
+        """Record message or raise the next error."""
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, text, time.monotonic()))
+        return text
+
+
+@pytest.fixture
+def outbox(request):
+    """Return a started outbox factory that is stopped after the test."""
+    outboxes = []
+
+    def factory(bot, **kwargs):
+        rv = Outbox(bot, **kwargs)
+        rv.start()
+        outboxes.append(rv)
+        return rv
+
+    def stop_outboxes():
+        for o in outboxes:
+            o.stop()
+    request.addfinalizer(stop_outboxes)
+
+    return factory
+
+
+class TestTokenBucket():
+    """Tests for the token bucket."""
+
+    def test_delay(self):
+        """Test that an empty bucket reports time until the next token."""
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = bucket.updated
+        bucket.take(now)
+        bucket.take(now)
+
+        assert bucket.delay(now) == pytest.approx(0.5)
+        assert bucket.delay(now + 0.5) == 0
+
+
+class TestOutbox():
+    """Tests for the outbox."""
+
+    def test_order(self, outbox):
+        """Test that messages within a chat keep their order."""
+        bot = RecordingBot()
+        ob = outbox(bot, global_rate=1000, chat_rate=1000, chat_burst=1000)
+
+        futures = [ob.bot.sendMessage(chat % 3, text=str(i))
+            for i, chat in enumerate(range(30))]
+
+        assert [f.result(5) for f in futures] == [str(i) for i in range(30)]
+        for chat in range(3):
+            texts = [int(t) for c, t, ts in bot.sent if c == chat]
+            assert texts == sorted(texts)
+
+    def test_chat_rate(self, outbox):
+        """Test that a chat is limited to its rate after the burst."""
+        bot = RecordingBot()
+        ob = outbox(bot, global_rate=1000, chat_rate=10, chat_burst=2)
+
+        futures = [ob.bot.sendMessage(1, text=str(i)) for i in range(4)]
+        [f.result(5) for f in futures]
+
+        times = [ts for c, t, ts in bot.sent]
+        assert times[3] - times[0] >= 0.15
+
+    def test_chat_rate_sustained(self, outbox):
+        """Test that a chat stays limited for longer than a bucket's TTL."""
+        bot = RecordingBot()
+        ob = outbox(bot, global_rate=1000, chat_rate=20, chat_burst=2)
+
+        futures = [ob.bot.sendMessage(1, text=str(i)) for i in range(12)]
+        [f.result(5) for f in futures]
+
+        times = [ts for c, t, ts in bot.sent]
+        assert times[-1] - times[0] >= 0.45
+
+    def test_retry(self, outbox):
+        """Test that 429 and network errors are retried."""
+        bot = RecordingBot(errors=[
+            TelegramError("Too Many Requests: retry after 0 (429)"),
+            NetworkError("Bad Gateway")])
+        ob = outbox(bot, backoff=0.01)
+
+        assert ob.bot.sendMessage(1, text="Hi").result(5) == "Hi"
+        assert ob.throttled == 1
+
+    def test_failure(self, outbox):
+        """Test that other errors are set on the future."""
+        bot = RecordingBot(errors=[TelegramError("Bad Request")])
+        ob = outbox(bot)
+
+        with pytest.raises(TelegramError):
+            ob.bot.sendMessage(1, text="Hi").result(5)
+        assert ob.bot.sendMessage(1, text="Hi").result(5) == "Hi"
+        assert ob.failed == 1
+
+    def test_send_many(self, outbox):
+        """Test queueing a batch of messages at once."""
+        bot = RecordingBot()
+        ob = outbox(bot, global_rate=1000, chat_rate=1000, chat_burst=1000)
+
+        futures = ob.send_many("sendMessage",
+            [(i % 5, {"text": str(i)}) for i in range(20)])
+
+        assert [f.result(5) for f in futures] == [str(i) for i in range(20)]
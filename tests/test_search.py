@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""Tests for full-text search."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from playhouse.test_utils import test_database
+
+from diary_peter.models import User, Record, DailySummary
+from diary_peter.search import create_index, format_results, \
+    match_expression, search
+from diary_peter.sessions import RecordSession
+
+from conftest import create_users
+
+
+def contents(records):
+    """Return the contents of records."""
+    return [r.content for r in records]
+
+
+class TestSearch():
+    """Tests for searching records."""
+
+    def test_index_existing(self, test_db, user):
+        """Test that records from before the index are found."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            user.create_record("text", "We walked along the beach").save()
+            create_index(test_db)
+
+            records, more = search(user, "walking")
+
+            assert contents(records) == ["We walked along the beach"]
+            assert not more
+
+    def test_sync(self, test_db, user):
+        """Test that inserts, updates and deletes reach the index."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            create_index(test_db)
+            user.save(force_insert=True)
+            rec = user.create_record("text", "Cooked pasta")
+            rec.save()
+            Record.insert_batch([{"user": user.id, "kind": "text",
+                "content": "More pasta", "reaction": None,
+                "created": rec.created}])
+            assert len(search(user, "pasta")[0]) == 2
+
+            rec.content = "Cooked rice"
+            rec.save()
+            assert contents(search(user, "pasta")[0]) == ["More pasta"]
+            assert contents(search(user, "rice")[0]) == ["Cooked rice"]
+
+            session = RecordSession(user, "text", 3)
+            session[0].reaction = "It was tasty"
+            session.save()
+            assert contents(search(user, "tasty")[0]) == ["Cooked rice"]
+
+            rec.delete_instance()
+            assert search(user, "rice")[0] == []
+
+    def test_users(self, test_db):
+        """Test that only the user's own records are found."""
+        users = create_users(test_db, num=2)
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            create_index(test_db)
+            for u in users:
+                u.save(force_insert=True)
+                u.create_record("text", "Secret").save()
+
+            assert [r.user_id for r in search(users[1], "secret")[0]] == \
+                [users[1].id]
+
+    def test_pages(self, test_db, user):
+        """Test ranking and pagination."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            create_index(test_db)
+            user.save(force_insert=True)
+            for i in range(3):
+                user.create_record("text", "Tea number {}".format(i)).save()
+            user.create_record("text", "Tea, tea and more tea").save()
+
+            records, more = search(user, "tea", page=1, per_page=2)
+            assert records[0].content == "Tea, tea and more tea"
+            assert more
+
+            records, more = search(user, "tea", page=2, per_page=2)
+            assert len(records) == 2
+            assert not more
+
+    def test_match_expression(self):
+        """Test that query syntax in user input is quoted."""
+        assert match_expression('cats OR "dogs') == '"cats" "OR" """dogs"'
+
+    def test_format_results(self, test_db, user):
+        """Test the search result message."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            create_index(test_db)
+            user.save(force_insert=True)
+            user.create_record("text", "Tea", reaction="Warm").save()
+            records, more = search(user, "tea")
+
+            text = format_results("tea", 2, records, True)
+            assert "Entries 11-11" in text
+            assert "  > Warm" in text
+            assert text.endswith("Send /search 3 tea for more.")
+
+            assert "couldn't find" in format_results("cake", 1, [], False)
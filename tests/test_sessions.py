@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+"""Tests for coach record sessions."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from datetime import datetime, timedelta
+from playhouse.test_utils import test_database
+
+from diary_peter.models import User, Record, DailySummary
+from diary_peter.sessions import RecordSession
+
+
+class TestRecordSession():
+    """Tests for record sessions."""
+
+    def test_load(self, test_db, user):
+        """Test that only recent records of the session's kind are loaded."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            user.create_record("text", "Diary entry").save()
+            old = user.create_record("Gratitude", "Yesterday")
+            old.created = datetime.now() - timedelta(days=2)
+            old.save()
+            for i in range(4):
+                user.create_record("Gratitude", "Thing {}".format(i)).save()
+
+            session = RecordSession(user, "Gratitude", 3)
+
+            assert [r.content for r in session] == \
+                ["Thing 0", "Thing 1", "Thing 2"]
+
+    def test_save(self, test_db, user):
+        """Test that new and changed records are written."""
+        with test_database(test_db, [User, Record, DailySummary], fail_silently=True):
+            user.save(force_insert=True)
+            user.create_record("Gratitude", "Thing 0").save()
+            user.create_record("Gratitude", "Thing 1").save()
+
+            session = RecordSession(user, "Gratitude", 3)
+            session[1].reaction = "Because"
+            session.add("Thing 2")
+
+            assert session.changed() == [session[1]]
+            session.save()
+            assert session.changed() == []
+
+            records = list(Record.select().order_by(Record.id))
+            assert [r.content for r in records] == \
+                ["Thing 0", "Thing 1", "Thing 2"]
+            assert [r.reaction for r in records] == [None, "Because", None]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Tests for running the bot in shard processes."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import telegram
+import time
+
+from queue import Queue
+from playhouse.test_utils import test_database
+
+from conftest import create_users, custom_update, inline_query
+from diary_peter.models import User
+from diary_peter.shards import Router, Supervisor, feed, in_shard, shard_of
+
+
+# Runs the supervisor with shards that mark when they were stopped cleanly
+SUPERVISE = """
+import signal, sys
+sys.path[:0] = [{root!r}, {tests!r}]
+import main
+
+def shard(index, shards, updates, token):
+    signal.signal(signal.SIGTERM, main.interrupt)
+    try:
+        while updates.get() is not None:
+            pass
+    except KeyboardInterrupt:
+        while updates.get() is not None:
+            pass
+    finally:
+        open({tmpdir!r} + "/stopped.{{}}".format(index), "w").close()
+
+main.run_shard = shard
+main.supervise("123:abc", 2)
+"""
+
+
+def echo(index, shards, updates, results):
+    """Worker that reports the first update it receives and exits."""
+    results.put((index, updates.get()))
+
+
+class TestShards:
+    """Tests for routing users to shards."""
+
+    def test_in_shard(self, test_db):
+        """Test that the query expression agrees with shard_of."""
+        users = create_users(test_db, num=7)
+        with test_database(test_db, [User], fail_silently=True):
+            for u in users:
+                u.save(force_insert=True)
+
+            for index in range(3):
+                ids = [u.telegram_id for u in User.select().where(
+                    in_shard(User.telegram_id, index, 3))]
+                assert ids
+                assert all(shard_of(i, 3) == index for i in ids)
+
+    def test_router(self):
+        """Test that updates go to the queue of their user's shard."""
+        queues = [Queue() for i in range(4)]
+        router = Router(queues)
+        update = custom_update("Hello")
+        router.put(update)
+        router.put(inline_query("continue"))
+        router.put(telegram.Update(update_id=1))
+
+        index = shard_of(update.message.from_user.id, 4)
+        assert queues[index].qsize() == 2
+        assert queues[0].qsize() == 1 or index == 0
+        assert sum(router.routed) == 3
+
+        local = Queue()
+        queues[index].put(None)
+        feed(queues[index], local)
+        assert local.get().message.text == "Hello"
+        assert local.get().callback_query.data == "continue"
+
+    def test_supervisor(self):
+        """Test starting, restarting and stopping worker processes."""
+        results = multiprocessing.Queue()
+        supervisor = Supervisor(echo, 2, args=(results,))
+        supervisor.start()
+        for q in supervisor.queues:
+            q.put("update")
+        assert sorted(results.get(timeout=10) for i in range(2)) == \
+            [(0, "update"), (1, "update")]
+
+        for proc in supervisor.processes:
+            proc.join(10)
+        supervisor.check()
+        assert supervisor.restarts == 2
+
+        supervisor.stop()
+        assert sorted(results.get(timeout=10) for i in range(2)) == \
+            [(0, None), (1, None)]
+        assert not any(p.is_alive() for p in supervisor.processes)
+
+    def test_sigterm(self, tmpdir):
+        """Test that SIGTERM stops the supervisor and its shards."""
+        tests = os.path.dirname(os.path.abspath(__file__))
+        script = SUPERVISE.format(root=os.path.dirname(tests), tests=tests,
+            tmpdir=str(tmpdir))
+        proc = subprocess.Popen([sys.executable, "-c", script],
+            cwd=str(tmpdir), start_new_session=True)
+        time.sleep(2)
+
+        # Like a process manager stopping the whole process group
+        os.killpg(proc.pid, signal.SIGTERM)
+        assert proc.wait(30) == 0
+        assert sorted(os.listdir(str(tmpdir.join("")))) == \
+            ["stopped.0", "stopped.1"]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Tests for warm restart snapshots."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+
+from datetime import time
+from playhouse.test_utils import test_database
+
+from conftest import create_users
+from diary_peter import snapshot
+from diary_peter.cache import LRUCache
+from diary_peter.models import User, Record, Job, DailySummary
+
+
+class TestSnapshot:
+    """Tests for writing and loading snapshots."""
+
+    def test_roundtrip(self, test_db, tmpdir):
+        """Test that cached users are restored as they were."""
+        path = str(tmpdir.join("snapshot.bin"))
+        users = create_users(test_db, num=3)
+        with test_database(test_db, [User, Record, Job, DailySummary],
+                fail_silently=True):
+            cache = LRUCache()
+            for u in users:
+                u.save(force_insert=True)
+            users[1].name = "Zoë"
+            users[1].active_coach = "Gratitude"
+            users[1].state = 2
+            users[1].wake_time = time(7, 30)
+            users[1].intro_seen = True
+            users[1].save()
+            for u in users:
+                cache.put(u.telegram_id, dict(u._data))
+
+            assert snapshot.write(path, cache) == 3
+
+            restored = LRUCache()
+            assert snapshot.load(path, restored) == 3
+            assert not os.path.exists(path)
+            assert [k for k, v in restored.items()] == \
+                [u.telegram_id for u in users]
+
+            data = restored.get(users[1].telegram_id)
+            user = User(**data)
+            assert (user.name, user.active_coach, user.state, user.wake_time,
+                user.intro_seen, user.ask_mood) == \
+                ("Zoë", "Gratitude", 2, time(7, 30), True, True)
+            assert user.id == users[1].id
+
+    def test_stale(self, test_db, tmpdir):
+        """Test that snapshots are discarded when the database changed."""
+        path = str(tmpdir.join("snapshot.bin"))
+        users = create_users(test_db, num=2)
+        with test_database(test_db, [User, Record, Job, DailySummary],
+                fail_silently=True):
+            cache = LRUCache()
+            users[0].save(force_insert=True)
+            cache.put(users[0].telegram_id, dict(users[0]._data))
+            snapshot.write(path, cache)
+
+            users[1].save(force_insert=True)
+            restored = LRUCache()
+            assert snapshot.load(path, restored) == 0
+            assert len(restored) == 0
+            assert snapshot.load(path, restored) == 0
+
+    def test_corrupt(self, test_db, tmpdir):
+        """Test that damaged snapshots are discarded."""
+        path = str(tmpdir.join("snapshot.bin"))
+        users = create_users(test_db, num=1)
+        with test_database(test_db, [User, Record, Job, DailySummary],
+                fail_silently=True):
+            cache = LRUCache()
+            users[0].save(force_insert=True)
+            cache.put(users[0].telegram_id, dict(users[0]._data))
+            snapshot.write(path, cache)
+
+            with open(path, "r+b") as fp:
+                fp.seek(-1, os.SEEK_END)
+                fp.write(b"\xff")
+            assert snapshot.load(path, LRUCache()) == 0
+
+            with open(path, "wb") as fp:
+                fp.write(b"DPSNAP")
+            assert snapshot.load(path, LRUCache()) == 0
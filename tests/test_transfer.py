@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Tests for copying the database to another one."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import pytest
+
+from datetime import datetime, time
+from peewee import SqliteDatabase, Using
+
+from diary_peter import transfer
+from diary_peter.migrations import SchemaVersion, pending, stamp
+from diary_peter.models import User, Record, Job, DailySummary
+from diary_peter.search import create_index, search
+
+MODELS = [User, Record, Job, DailySummary, SchemaVersion]
+
+
+@pytest.fixture
+def source(tmpdir):
+    """Return an SQLite database with a few users, records and summaries."""
+    database = SqliteDatabase(str(tmpdir.join("source.db")))
+    with Using(database, MODELS, with_transaction=False):
+        database.create_tables(MODELS)
+        create_index(database)
+        stamp()
+        for i in range(5):
+            user = User.create(telegram_id=1000 + i, name="User-{}".format(i),
+                chat_id=1000 + i, wake_time=time(7, i))
+            Job.create(user=user, coach="Gratitude", text="Evening",
+                next_run_at=datetime(2016, 8, 1, 22, i))
+            for j in range(7):
+                Record.create(user=user, kind="text",
+                    content="Entry {}\twith\\ tab\nand newline".format(j),
+                    created=datetime(2016, 8, j + 1, 9, 30, 0, 123))
+    return database
+
+
+@pytest.fixture
+def target(tmpdir):
+    """Return an empty SQLite database."""
+    return SqliteDatabase(str(tmpdir.join("target.db")))
+
+
+class TestTransfer:
+    """Tests for the database transfer."""
+
+    def test_transfer(self, source, target):
+        """Test that all rows are copied in batches and verify."""
+        assert transfer.transfer(source, target, batch_size=4) == {
+            "user": 5, "job": 5, "record": 35, "daily_summary": 35}
+        assert transfer.verify(source, target, batch_size=3) == []
+
+        with Using(target, MODELS, with_transaction=False):
+            assert not pending()
+            user = User.get(User.telegram_id == 1002)
+            assert user.wake_time == time(7, 2)
+            records, more = search(user, "newline")
+            assert len(records) == 7
+            assert records[0].content.endswith("\twith\\ tab\nand newline")
+
+            # Ids continue after the copied rows
+            assert User.create(telegram_id=2000, chat_id=2000).id == 6
+
+    def test_resume(self, source, target, monkeypatch):
+        """Test that an interrupted transfer continues where it stopped."""
+        write_batch = transfer.write_batch
+        calls = []
+
+        def failing_write_batch(database, model, rows):
+            calls.append(model)
+            if model is Record and calls.count(Record) == 3:
+                raise RuntimeError("Connection lost")
+            write_batch(database, model, rows)
+
+        monkeypatch.setattr(transfer, "write_batch", failing_write_batch)
+        with pytest.raises(RuntimeError):
+            transfer.transfer(source, target, batch_size=10)
+        assert transfer.get_progress(target, "record") == 20
+
+        monkeypatch.setattr(transfer, "write_batch", write_batch)
+        assert transfer.transfer(source, target, batch_size=10) == {
+            "user": 0, "job": 0, "record": 15, "daily_summary": 35}
+        assert transfer.verify(source, target) == []
+
+    def test_verify(self, source, target):
+        """Test that differing tables are reported."""
+        transfer.transfer(source, target)
+        with Using(target, MODELS, with_transaction=False):
+            Record.update(content="Changed").where(Record.id == 3).execute()
+        assert transfer.verify(source, target) == ["record"]
+
+    def test_unmigrated(self, source, target):
+        """Test that a source with pending migrations is refused."""
+        source.execute_sql("DELETE FROM schema_version")
+        with pytest.raises(ValueError):
+            transfer.transfer(source, target)
+
+    def test_copy_value(self):
+        """Test escaping for Postgres' COPY text format."""
+        assert transfer.copy_value(None) == "\\N"
+        assert transfer.copy_value(True) == "t"
+        assert transfer.copy_value(datetime(2016, 8, 1, 9, 30)) == \
+            "2016-08-01 09:30:00"
+        assert transfer.copy_value("a\tb\\c\nd") == "a\\tb\\\\c\\nd"
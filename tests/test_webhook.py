@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""Tests for the webhook server."""
+
+# Copyright 2016 Vincent Ahrend
+
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import os
+import pytest
+import signal
+import telegram
+
+from queue import Queue
+from threading import Timer
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import main
+from conftest import custom_update_data, inline_query_data
+from diary_peter.webhook import WebhookServer
+
+
+@pytest.fixture
+def webhook(request):
+    """Return a running webhook server on a free local port."""
+    httpd = WebhookServer(("127.0.0.1", 0), Queue(), "s3cret")
+    httpd.start()
+
+    def stop_webhook():
+        httpd.shutdown()
+        httpd.server_close()
+    request.addfinalizer(stop_webhook)
+
+    return httpd
+
+
+def post(httpd, path, data):
+    """POST data as JSON to the webhook server and return the status."""
+    url = "http://127.0.0.1:{}{}".format(httpd.server_address[1], path)
+    return urlopen(url, json.dumps(data).encode("utf-8")).getcode()
+
+
+class TestWebhook():
+    """Tests for the webhook server."""
+
+    def test_single(self, webhook):
+        """Test posting a single update."""
+        data = custom_update_data("Hello")
+        assert post(webhook, "/s3cret", data) == 200
+
+        update = webhook.update_queue.get(timeout=1)
+        assert isinstance(update, telegram.Update)
+        assert update.update_id == data["update_id"]
+        assert update.message.text == "Hello"
+
+    def test_batch(self, webhook):
+        """Test posting a list of updates."""
+        data = [custom_update_data("Hello"), inline_query_data("continue")]
+        assert post(webhook, "/s3cret/", data) == 200
+
+        updates = [webhook.update_queue.get(timeout=1) for d in data]
+        assert updates[0].message.text == "Hello"
+        assert updates[1].callback_query.data == "continue"
+
+    def test_secret(self, webhook):
+        """Test that updates on other paths are refused."""
+        with pytest.raises(HTTPError) as e:
+            post(webhook, "/wrong", custom_update_data())
+        assert e.value.code == 404
+        assert webhook.update_queue.empty()
+
+    def test_invalid(self, webhook):
+        """Test that malformed bodies are refused."""
+        with pytest.raises(HTTPError) as e:
+            post(webhook, "/s3cret", "not an update")
+        assert e.value.code == 400
+
+    @pytest.mark.parametrize("data", [
+        {"message": {"text": "No update id"}},
+        [custom_update_data(), {"update_id": 1, "message": "Not a message"}],
+    ])
+    def test_invalid_update(self, webhook, data):
+        """Test that JSON objects that aren't updates are refused."""
+        with pytest.raises(HTTPError) as e:
+            post(webhook, "/s3cret", data)
+        assert e.value.code == 400
+        assert webhook.update_queue.empty()
+
+    def test_sigterm(self, updater, fake_api, monkeypatch):
+        """Test that SIGTERM stops the webhook and tears the bot down."""
+        for name, value in [("WEBHOOK_URL", "https://example.com"),
+                ("WEBHOOK_SECRET", "s3cret"), ("WEBHOOK_LISTEN", "127.0.0.1"),
+                ("WEBHOOK_PORT", "0")]:
+            monkeypatch.setenv(name, value)
+        torn_down = []
+        monkeypatch.setattr(main, "setup", lambda token: updater)
+        monkeypatch.setattr(main, "teardown", lambda: torn_down.append(True))
+
+        previous = signal.getsignal(signal.SIGTERM)
+        Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        main.serve(fake_api.token)
+
+        assert torn_down == [True]
+        assert fake_api.webhook_url == "https://example.com/s3cret"
+        assert signal.getsignal(signal.SIGTERM) == previous